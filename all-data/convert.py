@@ -2,15 +2,19 @@
 Convert input data from various sources to samples format.
 """
 import argparse
+import collections
+import copy
 import subprocess
 import os
 import sys
 import math
+import hashlib
+import pickle
+import time
 
-import allel
+import numcodecs
 import numpy as np
 import tsinfer
-import attr
 import cyvcf2
 import pysam
 import tqdm
@@ -19,104 +23,340 @@ import multiprocessing
 
 import tskit
 
+from liftover import Liftover, reverse_complement
+
 GENERATION_TIME = 25
 
 
-@attr.s()
-class Site(object):
-    position = attr.ib(None)
-    alleles = attr.ib(None)
-    genotypes = attr.ib(None)
-    metadata = attr.ib({})
-    inference = attr.ib(None)
+# Number of sites buffered in a SiteBatch before it is appended to the samples.
+SITE_BATCH_SIZE = 8192
+
+# Report entries that count individuals rather than sites.
+INDIVIDUAL_REPORT_KEYS = ("pseudo_haploid_individuals",)
+
+
+class SiteBatch(object):
+    """
+    Column-oriented buffer of converted sites. Converters write genotypes directly
+    into rows of a preallocated int8 block and record positions, alleles and the
+    ID/REF metadata columns alongside, so no per-site objects are created while
+    converting. Full batches are added to the SampleData file by
+    append_site_batch.
+    """
+
+    def __init__(self, num_samples, max_size=SITE_BATCH_SIZE, max_alleles=2):
+        self.max_size = max_size
+        self.position = np.zeros(max_size, dtype=np.float64)
+        self.genotypes = np.zeros((max_size, num_samples), dtype=np.int8)
+        # Unused allele slots are None, e.g. at sites with only the ancestral allele.
+        self.alleles = np.full((max_size, max_alleles), None, dtype=object)
+        self.ids = np.full(max_size, None, dtype=object)
+        self.refs = np.full(max_size, None, dtype=object)
+        self.size = 0
+
+    @property
+    def full(self):
+        return self.size == self.max_size
+
+    def next_genotypes(self):
+        """
+        Returns the genotype row for the next site. The row is only kept if
+        commit is called; otherwise it is overwritten by the next site.
+        """
+        row = self.genotypes[self.size]
+        row[:] = 0
+        return row
+
+    def commit(self, position, alleles, site_id, ref):
+        """
+        Keeps the current genotype row as a site with the specified list of
+        alleles, the ancestral state first.
+        """
+        j = self.size
+        self.position[j] = position
+        self.alleles[j] = None
+        self.alleles[j, : len(alleles)] = alleles
+        self.ids[j] = site_id
+        self.refs[j] = ref
+        self.size += 1
+
+    def clear(self):
+        self.size = 0
+
+    def columns(self):
+        """
+        Returns the batch as a dictionary of the position, genotypes, alleles and
+        metadata columns, in the form taken by the arguments of add_site.
+        """
+        n = self.size
+        num_alleles = np.sum(self.alleles[:n] != None, axis=1)  # noqa: E711
+        alleles = np.empty(n, dtype=object)
+        metadata = np.empty(n, dtype=object)
+        for j in range(n):
+            alleles[j] = list(self.alleles[j, : num_alleles[j]])
+            metadata[j] = {"ID": self.ids[j], "REF": self.refs[j]}
+        return {
+            "position": self.position[:n],
+            "genotypes": self.genotypes[:n],
+            "alleles": alleles,
+            "metadata": metadata,
+        }
+
+
+def append_site_batch(samples, batch):
+    """
+    Adds all sites in the batch to the samples with the public add_site, which
+    checks each site and sets the remaining site columns (inference, time) to
+    its defaults, and clears the batch.
+    """
+    if batch.size == 0:
+        return
+    columns = batch.columns()
+    position = columns["position"]
+    genotypes = columns["genotypes"]
+    alleles = columns["alleles"]
+    metadata = columns["metadata"]
+    add_site = samples.add_site
+    for j in range(batch.size):
+        add_site(
+            position=position[j],
+            genotypes=genotypes[j],
+            alleles=alleles[j],
+            metadata=metadata[j],
+        )
+    batch.clear()
+
+
+# Named combinations of the SampleData write options benchmarked by --autotune.
+SAMPLEDATA_PROFILES = {
+    "default": {
+        "chunk_size": 1024,
+        "compressor": "zstd",
+        "compression_level": None,
+        "num_flush_threads": 1,
+    },
+    "threaded": {
+        "chunk_size": 1024,
+        "compressor": "zstd",
+        "compression_level": None,
+        "num_flush_threads": min(8, os.cpu_count()),
+    },
+    "large-chunks": {
+        "chunk_size": 4096,
+        "compressor": "zstd",
+        "compression_level": None,
+        "num_flush_threads": min(8, os.cpu_count()),
+    },
+    "blosc-lz4": {
+        "chunk_size": 1024,
+        "compressor": "blosc-lz4",
+        "compression_level": 5,
+        "num_flush_threads": min(8, os.cpu_count()),
+    },
+    "zstd-high": {
+        "chunk_size": 4096,
+        "compressor": "zstd",
+        "compression_level": 9,
+        "num_flush_threads": min(8, os.cpu_count()),
+    },
+}
+
+
+def make_compressor(name, level=None):
+    """
+    Returns the numcodecs compressor with the specified name for SampleData arrays,
+    using the codec's default level if level is None.
+    """
+    if name == "none":
+        return None
+    if name == "zstd":
+        return numcodecs.Zstd() if level is None else numcodecs.Zstd(level=level)
+    if name == "zlib":
+        return numcodecs.Zlib() if level is None else numcodecs.Zlib(level=level)
+    if name.startswith("blosc-"):
+        # Bit shuffling packs the 0/1 genotypes of neighbouring samples together.
+        kwargs = {"cname": name[len("blosc-"):], "shuffle": numcodecs.Blosc.BITSHUFFLE}
+        if level is not None:
+            kwargs["clevel"] = level
+        return numcodecs.Blosc(**kwargs)
+    raise ValueError("Unknown compressor: {}".format(name))
+
+
+def sampledata_options(args):
+    """
+    Returns the keyword arguments for tsinfer.SampleData given by the command line
+    write options.
+    """
+    return {
+        "chunk_size": args.chunk_size,
+        "compressor": make_compressor(args.compressor, args.compression_level),
+        "num_flush_threads": args.num_flush_threads,
+    }
+
+
+def autotune(args):
+    """
+    Converts the input with each of the SAMPLEDATA_PROFILES and prints the time
+    taken, the file size and the time to read the genotypes of a random 1% of
+    sites from the result, followed by the options of the fastest profile. The
+    input should be restricted with --region or --max-variants.
+    """
+    rng = np.random.default_rng(42)
+    results = {}
+    for name, profile in SAMPLEDATA_PROFILES.items():
+        profile_args = copy.copy(args)
+        for key, value in profile.items():
+            setattr(profile_args, key, value)
+        profile_args.output_file = "{}.{}".format(args.output_file, name)
+        before = time.perf_counter()
+        report = make_sampledata(profile_args)
+        write_time = time.perf_counter() - before
+        if report["num_sites"] == 0:
+            raise ValueError("No sites were converted")
+        size = os.path.getsize(profile_args.output_file)
+        samples = tsinfer.load(profile_args.output_file)
+        sites = np.sort(
+            rng.choice(
+                samples.num_sites, max(1, samples.num_sites // 100), replace=False
+            )
+        )
+        before = time.perf_counter()
+        samples.sites_genotypes.get_orthogonal_selection((sites, slice(None)))
+        read_time = time.perf_counter() - before
+        samples.close()
+        for path in [profile_args.output_file, profile_args.output_file + "-lock"]:
+            if os.path.exists(path):
+                os.unlink(path)
+        results[name] = write_time
+        print(
+            "{}: write {:.2f}s, size {:.1f} MiB, subset read {:.3f}s".format(
+                name, write_time, size / 2 ** 20, read_time
+            )
+        )
+    fastest = min(results, key=results.get)
+    profile = SAMPLEDATA_PROFILES[fastest]
+    options = "--chunk-size={} --compressor={} --num-flush-threads={}".format(
+        profile["chunk_size"], profile["compressor"], profile["num_flush_threads"]
+    )
+    if profile["compression_level"] is not None:
+        options += " --compression-level={}".format(profile["compression_level"])
+    print("Fastest profile: {} ({})".format(fastest, options))
+
+
+def get_output_intervals(positions, num_chunks):
+    """
+    Returns a list of [start, end) intervals of output positions that together
+    cover all positions, splitting the sorted positions into num_chunks chunks of
+    about the same number of sites.
+    """
+    breaks = []
+    if len(positions) > 0:
+        index = np.arange(1, num_chunks) * len(positions) // num_chunks
+        breaks = np.unique(positions[index])
+    bounds = [0] + [int(position) for position in breaks] + [math.inf]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def combine_reports(master_report, report):
+    """
+    Adds the counts in the report of a chunk to master_report. The reports of
+    merged conversions hold the report of each input under its data file.
+    """
+    for var_type, val in report.items():
+        if isinstance(val, dict):
+            combine_reports(master_report[var_type], val)
+        # Counts of individuals are the same in every chunk.
+        elif var_type not in INDIVIDUAL_REPORT_KEYS:
+            master_report[var_type] += val
 
 
 def run_multiprocessing(args, function):
     """
-    Run multiprocessing of sampledata files.
-    We use multiple threads by splitting the VCF file into chunks and using the
-    vcf_subset function of cyvcf2.
+    Converts the input in args.num_threads chunks in parallel by calling function
+    on each chunk, and joins the chunks into the output file. The chunks are
+    intervals of output positions holding about the same number of the input's
+    records, so lifted inputs are split on their positions in the new assembly.
+    Each chunk job reads its input and converts only the sites in its interval.
+    For --merge-with, the intervals are balanced over the records of all the
+    merged inputs and each chunk job merges the sites of every input in its
+    interval, so the inputs are converted in parallel as well.
     """
-    vcf_fn = args.data_file
     num_processes = args.num_threads
-    if num_processes > 1:
-        # Split the VCF into chunks
-        callset = allel.read_vcf(vcf_fn, fields=["variants/CHROM", "variants/POS"])
-        pos_list = callset["variants/POS"]
-        chroms = callset["variants/CHROM"]
-        assert np.all(chroms == chroms[0])
-        chrom = str(chroms[0])
-
-        def get_chromosome_chunks(lst, num_processes):
-            length = len(lst)
-            n = math.ceil(length / num_processes)
-            chunks = list()
-            for index, i in enumerate(range(0, length, n)):
-                if index != num_processes - 1:
-                    chunks.append(
-                        (
-                            args,
-                            args.output_file + str(index),
-                            (chrom + ":" + str(lst[i]) + "-" + str(lst[i + n])),
-                        )
-                    )
-                else:
-                    chunks.append(
-                        (
-                            args,
-                            args.output_file + str(index),
-                            (chrom + ":" + str(lst[i]) + "-" + str(lst[-1])),
-                        )
-                    )
-            return chunks
-
-        chunks = get_chromosome_chunks(pos_list, num_processes)
-        chunks_iter = iter(chunks)
-        reports = list()
-        completed_files = list()
-        with multiprocessing.Pool(processes=num_processes, maxtasksperchild=10) as pool:
-            for index, row in enumerate(pool.map(function, chunks_iter)):
-                reports.append(row)
-                print(
-                    "Processed Chunk {}: {} with {} sites added.".format(
-                        index, chunks[index][2], row["num_sites"]
-                    )
+    liftovers = {}
+    converters = []
+    for source, data_file, metadata_file, liftover_chain in merge_inputs(args):
+        if liftover_chain is not None and liftover_chain not in liftovers:
+            liftovers[liftover_chain] = Liftover(liftover_chain)
+        converter = CONVERTER_CLASSES[source](
+            data_file,
+            None,
+            None,
+            liftover=liftovers.get(liftover_chain),
+            sample_subset=args.sample_subset,
+            metadata_cache_dir=args.metadata_cache_dir,
+        )
+        converters.append((converter, metadata_file))
+    positions = np.sort(
+        np.concatenate(
+            [converter.output_positions(args.region) for converter, _ in converters]
+        )
+    )
+    intervals = get_output_intervals(positions, num_processes)
+
+    # Read the VCF header and parse the metadata files once here, so that the
+    # chunk workers reuse them instead of each reading the files again.
+    if args.merge_with is None and args.source != "1240k-packed":
+        args.individual_names = read_vcf_samples(args.data_file, args.sample_subset)
+    for converter, metadata_file in converters:
+        converter.prepare_chunks()
+        if metadata_file:
+            try:
+                load_cached_metadata(converter, metadata_file)
+            except NotImplementedError:
+                pass
+
+    chunks = [
+        (args, args.output_file + str(index), args.region, interval)
+        for index, interval in enumerate(intervals)
+    ]
+    reports = list()
+    completed_files = list()
+    with multiprocessing.Pool(processes=num_processes, maxtasksperchild=10) as pool:
+        for index, row in enumerate(pool.map(function, chunks)):
+            reports.append(row)
+            print(
+                "Processed Chunk {}: positions [{}, {}) with {} sites added.".format(
+                    index, *chunks[index][3], row["num_sites"]
                 )
-                if row["num_sites"] > 0:
-                    completed_files.append(index)
-                else:
-                    os.remove(args.output_file + str(index) + "-lock")
-
-        # Combine reports and print
-        master_report = reports[0]
-        for report in reports[1:]:
-            for var_type, val in report.items():
-                master_report[var_type] += val
-        print(master_report)
-
-        # Combine sampledata files
-        filenames = completed_files
-        all_samples = []
-        for name in filenames:
-            all_samples.append(tsinfer.load(args.output_file + str(name)))
-            os.remove(args.output_file + str(name))
-
-        samples = all_samples[0].copy(args.output_file)
-        samples.append_sites(*all_samples[1:])
-        samples.finalise()
-        assert np.all(np.diff(samples.sites_position[:]) > 0)
+            )
+            if row["num_sites"] > 0:
+                completed_files.append(index)
+            else:
+                os.remove(args.output_file + str(index) + "-lock")
 
-    else:
-        raise ValueError
+    # Combine reports and print
+    master_report = reports[0]
+    for report in reports[1:]:
+        combine_reports(master_report, report)
+    print(master_report)
 
+    # Combine sampledata files
+    filenames = completed_files
+    all_samples = []
+    for name in filenames:
+        all_samples.append(tsinfer.load(args.output_file + str(name)))
+        os.remove(args.output_file + str(name))
 
-def make_sampledata(args):
-    if isinstance(args, tuple):
-        vcf_subset = args[2]
-        args[0].output_file = str(args[1])
-        args = args[0]
-    else:
-        vcf_subset = None
+    samples = all_samples[0].copy(args.output_file)
+    samples.append_sites(*all_samples[1:])
+    samples.finalise()
+    assert np.all(np.diff(samples.sites_position[:]) > 0)
+
+
+def get_provenance(args):
+    """
+    Returns the (git, data) provenance dictionaries for the output.
+    """
     try:
         git_hash = subprocess.check_output(["git", "rev-parse", "HEAD"])
         git_provenance = {
@@ -127,40 +367,71 @@ def make_sampledata(args):
                 "Use the Makefile to download and process the upstream data files"),
         }
     except FileNotFoundError:
-        git_hash = "Git unavailable"
         git_provenance = "Git unavailable"
     data_provenance = {
         "ancestral_states_url": args.ancestral_states_url,
         "reference_name": args.reference_name,
     }
+    return git_provenance, data_provenance
+
 
-    # Get the ancestral states.
-    fasta = pysam.FastaFile(args.ancestral_states_file)
+def read_ancestral_states(ancestral_states_file):
+    """
+    Returns the ancestral states sequence, indexed by 1-based position, and the
+    sequence length.
+    """
+    fasta = pysam.FastaFile(ancestral_states_file)
     # NB! We put in an extra character at the start to convert to 1 based coords.
     ancestral_states = "X" + fasta.fetch(reference=fasta.references[0])
     # The largest possible site position is len(ancestral_states). Positions must
     # be strictly less than sequence_length, so we add 1.
     sequence_length = len(ancestral_states) + 1
+    return ancestral_states, sequence_length
 
-    converter_class = {
-        "1kg": ThousandGenomesConverter,
-        "sgdp": SgdpConverter,
-        "hgdp": HgdpConverter,
-        "max-planck": MaxPlanckConverter,
-        "afanasievo": AfanasievoConverter,
-        "1240k": ReichConverter,
-    }
+
+def unpack_job(job):
+    """
+    Returns a tuple (args, vcf_subset, output_interval) for a conversion job,
+    which is either the parsed arguments or a chunk from run_multiprocessing.
+    """
+    if isinstance(job, tuple):
+        args, output_file, vcf_subset, output_interval = job
+        args.output_file = str(output_file)
+        return args, vcf_subset, output_interval
+    return job, job.region, None
+
+
+def make_sampledata(args):
+    args, vcf_subset, output_interval = unpack_job(args)
+    git_provenance, data_provenance = get_provenance(args)
+    ancestral_states, sequence_length = read_ancestral_states(
+        args.ancestral_states_file
+    )
+
+    liftover = None
+    if args.liftover_chain is not None:
+        liftover = Liftover(args.liftover_chain)
+    report = None
     try:
         with tsinfer.SampleData(
-            path=args.output_file, num_flush_threads=1, sequence_length=sequence_length
+            path=args.output_file,
+            sequence_length=sequence_length,
+            **sampledata_options(args)
         ) as samples:
-            converter = converter_class[args.source](
-                args.data_file, ancestral_states, samples, args.target_samples
+            converter = CONVERTER_CLASSES[args.source](
+                args.data_file,
+                ancestral_states,
+                samples,
+                args.target_samples,
+                individual_names=getattr(args, "individual_names", None),
+                gt_only=args.gt_only,
+                decompression_threads=args.decompression_threads,
+                liftover=liftover,
+                sample_subset=args.sample_subset,
+                metadata_cache_dir=args.metadata_cache_dir,
+                output_interval=output_interval,
             )
-            if args.metadata_file:
-                converter.process_metadata(args.metadata_file, args.progress)
-            else:
-                converter.process_metadata(args.progress)
+            converter.process_metadata(args.metadata_file, args.progress)
             if vcf_subset is not None:
                 report = converter.process_sites(
                     vcf_subset=vcf_subset,
@@ -180,7 +451,9 @@ def make_sampledata(args):
             assert np.all(np.diff(samples.sites_position[:]) > 0)
     except Exception as e:
         os.unlink(args.output_file)
-        if report["num_sites"] == 0:
+        # tsinfer refuses to finalise a file without sites, which is expected
+        # for chunks whose interval holds no convertible sites.
+        if report is not None and report["num_sites"] == 0:
             return report
         raise e
     if report["num_sites"] == 0:
@@ -188,6 +461,355 @@ def make_sampledata(args):
     return report
 
 
+def merge_inputs(args):
+    """
+    Returns the list of (source, data_file, metadata_file, liftover_chain) tuples
+    for the inputs to merge: the main input followed by each --merge-with input,
+    if any.
+    """
+    inputs = [(args.source, args.data_file, args.metadata_file, args.liftover_chain)]
+    for values in args.merge_with or []:
+        if len(values) < 2 or len(values) > 4 or values[0] not in CONVERTER_CLASSES:
+            raise ValueError(
+                "Bad --merge-with input {}: expected SOURCE DATA_FILE "
+                "[METADATA_FILE [LIFTOVER_CHAIN]]".format(" ".join(values))
+            )
+        values = values + [None] * (4 - len(values))
+        if values[2] == "-":
+            values[2] = None
+        inputs.append(tuple(values))
+    return inputs
+
+
+def merge_sites(
+    samples,
+    converters,
+    vcf_subset=None,
+    mode="intersection",
+    show_progress=False,
+    max_sites=None,
+):
+    """
+    Converts the sites of each converter's input and adds them to the samples in
+    a single k-way join on position, with the genotypes of each converter's
+    samples side by side in the order of converters. mode decides which sites are
+    added: "intersection" keeps the sites kept by every converter, "union" the
+    sites kept by any of them and "first" the sites kept by the first. Samples
+    of a converter that does not keep an added site have missing data there. The
+    ID and REF metadata come from the first converter that keeps the site.
+    Returns the number of sites added.
+    """
+    offsets = np.cumsum([0] + [converter.num_samples for converter in converters])
+    batch = SiteBatch(offsets[-1], max_alleles=len(converters) + 1)
+    rows = [np.zeros(converter.num_samples, dtype=np.int8) for converter in converters]
+    all_records = []
+    generators = []
+    for converter, row in zip(converters, rows):
+        records, num_records = converter.open_records(vcf_subset)
+        converter.num_sites = 0
+        progress = tqdm.tqdm(
+            total=num_records,
+            desc=type(converter).__name__,
+            disable=not show_progress,
+        )
+        all_records.append(records)
+        generators.append(
+            converter.convert_sites(records, lambda row=row: row, progress)
+        )
+    heads = [next(generator, None) for generator in generators]
+    num_sites = 0
+    while num_sites != max_sites:
+        if mode == "intersection" and any(head is None for head in heads):
+            break
+        if mode == "first" and heads[0] is None:
+            break
+        if all(head is None for head in heads):
+            break
+        position = min(head[0] for head in heads if head is not None)
+        present = [head is not None and head[0] == position for head in heads]
+        if mode == "union" or (mode == "first" and present[0]) or all(present):
+            genotypes = batch.next_genotypes()
+            alleles = None
+            for j, head in enumerate(heads):
+                a = genotypes[offsets[j]: offsets[j + 1]]
+                if not present[j]:
+                    a[:] = tskit.MISSING_DATA
+                    continue
+                _, source_alleles, site_id, ref = head
+                if alleles is None:
+                    alleles = list(source_alleles)
+                    metadata = site_id, ref
+                # All converters use the same ancestral states.
+                assert source_alleles[0] == alleles[0]
+                a[:] = rows[j]
+                if len(source_alleles) > 1:
+                    if source_alleles[1] not in alleles:
+                        alleles.append(source_alleles[1])
+                    a[rows[j] == 1] = alleles.index(source_alleles[1])
+            batch.commit(position, alleles, *metadata)
+            if batch.full:
+                append_site_batch(samples, batch)
+            num_sites += 1
+        for j in range(len(heads)):
+            if present[j]:
+                heads[j] = next(generators[j], None)
+    for generator, records in zip(generators, all_records):
+        generator.close()
+        records.close()
+    append_site_batch(samples, batch)
+    return num_sites
+
+
+def make_merged_sampledata(args):
+    """
+    Converts the main input and each --merge-with input into a single SampleData
+    file, with the populations and individuals of each input in turn and the
+    sites joined by merge_sites.
+    """
+    args, vcf_subset, output_interval = unpack_job(args)
+    git_provenance, data_provenance = get_provenance(args)
+    ancestral_states, sequence_length = read_ancestral_states(
+        args.ancestral_states_file
+    )
+    liftovers = {}
+    report = None
+    try:
+        with tsinfer.SampleData(
+            path=args.output_file,
+            sequence_length=sequence_length,
+            **sampledata_options(args)
+        ) as samples:
+            converters = []
+            for source, data_file, metadata_file, liftover_chain in merge_inputs(args):
+                if liftover_chain is not None and liftover_chain not in liftovers:
+                    liftovers[liftover_chain] = Liftover(liftover_chain)
+                converter = CONVERTER_CLASSES[source](
+                    data_file,
+                    ancestral_states,
+                    samples,
+                    args.target_samples,
+                    gt_only=args.gt_only,
+                    decompression_threads=args.decompression_threads,
+                    liftover=liftovers.get(liftover_chain),
+                    metadata_cache_dir=args.metadata_cache_dir,
+                    output_interval=output_interval,
+                )
+                converter.add_populations(metadata_file)
+                converters.append((converter, metadata_file))
+            for converter, metadata_file in converters:
+                converter.add_individuals(metadata_file)
+            converters = [converter for converter, _ in converters]
+            num_sites = merge_sites(
+                samples,
+                converters,
+                vcf_subset=vcf_subset,
+                mode=args.merge_sites,
+                show_progress=args.progress,
+                max_sites=args.max_variants,
+            )
+            report = {"num_sites": num_sites}
+            for converter in converters:
+                report[converter.data_file] = converter.report()
+            samples.record_provenance(
+                command=sys.argv[0],
+                args=sys.argv[1:],
+                git=git_provenance,
+                data=data_provenance,
+            )
+            assert np.all(np.diff(samples.sites_position[:]) > 0)
+    except Exception as e:
+        os.unlink(args.output_file)
+        # As in make_sampledata, chunks without sites cannot be finalised.
+        if report is not None and report["num_sites"] == 0:
+            return report
+        raise e
+    return report
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    Returns the SHA-256 hex digest of the contents of the specified file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_cached_metadata(converter, metadata_file):
+    """
+    Returns the (populations, individuals) table produced by the converter's
+    parse_metadata for this file. The parsed table is pickled in the converter's
+    metadata_cache_dir under a name keyed by the converter and the hash of the
+    file contents, so chunk workers and the jobs for other chromosomes reuse it
+    rather than parsing the file again. A changed metadata file gets a new cache
+    entry. If there is no cache directory or it cannot be written, the file is
+    parsed without caching.
+    """
+    if converter.metadata_cache_dir is None:
+        return converter.parse_metadata(metadata_file)
+    cache_file = os.path.join(
+        converter.metadata_cache_dir,
+        "{}.{}.{}.metadata.p".format(
+            os.path.basename(metadata_file),
+            type(converter).__name__,
+            file_hash(metadata_file)[:16],
+        ),
+    )
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    table = converter.parse_metadata(metadata_file)
+    # Write to a temporary file and rename so that concurrent jobs never see a
+    # partially written cache.
+    tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    try:
+        with open(tmp_file, "wb") as f:
+            pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print("Not caching metadata in {}: {}".format(cache_file, e), file=sys.stderr)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return table
+
+
+def read_sample_subset(args):
+    """
+    Returns the list of sample names given by --samples or --samples-file, or
+    None if neither is given.
+    """
+    if args.samples is not None:
+        return args.samples.split(",")
+    if args.samples_file is not None:
+        with open(args.samples_file, "r") as f:
+            return [line.strip() for line in f if line.strip()]
+    return None
+
+
+def subset_samples(names, sample_subset):
+    """
+    Returns the indexes of the names in sample_subset, in the order of names.
+    """
+    missing = set(sample_subset) - set(names)
+    if len(missing) > 0:
+        raise ValueError("Samples not in the input: {}".format(sorted(missing)))
+    sample_subset = set(sample_subset)
+    return [j for j, name in enumerate(names) if name in sample_subset]
+
+
+def read_vcf_samples(data_file, sample_subset=None):
+    """
+    Returns the list of sample names in the header of the specified VCF,
+    restricted to those in sample_subset if it is not None.
+    """
+    vcf = cyvcf2.VCF(data_file)
+    individual_names = list(vcf.samples)
+    vcf.close()
+    if sample_subset is not None:
+        individual_names = [
+            individual_names[j] for j in subset_samples(individual_names, sample_subset)
+        ]
+    return individual_names
+
+
+def open_vcf(data_file, vcf_subset=None, gt_only=False, threads=0, samples=None):
+    """
+    Opens the VCF/BCF for reading, restricted to the vcf_subset region if given,
+    using ``threads`` extra threads for BGZF decompression. If samples is a list
+    of names, htslib only unpacks the FORMAT fields of these samples. If gt_only
+    is True, records are streamed through ``bcftools annotate``, which drops INFO
+    and all FORMAT fields other than GT and writes uncompressed BCF to a pipe.
+    bcftools still parses every field, so this does not reduce the total work:
+    it moves the decompression and field stripping to a second process running
+    alongside this one, which only decodes CHROM/POS/ID/REF/ALT and GT. Returns the
+    cyvcf2.VCF and the bcftools process (None if not gt_only), to be passed to
+    close_vcf.
+    """
+    if not gt_only:
+        vcf = cyvcf2.VCF(
+            data_file, threads=threads if threads > 0 else None, samples=samples
+        )
+        if vcf_subset is not None:
+            vcf = vcf(vcf_subset)
+        return vcf, None
+    command = ["bcftools", "annotate", "-x", "INFO,^FORMAT/GT", "-Ou"]
+    if threads > 0:
+        command += ["--threads", str(threads)]
+    if vcf_subset is not None:
+        command += ["-r", vcf_subset]
+    command.append(data_file)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    vcf = cyvcf2.VCF(process.stdout.fileno(), lazy=True, samples=samples)
+    return vcf, process
+
+
+def close_vcf(vcf, process, complete=True):
+    """
+    Closes a VCF returned by open_vcf. If the records were read to the end
+    (complete is True), waits for the bcftools process and raises a RuntimeError
+    if it failed, since its output would then have been truncated. Otherwise the
+    reader stopped early (e.g. max_sites), so bcftools is terminated rather than
+    left blocked on a full pipe.
+    """
+    vcf.close()
+    if process is None:
+        return
+    process.stdout.close()
+    if not complete:
+        process.terminate()
+        process.wait()
+    elif process.wait() != 0:
+        raise RuntimeError(
+            "{} failed with exit status {}".format(
+                " ".join(process.args), process.returncode
+            )
+        )
+
+
+def interval_region(data_file, interval):
+    """
+    Returns the region string for the [start, end) interval of positions on the
+    chromosome of the first record in the VCF/BCF, or None if it has no records.
+    """
+    vcf = cyvcf2.VCF(data_file)
+    row = next(vcf, None)
+    chromosome = None if row is None else row.CHROM
+    vcf.close()
+    if chromosome is None:
+        return None
+    start, end = interval
+    region = "{}:{}-".format(chromosome, max(1, start))
+    if end != math.inf:
+        region += str(end - 1)
+    return region
+
+
+def read_positions(data_file, vcf_subset=None):
+    """
+    Returns the chromosome and the array of positions of all records in the
+    VCF/BCF (restricted to the vcf_subset region if given), which must all be on
+    a single chromosome.
+    """
+    command = ["bcftools", "query", "-f", "%CHROM\t%POS\n"]
+    if vcf_subset is not None:
+        command += ["-r", vcf_subset]
+    fields = subprocess.check_output(command + [data_file]).split()
+    chroms = set(fields[0::2])
+    assert len(chroms) <= 1
+    chrom = chroms.pop().decode() if len(chroms) == 1 else None
+    return chrom, np.array(fields[1::2], dtype=np.int64)
+
+
+def unique_mask(values):
+    """
+    Returns a boolean mask of the entries of values that occur exactly once.
+    """
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    return counts[inverse] == 1
+
+
 def filter_duplicates_target(vcf, target_sites_pos=None):
     """
     Returns the variants from this VCF with duplicate sites filtered
@@ -217,17 +839,82 @@ def filter_duplicates_target(vcf, target_sites_pos=None):
             elif bad_pos != next_row.POS:
                 bad_pos = -1
         row = next_row
-    if row is not None and bad_pos != -1 and site_in_target(row.POS):
+    if row is not None and bad_pos == -1 and site_in_target(row.POS):
         yield row
 
 
+# The 2-bit code for a missing call in PACKEDANCESTRYMAP genotype records.
+PACKED_MISSING = 3
+
+# A site read from EIGENSTRAT files. REF and ALT are the first and second alleles in
+# the .snp file and calls holds the number of copies of REF carried by each
+# individual, or PACKED_MISSING.
+EigenstratRecord = collections.namedtuple(
+    "EigenstratRecord", ["ID", "REF", "ALT", "calls"]
+)
+
+
+def read_packed_geno_header(geno_file):
+    """
+    Returns the tuple (num_individuals, num_snps, record_length) from the header
+    of a PACKEDANCESTRYMAP .geno file.
+    """
+    with open(geno_file, "rb") as f:
+        header = f.read(48).split(b"\0")[0].split()
+    if len(header) < 3 or header[0] != b"GENO":
+        raise ValueError("{} is not a PACKEDANCESTRYMAP file".format(geno_file))
+    num_individuals = int(header[1])
+    num_snps = int(header[2])
+    # Each record holds 2 bits per individual, and is at least 48 bytes long.
+    record_length = max(48, (num_individuals + 3) // 4)
+    return num_individuals, num_snps, record_length
+
+
+def unpack_genotypes(records, num_individuals):
+    """
+    Unpacks the rows of PACKEDANCESTRYMAP genotype records into an array of calls
+    with one column per individual. The first individual is in the top two bits
+    of the first byte of each record.
+    """
+    shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+    calls = (records[:, :, np.newaxis] >> shifts) & 3
+    return calls.reshape(len(records), -1)[:, :num_individuals]
+
+
 class Converter(object):
     """
     Superclass of converters.
     """
 
-    def __init__(self, data_file, ancestral_states, samples, target_samples=None):
+    def __init__(
+        self,
+        data_file,
+        ancestral_states,
+        samples,
+        target_samples=None,
+        individual_names=None,
+        gt_only=False,
+        decompression_threads=0,
+        liftover=None,
+        sample_subset=None,
+        metadata_cache_dir=None,
+        output_interval=None,
+    ):
         self.data_file = data_file
+        # The [start, end) interval of output positions to convert, or None for
+        # all positions.
+        self.output_interval = output_interval
+        # Where parsed metadata is cached, or None to parse it every time.
+        self.metadata_cache_dir = metadata_cache_dir
+        # The names of the samples to convert, or None for all samples.
+        self.sample_subset = sample_subset
+        # A liftover.Liftover, if the input is in another assembly to the
+        # ancestral states.
+        self.liftover = liftover
+        self.gt_only = gt_only
+        self.decompression_threads = decompression_threads
+        # The VCF sample names, if the header has already been read by the caller.
+        self.individual_names = individual_names
         self.ancestral_states = ancestral_states
         self.samples = samples
         if target_samples is not None:
@@ -265,8 +952,87 @@ class Converter(object):
         report_dict["num_(n - 1)_tons"] = self.num_nmo_tons
         return report_dict
 
-    def process_metadata(self, metadata_file):
-        pass
+    def get_individual_names(self):
+        if self.individual_names is None:
+            self.individual_names = read_vcf_samples(self.data_file, self.sample_subset)
+        return self.individual_names
+
+    def in_output_interval(self, position):
+        """
+        Returns a boolean mask of the output positions in the output interval.
+        """
+        if self.output_interval is None:
+            return np.ones(len(position), dtype=bool)
+        start, end = self.output_interval
+        return (position >= start) & (position < end)
+
+    def output_positions(self, vcf_subset=None):
+        """
+        Returns the sorted output positions of the records in the input, which
+        run_multiprocessing splits into chunks.
+        """
+        raise NotImplementedError()
+
+    def prepare_chunks(self):
+        """
+        Does any work that the jobs for all chunks of the input would otherwise
+        each repeat, before they start.
+        """
+
+    def parse_metadata(self, metadata_file):
+        """
+        Parses the metadata file and returns a tuple (populations, individuals),
+        where populations is the list of population metadata dicts in the order
+        they are added, and individuals maps each individual name to the keyword
+        arguments for samples.add_individual (excluding ploidy).
+        """
+        raise NotImplementedError()
+
+    def process_metadata(self, metadata_file, show_progress=False):
+        """
+        Adds the populations and then the individuals for the input.
+        """
+        self.add_populations(metadata_file)
+        self.add_individuals(metadata_file)
+
+    def add_populations(self, metadata_file):
+        """
+        Adds the populations from the (cached) parsed metadata. Populations must
+        all be added before any individuals, so when several inputs are merged
+        this is called for each of them before add_individuals.
+        """
+        populations, individuals = load_cached_metadata(self, metadata_file)
+        individual_names = self.get_individual_names()
+        if self.sample_subset is not None:
+            # Only add the populations of the selected individuals.
+            used = sorted({individuals[name]["population"] for name in individual_names})
+            population_id_map = {j: k for k, j in enumerate(used)}
+            populations = [populations[j] for j in used]
+            individuals = {
+                name: dict(
+                    individuals[name],
+                    population=population_id_map[individuals[name]["population"]],
+                )
+                for name in individual_names
+            }
+        # Other inputs may already have added populations to the samples.
+        population_ids = [
+            self.samples.add_population(population) for population in populations
+        ]
+        self.individuals_metadata = {}
+        for name in individual_names:
+            kwargs = dict(individuals[name])
+            kwargs["population"] = population_ids[kwargs["population"]]
+            self.individuals_metadata[name] = kwargs
+
+    def add_individuals(self, metadata_file):
+        """
+        Adds the individuals in the order of the VCF.
+        """
+        individual_names = self.get_individual_names()
+        self.num_samples = 2 * len(individual_names)
+        for name in individual_names:
+            self.samples.add_individual(ploidy=2, **self.individuals_metadata[name])
 
     def get_ancestral_state(self, position):
         # From the ancestral states README:
@@ -292,22 +1058,19 @@ class Converter(object):
 
 
 class VcfConverter(Converter):
-    def convert_genotypes(self, row, ancestral_state):
-        def return_genotype(allele, ancestral_state):
-            if allele == ".":
-                return tskit.MISSING_DATA
-            else:
-                return allele != ancestral_state
-
-        ret = None
-        num_diploids = self.num_samples // 2
-        a = np.zeros(self.num_samples, dtype=np.int8)
-        # Use upper case version of ancestral state (keep original
-        # for checking low-confidence ancestral state)
+    def fill_genotypes(self, row, ancestral_state, a):
+        """
+        Fills the genotype row ``a`` for this VCF record with 1 where a sample
+        carries an allele other than the ancestral state, 0 where it carries the
+        ancestral state and tskit.MISSING_DATA where the call is missing. Returns
+        the set of alleles seen (including the ancestral state), or None if the
+        record has calls that are not diploid.
+        """
+        if self.gt_only:
+            return self.fill_genotypes_gt(row, ancestral_state, a)
         all_alleles = set([ancestral_state])
-        # Fill in a with genotypes.
         bases = np.array(row.gt_bases)
-        for j in range(num_diploids):
+        for j in range(self.num_samples // 2):
             missing = False
             if "|" in bases[j]:
                 alleles = bases[j].split("|")
@@ -315,7 +1078,7 @@ class VcfConverter(Converter):
                 self.num_unphased += 1
                 alleles = bases[j].split("/")
             if len(alleles) != 2:
-                break
+                return None
             for allele in alleles:
                 if allele == ".":
                     self.num_missing_data += 1
@@ -330,7 +1093,37 @@ class VcfConverter(Converter):
                     a[2 * j] = tskit.MISSING_DATA
                 if alleles[1] == ".":
                     a[2 * j + 1] = tskit.MISSING_DATA
-        else:
+        return all_alleles
+
+    def fill_genotypes_gt(self, row, ancestral_state, a):
+        """
+        Version of fill_genotypes that works on the decoded GT array directly
+        rather than building per-sample allele strings.
+        """
+        gt = row.genotype.array()
+        # Haploid calls are padded with vector-end values, which are < MISSING_DATA.
+        if gt.shape[1] != 3 or np.any(gt[:, :2] < tskit.MISSING_DATA):
+            return None
+        calls = gt[:, :2].reshape(-1)
+        missing = calls == tskit.MISSING_DATA
+        # gt_bases writes calls whose first allele is missing as unphased, so
+        # count those as unphased too to keep the reports identical.
+        unphased = (gt[:, 2] == 0) | (gt[:, 0] == tskit.MISSING_DATA)
+        self.num_unphased += int(np.sum(unphased))
+        self.num_missing_data += int(np.sum(missing))
+        alleles = np.array([row.REF] + row.ALT)
+        a[:] = alleles[calls] != ancestral_state
+        a[missing] = tskit.MISSING_DATA
+        return set(alleles[np.unique(calls[~missing])]) | {ancestral_state}
+
+    def convert_genotypes(self, row, ancestral_state, a):
+        """
+        Fills the genotype row ``a`` for this VCF record and returns the list of
+        alleles if the site should be kept, or None if it is filtered out.
+        """
+        ret = None
+        all_alleles = self.fill_genotypes(row, ancestral_state, a)
+        if all_alleles is not None:
             freq = np.sum(a == 1)
             if len(all_alleles) > 2:
                 self.num_non_biallelic += 1
@@ -341,53 +1134,163 @@ class VcfConverter(Converter):
             elif freq == self.num_samples - 1:
                 self.num_nmo_tons += 1
             else:
-                metadata = {"ID": row.ID, "REF": row.REF}
                 if freq == 1:
                     self.num_singletons += 1
                 all_alleles.remove(ancestral_state)
-                alleles = [ancestral_state, all_alleles.pop()]
-                ret = Site(
-                    position=row.POS, alleles=alleles, genotypes=a, metadata=metadata
-                )
+                ret = [ancestral_state, all_alleles.pop()]
         return ret
 
-    def process_sites(self, vcf_subset=None, show_progress=False, max_sites=None):
+    def records(self, data_file, vcf_subset=None):
+        """
+        Yields tuples (row, position, flipped) for the records to convert, in
+        increasing order of output position. Without liftover this is the
+        position of the record and flipped is always False.
+        """
+        if self.liftover is not None:
+            yield from self.lifted_records(data_file, vcf_subset)
+            return
+        start, end = 0, math.inf
+        if self.output_interval is not None:
+            start, end = self.output_interval
+            if vcf_subset is None:
+                # The output positions are the input positions, so only the
+                # records in the interval need to be read.
+                vcf_subset = interval_region(data_file, self.output_interval)
+        vcf, process = open_vcf(
+            data_file,
+            vcf_subset,
+            self.gt_only,
+            self.decompression_threads,
+            self.sample_subset,
+        )
+        complete = False
+        try:
+            for row in filter_duplicates_target(vcf, self.target_sites_pos):
+                # Region queries also return records overlapping the start.
+                if start <= row.POS < end:
+                    yield row, row.POS, False
+            complete = True
+        finally:
+            close_vcf(vcf, process, complete)
+
+    def keep_lifted(self, lifted):
+        """
+        Returns a boolean mask of the lifted positions to keep: sites that lifted
+        over onto a position of their own, and are in the target samples if given.
+        """
+        keep = (lifted > 0) & unique_mask(lifted)
+        if self.target_sites_pos is not None:
+            target = np.fromiter(self.target_sites_pos, dtype=np.float64)
+            keep &= np.isin(lifted, target)
+        return keep
+
+    def lifted_records(self, data_file, vcf_subset=None):
+        """
+        Version of records for inputs in another assembly. All positions are read
+        and lifted over up front; records whose lifted positions are out of order
+        (inversions relative to the source, or minus-strand chains) are then read
+        in runs that are contiguous in the source file, with one region query per
+        run, so that they can be yielded in increasing order of lifted position.
+        """
+        chromosome, source_positions = read_positions(data_file, vcf_subset)
+        # As in filter_duplicates_target, drop all records at repeated positions.
+        source_positions = source_positions[unique_mask(source_positions)]
+        lifted, flipped = self.liftover.lift(chromosome, source_positions)
+        keep = self.keep_lifted(lifted) & self.in_output_interval(lifted)
+        source_positions = source_positions[keep]
+        lifted = lifted[keep]
+        flipped = flipped[keep]
+        if len(lifted) == 0:
+            return
+        order = np.argsort(lifted)
+        breaks = np.where(np.abs(np.diff(order)) != 1)[0] + 1
+        for run in np.split(order, breaks):
+            first, last = np.min(run), np.max(run)
+            region = "{}:{}-{}".format(
+                chromosome, source_positions[first], source_positions[last]
+            )
+            vcf, process = open_vcf(
+                data_file,
+                region,
+                self.gt_only,
+                self.decompression_threads,
+                self.sample_subset,
+            )
+            run_records = []
+            j = first
+            for row in vcf:
+                while j <= last and source_positions[j] < row.POS:
+                    j += 1
+                if j <= last and source_positions[j] == row.POS:
+                    run_records.append((row, lifted[j], flipped[j]))
+            close_vcf(vcf, process)
+            if len(run) > 1 and run[0] > run[1]:
+                run_records.reverse()
+            yield from run_records
+
+    def open_records(self, vcf_subset=None):
+        """
+        Returns a tuple (records, num_records) of the records generator for the
+        input and the number of records in the input file, for progress.
+        """
         num_data_sites = int(
             subprocess.check_output(["bcftools", "index", "--nrecords", self.data_file])
         )
+        return self.records(self.data_file, vcf_subset), num_data_sites
 
-        progress = tqdm.tqdm(total=num_data_sites, disable=not show_progress)
-        self.num_sites = 0
-        if vcf_subset is None:
-            vcf = cyvcf2.VCF(self.data_file)
-        else:
-            vcf = cyvcf2.VCF(self.data_file)(vcf_subset)
-        for row in filter_duplicates_target(vcf, self.target_sites_pos):
-            ancestral_state = self.get_ancestral_state(row.POS)
+    def output_positions(self, vcf_subset=None):
+        chromosome, positions = read_positions(self.data_file, vcf_subset)
+        if self.liftover is not None:
+            positions, _ = self.liftover.lift(chromosome, positions)
+            positions = positions[positions > 0]
+        return np.sort(positions)
+
+    def process_sites(self, vcf_subset=None, show_progress=False, max_sites=None):
+        records, num_records = self.open_records(vcf_subset)
+        return self.convert_records(records, num_records, show_progress, max_sites)
+
+    def convert_sites(self, records, genotype_row, progress):
+        """
+        Converts the (row, position, flipped) tuples from the records generator
+        and yields a tuple (position, alleles, ID, REF) for each site that is
+        kept. The genotypes of the site are written to the array returned by
+        calling genotype_row(). Rows must have ID and REF attributes and are
+        passed to convert_genotypes.
+        """
+        for row, position, flipped in records:
+            ancestral_state = self.get_ancestral_state(position)
             if ancestral_state is not None:
-                site = self.convert_genotypes(row, ancestral_state)
-                if site is not None:
-                    if site.inference is not None:
-                        self.samples.add_site(
-                            position=site.position,
-                            genotypes=site.genotypes,
-                            alleles=site.alleles,
-                            metadata=site.metadata,
-                            inference=site.inference,
-                        )
-                    else:
-                        self.samples.add_site(
-                            position=site.position,
-                            genotypes=site.genotypes,
-                            alleles=site.alleles,
-                            metadata=site.metadata,
-                        )
-
-                    progress.set_postfix(used=str(self.num_sites))
+                # Compare against the ancestral state on the strand of the record.
+                if flipped:
+                    ancestral_state = reverse_complement(ancestral_state)
+                alleles = self.convert_genotypes(row, ancestral_state, genotype_row())
+                if alleles is not None:
+                    ref = row.REF
+                    if flipped:
+                        alleles = [reverse_complement(allele) for allele in alleles]
+                        ref = reverse_complement(ref)
                     self.num_sites += 1
-                    if self.num_sites == max_sites:
-                        break
+                    yield position, alleles, row.ID, ref
             progress.update()
+
+    def convert_records(self, records, num_records, show_progress=False, max_sites=None):
+        """
+        Converts the records and adds the kept sites to the samples.
+        """
+        progress = tqdm.tqdm(total=num_records, disable=not show_progress)
+        self.num_sites = 0
+        batch = SiteBatch(self.num_samples)
+        sites = self.convert_sites(records, batch.next_genotypes, progress)
+        for position, alleles, site_id, ref in sites:
+            batch.commit(position, alleles, site_id, ref)
+            if batch.full:
+                append_site_batch(self.samples, batch)
+            progress.set_postfix(used=str(self.num_sites))
+            if self.num_sites == max_sites:
+                break
+        sites.close()
+        records.close()
+        append_site_batch(self.samples, batch)
         progress.close()
         report_dict = self.report()
         return report_dict
@@ -398,9 +1301,9 @@ class ThousandGenomesConverter(VcfConverter):
     Converts data for the 1000 Genomes.
     """
 
-    def process_metadata(self, metadata_file, show_progress=False):
+    def parse_metadata(self, metadata_file):
         """
-        Adds the 1000 genomes populations metadata.
+        Parses the 1000 genomes populations and ped file metadata.
         """
         # Based on
         # http://www.internationalgenome.org/faq/which-populations-are-part-your-study/
@@ -437,24 +1340,23 @@ class ThousandGenomesConverter(VcfConverter):
             ["ITU", "Indian Telugu from the UK", "SAS"],
         ]
 
+        population_metadata = []
         population_id_map = {}
         for pop in populations:
-            pop_id = self.samples.add_population(
+            population_id_map[pop[0]] = len(population_metadata)
+            population_metadata.append(
                 dict(zip(["name", "description", "super_population"], pop))
             )
-            population_id_map[pop[0]] = pop_id
 
         with open(metadata_file, "r") as ped_file:
             # Parse the individual metadata out of the ped file.
             columns = next(ped_file).split("\t")
             sane_names = [col.replace(" ", "_").lower().strip() for col in columns]
-            metadata = {}
-            populations = {}
+            individuals = {}
             for line in ped_file:
                 row = dict(zip(sane_names, line.strip().split("\t")))
                 name = row["individual_id"]
                 population_name = row.pop("population")
-                populations[name] = population_id_map[population_name]
                 # The value '0' seems to be used to encode missing, so insert None
                 # instead to be more useful.
                 nulled = {}
@@ -462,17 +1364,11 @@ class ThousandGenomesConverter(VcfConverter):
                     if value == "0":
                         value = None
                     nulled[key] = value
-                metadata[name] = nulled
-
-        vcf = cyvcf2.VCF(self.data_file)
-        individual_names = list(vcf.samples)
-        vcf.close()
-        self.num_samples = len(individual_names) * 2
-        # Add in the metadata rows in the order of the VCF.
-        for index, name in enumerate(individual_names):
-            self.samples.add_individual(
-                metadata=metadata[name], population=populations[name], ploidy=2
-            )
+                individuals[name] = {
+                    "metadata": nulled,
+                    "population": population_id_map[population_name],
+                }
+        return population_metadata, individuals
 
 
 class SgdpConverter(VcfConverter):
@@ -480,9 +1376,9 @@ class SgdpConverter(VcfConverter):
     Converts data for the Simons Genome Diversity project data.
     """
 
-    def process_metadata(self, metadata_file, show_progress=False):
+    def parse_metadata(self, metadata_file):
         """
-        Adds the SGDP populations metadata.
+        Parses the SGDP populations and sample metadata.
         """
         # All populations in SGDP mapped to their regions.
         region_map = {
@@ -629,12 +1525,11 @@ class SgdpConverter(VcfConverter):
             "Yoruba": "Africa",
             "Zapotec": "America",
         }
+        population_metadata = []
         population_id_map = {}
         for name in sorted(region_map.keys()):
-            pop_id = self.samples.add_population(
-                {"name": name, "region": region_map[name]}
-            )
-            population_id_map[name] = pop_id
+            population_id_map[name] = len(population_metadata)
+            population_metadata.append({"name": name, "region": region_map[name]})
 
         # The file contains some non UTF-8 codepoints for a contributors name.
         with open(metadata_file, "r", encoding="ISO-8859-1") as md_file:
@@ -647,38 +1542,24 @@ class SgdpConverter(VcfConverter):
                     # There's a very long key that doesn't impart any information here.
                     # Remove it.
                     sane_names[j] = "DELETE"
-            rows = {}
-            populations = {}
-            locations = {}
+            individuals = {}
             for line in md_file:
                 metadata = dict(zip(sane_names, line.strip().split("\t")))
                 del metadata["DELETE"]
                 name = metadata["sgdp_id"]
                 population_name = metadata.pop("population_id")
-                populations[name] = population_id_map[population_name]
-                rows[name] = metadata
                 location = [
                     float(metadata.pop("latitude")),
                     float(metadata.pop("longitude")),
                 ]
-                locations[name] = location
                 if metadata["town"] == "?":
                     metadata["town"] = None
-
-        vcf = cyvcf2.VCF(self.data_file)
-        individual_names = list(vcf.samples)
-        vcf.close()
-        self.num_samples = 2 * len(individual_names)
-
-        # Add in the metadata rows in the order of the VCF.
-        for name in individual_names:
-            metadata = rows[name]
-            self.samples.add_individual(
-                metadata=metadata,
-                location=locations[name],
-                ploidy=2,
-                population=populations[name],
-            )
+                individuals[name] = {
+                    "metadata": metadata,
+                    "location": location,
+                    "population": population_id_map[population_name],
+                }
+        return population_metadata, individuals
 
 
 class HgdpConverter(VcfConverter):
@@ -686,9 +1567,9 @@ class HgdpConverter(VcfConverter):
     Converts data for the Human Genome Diversity project data.
     """
 
-    def process_metadata(self, metadata_file, show_progress=False):
+    def parse_metadata(self, metadata_file):
         """
-        Adds the HGDP populations metadata.
+        Parses the HGDP populations and sample metadata.
         """
         # All populations in HGDP mapped to their regions.
         region_map = {
@@ -747,46 +1628,31 @@ class HgdpConverter(VcfConverter):
             "Adygei": "EUROPE",
             "BantuKenya": "AFRICA",
         }
+        population_metadata = []
         population_id_map = {}
         for name in sorted(region_map.keys()):
-            pop_id = self.samples.add_population(
-                {"name": name, "region": region_map[name]}
-            )
-            population_id_map[name] = pop_id
+            population_id_map[name] = len(population_metadata)
+            population_metadata.append({"name": name, "region": region_map[name]})
 
         # The file contains some non UTF-8 codepoints for a contributors name.
         with open(metadata_file, "r", encoding="ISO-8859-1") as md_file:
             columns = next(md_file).lstrip("#").split("\t")
             sane_names = [col.lower().strip() for col in columns]
-            rows = {}
-            populations = {}
-            locations = {}
+            individuals = {}
             for line in md_file:
                 metadata = dict(zip(sane_names, line.strip().split("\t")))
                 name = metadata["sample"]
                 population_name = metadata.pop("population")
-                populations[name] = population_id_map[population_name]
-                rows[name] = metadata
                 location = [
                     float(metadata.pop("latitude")),
                     float(metadata.pop("longitude")),
                 ]
-                locations[name] = location
-
-        vcf = cyvcf2.VCF(self.data_file)
-        individual_names = list(vcf.samples)
-        vcf.close()
-        self.num_samples = 2 * len(individual_names)
-
-        # Add in the metadata rows in the order of the VCF.
-        for name in individual_names:
-            metadata = rows[name]
-            self.samples.add_individual(
-                metadata=metadata,
-                location=locations[name],
-                ploidy=2,
-                population=populations[name],
-            )
+                individuals[name] = {
+                    "metadata": metadata,
+                    "location": location,
+                    "population": population_id_map[population_name],
+                }
+        return population_metadata, individuals
 
 
 class MaxPlanckConverter(VcfConverter):
@@ -794,9 +1660,9 @@ class MaxPlanckConverter(VcfConverter):
     Converts data for Max Planck Data.
     """
 
-    def process_metadata(self, metadata_file, show_progress=False):
+    def add_populations(self, metadata_file):
         """
-        Adds the Max Planck metadata.
+        Adds the Max Planck population.
         """
         with open(metadata_file, "r") as max_planck_metadata:
             # Parse the individual metadata out of the file.
@@ -807,67 +1673,44 @@ class MaxPlanckConverter(VcfConverter):
             metadata["name"] = name
             metadata["age"] = int(row[2]) / GENERATION_TIME
             population = row[1]
-        vcf = cyvcf2.VCF(self.data_file)
-        individual_names = list(vcf.samples)
-        vcf.close()
-        self.num_samples = len(individual_names) * 2
-        pop_id = self.samples.add_population(
+        self.individual_metadata = metadata
+        self.population_id = self.samples.add_population(
             {"name": population, "super_population": "Max Planck"}
         )
+
+    def add_individuals(self, metadata_file):
+        """
+        Adds the Max Planck individual.
+        """
+        individual_names = self.get_individual_names()
+        self.num_samples = len(individual_names) * 2
+        metadata = self.individual_metadata
         self.samples.add_individual(
-            time=metadata["age"], metadata=metadata, population=pop_id, ploidy=2
+            time=metadata["age"],
+            metadata=metadata,
+            population=self.population_id,
+            ploidy=2,
         )
 
-    def convert_genotypes(self, row, ancestral_state):
-        def return_genotype(allele, ancestral_state):
-            if allele == ".":
-                return tskit.MISSING_DATA
-            else:
-                return allele != ancestral_state
-
+    def convert_genotypes(self, row, ancestral_state, a):
+        """
+        Fills the genotype row ``a`` for this VCF record and returns the list of
+        alleles if the site should be kept, or None if it is filtered out. Unlike
+        modern samples, sites where the individual is invariant are kept.
+        """
         ret = None
-        num_diploids = self.num_samples // 2
-        a = np.zeros(self.num_samples, dtype=np.int8)
-        # Use upper case version of ancestral state (keep original
-        # for checking low-confidence ancestral state)
-        all_alleles = set([ancestral_state])
-        # Fill in a with genotypes.
-        bases = np.array(row.gt_bases)
-        for j in range(num_diploids):
-            missing = False
-            if "|" in bases[j]:
-                alleles = bases[j].split("|")
-            else:
-                self.num_unphased += 1
-                alleles = bases[j].split("/")
-            if len(alleles) != 2:
-                break
-            for allele in alleles:
-                if allele == ".":
-                    self.num_missing_data += 1
-                    missing = True
-                else:
-                    all_alleles.add(allele)
-            a[2 * j] = alleles[0] != ancestral_state
-            a[2 * j + 1] = alleles[1] != ancestral_state
-
-            if missing:
-                if alleles[0] == ".":
-                    a[2 * j] = tskit.MISSING_DATA
-                if alleles[1] == ".":
-                    a[2 * j + 1] = tskit.MISSING_DATA
-        else:
+        all_alleles = self.fill_genotypes(row, ancestral_state, a)
+        if all_alleles is not None:
             freq = np.sum(a == 1)
             if len(all_alleles) > 2:
                 self.num_non_biallelic += 1
             elif any(len(allele) != 1 for allele in all_alleles):
                 self.num_indels += 1
             else:
-                metadata = {"ID": row.ID, "REF": row.REF}
                 if freq == 0:
                     self.num_invariant += 1
                     all_alleles.remove(ancestral_state)
-                    alleles = [ancestral_state]
+                    ret = [ancestral_state]
                 else:
                     if freq == 1:
                         self.num_singletons += 1
@@ -877,10 +1720,7 @@ class MaxPlanckConverter(VcfConverter):
                         self.num_invariant += 1
 
                     all_alleles.remove(ancestral_state)
-                    alleles = [ancestral_state, all_alleles.pop()]
-                ret = Site(
-                    position=row.POS, alleles=alleles, genotypes=a, metadata=metadata
-                )
+                    ret = [ancestral_state, all_alleles.pop()]
         return ret
 
 
@@ -889,16 +1729,20 @@ class AfanasievoConverter(MaxPlanckConverter):
     Converts data for Afanasievo Family.
     """
 
-    def process_metadata(self, show_progress=False):
+    def add_populations(self, metadata_file=None):
         """
-        Adds the Afanasievo metadata.
+        Adds the Afanasievo population. There is no metadata file.
         """
-        pop_id = self.samples.add_population(
+        self.population_id = self.samples.add_population(
             {"name": "Afanasievo", "super_population": "Afanasievo"}
         )
-        vcf = cyvcf2.VCF(self.data_file)
-        individual_names = list(vcf.samples)
-        vcf.close()
+
+    def add_individuals(self, metadata_file=None):
+        """
+        Adds the Afanasievo individuals.
+        """
+        pop_id = self.population_id
+        individual_names = self.get_individual_names()
         for name in individual_names:
             metadata = {}
             metadata["name"] = name
@@ -917,51 +1761,274 @@ class ReichConverter(VcfConverter):
     Convert data from 1240K array to SampleData file.
     """
 
-    def process_metadata(self, metadata_file, show_progress=False):
-        metadata_df = pd.read_csv(metadata_file, delimiter="\t")
-        # Add populations
+    def parse_metadata(self, metadata_file):
+        """
+        Parses the 1240K annotation file in a single pass. Populations are the
+        countries in order of first appearance.
+        """
+        # Read every column as the raw string so metadata matches the file.
+        metadata_df = pd.read_csv(
+            metadata_file, delimiter="\t", dtype=str, keep_default_na=False
+        )
+        metadata_df.columns = [
+            col.lower().split(" (")[0].split(" [")[0].replace(" ", "_")
+            for col in metadata_df.columns
+        ]
+        population_metadata = []
         population_id_map = {}
-        seen_populations = list()
-        for index, row in metadata_df.iterrows():
-            country = row["Country"]
-            if country not in seen_populations:
-                pop_id = self.samples.add_population(
-                    {"name": country, "locality": row["Locality"]}
+        individuals = {}
+        for metadata in metadata_df.to_dict("records"):
+            name = metadata["index"] + "_" + metadata["instance_id"]
+            population_name = metadata.pop("country")
+            if population_name not in population_id_map:
+                population_id_map[population_name] = len(population_metadata)
+                population_metadata.append(
+                    {"name": population_name, "locality": metadata["locality"]}
                 )
-                population_id_map[country] = pop_id
-                seen_populations.append(country)
+            age = metadata.pop("average_of_95.4%_date_range_in_calbp")
+            metadata["age"] = int(age) / GENERATION_TIME
+            individuals[name] = {
+                "time": metadata["age"],
+                "metadata": metadata,
+                "population": population_id_map[population_name],
+            }
+        return population_metadata, individuals
 
-        # The file contains some non UTF-8 codepoints for a contributors name.
-        with open(metadata_file, "r") as md_file:
-            columns = next(md_file).split("\t")
-            sane_names = [
-                col.lower().split(" (")[0].split(" [")[0].replace(" ", "_")
-                for col in columns
-            ]
-            rows = {}
-            populations = {}
-            for line in md_file:
-                metadata = dict(zip(sane_names, line.strip().split("\t")))
-                name = metadata["index"] + "_" + metadata["instance_id"]
-                population_name = metadata.pop("country")
-                populations[name] = population_id_map[population_name]
-                age = metadata.pop("average_of_95.4%_date_range_in_calbp")
-                metadata["age"] = int(age) / GENERATION_TIME
-                rows[name] = metadata
-        vcf = cyvcf2.VCF(self.data_file)
-        individual_names = list(vcf.samples)
-        vcf.close()
-        self.num_samples = len(individual_names) * 2
 
-        # Add in the metadata rows in the order of the VCF.
-        for name in individual_names:
-            metadata = rows[name]
-            self.samples.add_individual(
-                time=metadata["age"],
-                metadata=metadata,
-                ploidy=2,
-                population=populations[name],
+class ReichPackedConverter(ReichConverter):
+    """
+    Converts the 1240K data directly from the PACKEDANCESTRYMAP .geno file and the
+    .snp and .ind files beside it, rather than from a VCF made with convertf and
+    plink. Genotype records are read from a memory map and unpacked in blocks.
+
+    Most ancient individuals are pseudo-haploid: a single read is sampled at each
+    site and the allele is recorded as a homozygous call. Individuals with no
+    heterozygous calls anywhere in the .geno file are treated as pseudo-haploid,
+    and their calls are added as a single allele on the first haplotype with the
+    second haplotype missing.
+    """
+
+    def __init__(self, data_file, *args, **kwargs):
+        super().__init__(data_file, *args, **kwargs)
+        prefix = data_file[: -len(".geno")] if data_file.endswith(".geno") else data_file
+        self.geno_file = prefix + ".geno"
+        self.snp_file = prefix + ".snp"
+        self.ind_file = prefix + ".ind"
+        self.pseudo_haploid = None
+        self.num_file_individuals = None
+        # The indexes of the selected individuals in the .ind file, or None if all
+        # individuals are converted.
+        self.columns = None
+
+    def get_individual_names(self):
+        if self.individual_names is None:
+            ind = pd.read_csv(
+                self.ind_file, sep=r"\s+", header=None, usecols=[0], dtype=str
             )
+            # convertf numbers the individuals in the family ID column and plink
+            # joins this to the ID, which is how the .anno file names them.
+            names = ["{}_{}".format(j + 1, name) for j, name in enumerate(ind[0])]
+            self.num_file_individuals = len(names)
+            if self.sample_subset is not None:
+                self.columns = subset_samples(names, self.sample_subset)
+                names = [names[j] for j in self.columns]
+            self.individual_names = names
+        return self.individual_names
+
+    def unpack_calls(self, records):
+        """
+        Returns the calls of the selected individuals in these genotype records.
+        """
+        calls = unpack_genotypes(records, self.num_file_individuals)
+        if self.columns is not None:
+            calls = calls[:, self.columns]
+        return calls
+
+    def read_genotypes(self):
+        """
+        Returns a read-only memory map of the genotype records, with one row of
+        packed calls per SNP in the .snp file.
+        """
+        num_individuals, num_snps, record_length = read_packed_geno_header(
+            self.geno_file
+        )
+        self.get_individual_names()
+        if num_individuals != self.num_file_individuals:
+            raise ValueError("The .geno and .ind files do not match")
+        geno = np.memmap(
+            self.geno_file,
+            dtype=np.uint8,
+            mode="r",
+            shape=(num_snps + 1, record_length),
+        )
+        # The first record is the header.
+        return geno[1:]
+
+    def select_sites(self, snps, region=None):
+        """
+        Returns a tuple (index, position, flipped) of arrays for the sites in the
+        region ("chrom" or "chrom:start-end") to convert, in increasing order of
+        output position. index holds the rows of the .snp file.
+        """
+        chromosomes = snps["chrom"].values
+        source_positions = snps["position"].values
+        if region is None:
+            if len(np.unique(chromosomes)) > 1:
+                raise ValueError("A region is required for multi-chromosome inputs")
+            chromosome = chromosomes[0]
+            keep = np.ones(len(snps), dtype=bool)
+        else:
+            chromosome, _, interval = region.partition(":")
+            keep = chromosomes == chromosome
+            if interval:
+                start, end = (int(x) for x in interval.split("-"))
+                keep &= (source_positions >= start) & (source_positions <= end)
+        index = np.where(keep)[0]
+        # As in filter_duplicates_target, drop all sites at repeated positions.
+        index = index[unique_mask(source_positions[index])]
+        position = source_positions[index]
+        flipped = np.zeros(len(index), dtype=bool)
+        if self.liftover is not None:
+            position, flipped = self.liftover.lift(chromosome, position)
+            keep = self.keep_lifted(position)
+        elif self.target_sites_pos is not None:
+            target = np.fromiter(self.target_sites_pos, dtype=np.float64)
+            keep = np.isin(position, target)
+        else:
+            keep = np.ones(len(index), dtype=bool)
+        keep &= self.in_output_interval(position)
+        order = np.argsort(position[keep], kind="stable")
+        return index[keep][order], position[keep][order], flipped[keep][order]
+
+    def find_pseudo_haploid(self, geno):
+        """
+        Returns a boolean array marking the selected individuals that have no
+        heterozygous calls in the whole .geno file, so that each individual gets
+        the same ploidy in the jobs for every chromosome or region. The result of
+        the scan is cached in the metadata cache directory, keyed by the size and
+        modification time of the .geno file.
+        """
+        cache_file = None
+        if self.metadata_cache_dir is not None:
+            stat = os.stat(self.geno_file)
+            cache_file = os.path.join(
+                self.metadata_cache_dir,
+                "{}.{}.{}.pseudo_haploid.npy".format(
+                    os.path.basename(self.geno_file), stat.st_size, stat.st_mtime_ns
+                ),
+            )
+        if cache_file is not None and os.path.exists(cache_file):
+            pseudo_haploid = np.load(cache_file)
+        else:
+            heterozygous = np.zeros(self.num_file_individuals, dtype=bool)
+            for start in range(0, len(geno), SITE_BATCH_SIZE):
+                calls = unpack_genotypes(
+                    geno[start: start + SITE_BATCH_SIZE], self.num_file_individuals
+                )
+                heterozygous |= np.any(calls == 1, axis=0)
+            pseudo_haploid = ~heterozygous
+            if cache_file is not None:
+                tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+                try:
+                    with open(tmp_file, "wb") as f:
+                        np.save(f, pseudo_haploid)
+                    os.replace(tmp_file, cache_file)
+                except OSError as e:
+                    print(
+                        "Not caching pseudo-haploid individuals in {}: {}".format(
+                            cache_file, e
+                        ),
+                        file=sys.stderr,
+                    )
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
+        if self.columns is not None:
+            pseudo_haploid = pseudo_haploid[self.columns]
+        return pseudo_haploid
+
+    def report(self):
+        report_dict = super().report()
+        report_dict["pseudo_haploid_individuals"] = int(np.sum(self.pseudo_haploid))
+        return report_dict
+
+    def fill_genotypes(self, row, ancestral_state, a):
+        """
+        Fills the genotype row ``a`` for this EigenstratRecord. Calls are unphased,
+        so a heterozygote carries REF on its first haplotype.
+        """
+        calls = row.calls
+        missing = calls == PACKED_MISSING
+        pseudo_haploid = self.pseudo_haploid
+        self.num_unphased += int(np.sum(~pseudo_haploid))
+        self.num_missing_data += int(
+            2 * np.sum(missing & ~pseudo_haploid) + np.sum(missing & pseudo_haploid)
+        )
+        ref_derived = row.REF != ancestral_state
+        alt_derived = row.ALT != ancestral_state
+        a[0::2] = np.where(calls >= 1, ref_derived, alt_derived)
+        a[1::2] = np.where(calls == 2, ref_derived, alt_derived)
+        a[0::2][missing] = tskit.MISSING_DATA
+        a[1::2][missing | pseudo_haploid] = tskit.MISSING_DATA
+        all_alleles = set([ancestral_state])
+        if np.any((calls >= 1) & ~missing):
+            all_alleles.add(row.REF)
+        if np.any(calls <= 1):
+            all_alleles.add(row.ALT)
+        return all_alleles
+
+    def records(self, geno, snps, index, position, flipped):
+        """
+        Yields tuples (EigenstratRecord, position, flipped) for the specified
+        sites, unpacking the genotype records a block at a time.
+        """
+        ids = snps["id"].values
+        refs = snps["ref"].values
+        alts = snps["alt"].values
+        for start in range(0, len(index), SITE_BATCH_SIZE):
+            block = index[start: start + SITE_BATCH_SIZE]
+            calls = self.unpack_calls(geno[block])
+            for j, k in enumerate(block):
+                record = EigenstratRecord(ids[k], refs[k], alts[k], calls[j])
+                yield record, position[start + j], flipped[start + j]
+
+    def read_snps(self):
+        return pd.read_csv(
+            self.snp_file,
+            sep=r"\s+",
+            header=None,
+            names=["id", "chrom", "genetic_position", "position", "ref", "alt"],
+            usecols=["id", "chrom", "position", "ref", "alt"],
+            dtype={"id": str, "chrom": str, "ref": str, "alt": str},
+        )
+
+    def output_positions(self, vcf_subset=None):
+        _, position, _ = self.select_sites(self.read_snps(), vcf_subset)
+        return position
+
+    def prepare_chunks(self):
+        # Scan the .geno file for pseudo-haploid individuals once, filling the
+        # cache that the chunk jobs then read.
+        self.find_pseudo_haploid(self.read_genotypes())
+
+    def open_records(self, vcf_subset=None):
+        geno = self.read_genotypes()
+        snps = self.read_snps()
+        if len(snps) != len(geno):
+            raise ValueError("The .geno and .snp files do not match")
+        index, position, flipped = self.select_sites(snps, vcf_subset)
+        self.pseudo_haploid = self.find_pseudo_haploid(geno)
+        return self.records(geno, snps, index, position, flipped), len(index)
+
+
+CONVERTER_CLASSES = {
+    "1kg": ThousandGenomesConverter,
+    "sgdp": SgdpConverter,
+    "hgdp": HgdpConverter,
+    "max-planck": MaxPlanckConverter,
+    "afanasievo": AfanasievoConverter,
+    "1240k": ReichConverter,
+    "1240k-packed": ReichPackedConverter,
+}
 
 
 def main():
@@ -970,7 +2037,7 @@ def main():
     )
     parser.add_argument(
         "source",
-        choices=["1kg", "sgdp", "hgdp", "max-planck", "afanasievo", "1240k"],
+        choices=list(CONVERTER_CLASSES.keys()),
         help="The source of the input data.",
     )
     parser.add_argument("data_file", help="The input data file pattern.")
@@ -1016,10 +2083,119 @@ def main():
     parser.add_argument(
         "--num-threads", type=int, default=1, help="Number of threads to use."
     )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--samples",
+        default=None,
+        help="A comma-separated list of the samples to convert. Only the genotypes \
+            of these samples are decoded, and only their populations are added.",
+    )
+    group.add_argument(
+        "--samples-file",
+        default=None,
+        help="A file listing the samples to convert, one per line.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1024,
+        help="The zarr chunk size, in sites and in samples, of the output arrays.",
+    )
+    parser.add_argument(
+        "--compressor",
+        choices=["zstd", "zlib", "blosc-zstd", "blosc-lz4", "none"],
+        default="zstd",
+        help="The compressor used for the output arrays.",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        default=None,
+        help="The compression level; the compressor's default if not given.",
+    )
+    parser.add_argument(
+        "--num-flush-threads",
+        type=int,
+        default=1,
+        help="Number of threads used to compress and write output chunks.",
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Benchmark a set of chunk size, compressor and flush thread profiles \
+            by converting the input (restricted with --region or -n) to temporary \
+            files named after output_file, and print the fastest.",
+    )
+    parser.add_argument(
+        "--merge-with",
+        nargs="+",
+        action="append",
+        default=None,
+        metavar="INPUT",
+        help="Convert another input and merge it with the main input in a single \
+            pass. Given as SOURCE DATA_FILE [METADATA_FILE [LIFTOVER_CHAIN]], using \
+            - for no metadata file. May be repeated; must be followed by another \
+            option rather than the output file.",
+    )
+    parser.add_argument(
+        "--merge-sites",
+        choices=["intersection", "union", "first"],
+        default="intersection",
+        help="Which sites to keep when merging: those kept from every input, from \
+            any input, or from the main input.",
+    )
+    parser.add_argument(
+        "--region",
+        default=None,
+        help="Only convert sites in this region of the input, e.g. 20 or \
+            20:1-1000000. Required for 1240k-packed input, which holds all \
+            chromosomes.",
+    )
+    parser.add_argument(
+        "--gt-only",
+        action="store_true",
+        help="Only decode the GT field of each record, streaming the input through \
+            bcftools to strip INFO and other FORMAT fields.",
+    )
+    parser.add_argument(
+        "--decompression-threads",
+        type=int,
+        default=0,
+        help="Number of extra threads each process uses for BGZF decompression.",
+    )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--liftover-chain",
+        default=None,
+        help="A chain file (e.g. hg19ToHg38.over.chain.gz) used to lift the input \
+            positions over to the assembly of the ancestral states file during \
+            conversion.",
+    )
 
-    if args.num_threads > 1:
+    parser.add_argument(
+        "--metadata-cache-dir",
+        default=None,
+        help="Directory in which parsed metadata files are cached. Defaults to the \
+            directory of the output file.",
+    )
+
+    args = parser.parse_args()
+    args.sample_subset = read_sample_subset(args)
+    if args.metadata_cache_dir is None:
+        args.metadata_cache_dir = os.path.dirname(os.path.abspath(args.output_file))
+
+    if args.merge_with is not None and (
+        args.sample_subset is not None or args.autotune
+    ):
+        raise ValueError("--merge-with cannot be used with --samples or --autotune")
+    if args.merge_with is not None and args.num_threads > 1:
+        run_multiprocessing(args, make_merged_sampledata)
+    elif args.merge_with is not None:
+        report = make_merged_sampledata(args)
+        print(report)
+    elif args.autotune:
+        autotune(args)
+    elif args.num_threads > 1:
         run_multiprocessing(args, make_sampledata)
     else:
         report = make_sampledata(args)
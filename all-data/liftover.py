@@ -0,0 +1,130 @@
+"""
+Coordinate liftover of site positions using UCSC chain files.
+"""
+import gzip
+
+import numpy as np
+
+
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+
+def reverse_complement(allele):
+    return allele.translate(COMPLEMENT)[::-1]
+
+
+def chain_chromosome(name):
+    """
+    Returns the UCSC chromosome name used in chain files, e.g. "20" -> "chr20".
+    """
+    return name if name.startswith("chr") else "chr" + name
+
+
+class Chain(object):
+    """
+    A single chain: the ungapped aligned blocks between one source (chain "target")
+    chromosome and one destination (chain "query") chromosome. Block coordinates
+    are 0-based; query coordinates are on the query strand.
+    """
+
+    def __init__(self, header):
+        fields = header.split()
+        self.score = int(fields[1])
+        self.t_name = fields[2]
+        self.t_start = int(fields[5])
+        self.t_end = int(fields[6])
+        self.q_name = fields[7]
+        self.q_size = int(fields[8])
+        self.q_strand = fields[9]
+        self.t_starts = []
+        self.q_starts = []
+        self.sizes = []
+
+    def finalise(self):
+        self.t_starts = np.array(self.t_starts, dtype=np.int64)
+        self.q_starts = np.array(self.q_starts, dtype=np.int64)
+        self.sizes = np.array(self.sizes, dtype=np.int64)
+
+
+def read_chains(chain_file, chromosomes=None):
+    """
+    Reads the chains in the specified (optionally gzipped) chain file, and returns a
+    dictionary mapping source chromosome names to lists of chains. If chromosomes
+    is not None, only chains from these source chromosomes are kept.
+    """
+    opener = gzip.open if chain_file.endswith(".gz") else open
+    chains = {}
+    chain = None
+    with opener(chain_file, "rt") as f:
+        for line in f:
+            if line.startswith("chain"):
+                chain = Chain(line)
+                t = chain.t_start
+                q = int(line.split()[10])
+                if chromosomes is not None and chain.t_name not in chromosomes:
+                    chain = None
+            elif chain is not None and line.strip():
+                fields = line.split()
+                size = int(fields[0])
+                chain.t_starts.append(t)
+                chain.q_starts.append(q)
+                chain.sizes.append(size)
+                if len(fields) == 3:
+                    t += size + int(fields[1])
+                    q += size + int(fields[2])
+                else:
+                    # The last block of the chain.
+                    chain.finalise()
+                    chains.setdefault(chain.t_name, []).append(chain)
+                    chain = None
+    return chains
+
+
+class Liftover(object):
+    """
+    Maps 1-based site positions between assemblies using a chain file, such as
+    hg19ToHg38.over.chain.gz. As in Picard's LiftoverVcf, a site is dropped if it
+    falls in no chain block or in blocks of more than one chain. Sites that map
+    to a chromosome with a different name are also dropped, since each converted
+    file holds a single chromosome.
+    """
+
+    def __init__(self, chain_file, chromosomes=None):
+        if chromosomes is not None:
+            chromosomes = {chain_chromosome(name) for name in chromosomes}
+        self.chains = read_chains(chain_file, chromosomes)
+
+    def lift(self, chromosome, positions):
+        """
+        Returns a tuple (lifted, flipped) of arrays the same length as positions.
+        lifted holds the new 1-based positions, with 0 for dropped sites, and
+        flipped is True for sites that map to the reverse strand, whose alleles
+        must be reverse complemented.
+        """
+        chromosome = chain_chromosome(chromosome)
+        source = np.asarray(positions, dtype=np.int64) - 1
+        lifted = np.zeros(len(source), dtype=np.int64)
+        flipped = np.zeros(len(source), dtype=bool)
+        hits = np.zeros(len(source), dtype=np.int32)
+        order = np.argsort(source, kind="stable")
+        sorted_source = source[order]
+        for chain in self.chains.get(chromosome, []):
+            start, end = np.searchsorted(sorted_source, [chain.t_start, chain.t_end])
+            index = order[start:end]
+            pos = source[index]
+            block = np.searchsorted(chain.t_starts, pos, side="right") - 1
+            inside = pos < chain.t_starts[block] + chain.sizes[block]
+            index = index[inside]
+            offset = pos[inside] - chain.t_starts[block[inside]]
+            hits[index] += 1
+            if chain.q_name == chromosome:
+                q = chain.q_starts[block[inside]] + offset
+                if chain.q_strand == "-":
+                    q = chain.q_size - 1 - q
+                lifted[index] = q + 1
+                flipped[index] = chain.q_strand == "-"
+            else:
+                lifted[index] = 0
+        lifted[hits != 1] = 0
+        flipped[hits != 1] = False
+        return lifted, flipped
@@ -4,9 +4,13 @@ Various utilities for manipulating tree sequences and running tsinfer.
 """
 import argparse
 import time
-import collections
 import json
+import multiprocessing
 import os.path
+import re
+import resource
+import sys
+import threading
 
 import tskit
 import tsinfer
@@ -17,6 +21,8 @@ import pandas as pd
 import tqdm
 import humanize
 import cyvcf2
+import numcodecs
+import zarr
 
 
 def run_simplify(args):
@@ -57,351 +63,817 @@ def run_match_samples(sample_data, ancestors_ts, num_threads):
     )
 
 
-def run_sequential_augment(args):
+def augment_sizes(num_samples):
+    """
+    Returns the number of samples augmented at each of the doubling stages.
+    """
+    sizes = []
+    n = 2
+    while n < num_samples // 4:
+        sizes.append(n)
+        n *= 2
+    return sizes
+
+
+def process_peak_memory():
+    """
+    Returns the peak resident set size of this process so far in bytes.
+    """
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_memory():
+    """
+    Returns the current resident set size of this process in bytes.
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+class MemoryMonitor(object):
+    """
+    Context manager that samples the resident set size of this process in a
+    background thread, recording the peak while the block runs in ``peak``.
+    Allocations that are freed again within one sampling interval are missed.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_memory())
 
+    def __enter__(self):
+        self.peak = current_memory()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_memory())
+
+
+def run_stage(record, func, *args):
+    """
+    Runs func(*args), storing the wall time and the peak memory of the stage in
+    the specified stage record, and returns the result. The peak resident set
+    size of the process so far is recorded as well, as an upper bound that
+    includes earlier stages.
+    """
+    before = time.perf_counter()
+    with MemoryMonitor() as monitor:
+        result = func(*args)
+    record["wall_time"] = time.perf_counter() - before
+    record["peak_memory"] = monitor.peak
+    record["process_peak_memory"] = process_peak_memory()
+    print(
+        "Stage {} done in {:.2f}s, peak memory {} (process peak so far {})".format(
+            record["stage"],
+            record["wall_time"],
+            humanize.naturalsize(record["peak_memory"], binary=True),
+            humanize.naturalsize(record["process_peak_memory"], binary=True),
+        )
+    )
+    return result
+
+
+def write_manifest(manifest_file, manifest):
+    # Write a new file and rename it, so that a crash never leaves a partial
+    # manifest behind.
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def load_manifest(manifest_file, manifest):
+    """
+    Returns the stages recorded in the specified manifest file if it was written
+    for the same input, number of samples and seed as the new manifest, and an
+    empty list otherwise.
+    """
+    if not os.path.exists(manifest_file):
+        return []
+    with open(manifest_file) as f:
+        previous = json.load(f)
+    for key in ["input", "num_samples", "seed"]:
+        if previous[key] != manifest[key]:
+            print("Ignoring manifest {}: {} differs".format(manifest_file, key))
+            return []
+    return previous["stages"]
+
+
+def resume_augment(stages):
+    """
+    Returns the completed augment stages up to and including the latest one
+    whose ancestors file can still be loaded, and the loaded tree sequence (or
+    None if there is no such stage).
+    """
+    stages = [stage for stage in stages if stage["stage"].startswith("augment")]
+    while len(stages) > 0:
+        try:
+            return stages, tskit.load(stages[-1]["file"])
+        except (OSError, tskit.FileFormatError) as e:
+            print("Cannot load {}: {}".format(stages[-1]["file"], e))
+            stages.pop()
+    return stages, None
+
+
+def run_sequential_augment(args):
+    """
+    Augments the ancestors with doubling numbers of samples, dumping the
+    ancestors after each stage, and matches the samples against the final
+    ancestors. Completed stages are recorded with their timings in a manifest
+    beside the input, and a rerun resumes from the latest valid one.
+    """
     base = ".".join(args.input.split(".")[:-1])
+    manifest_file = base + ".augment_manifest.json"
 
     sample_data = tsinfer.load(args.input)
     num_samples = sample_data.num_samples
-    ancestors_ts = tskit.load(base + ".ancestors.trees")
-
-    # Compute the total samples required.
-    n = 2
-    total = 0
-    while n < num_samples // 4:
-        total += n
-        n *= 2
+    sizes = augment_sizes(num_samples)
+    final_file = base + ".augmented_{}.nosimplify.trees".format(sizes[-1])
 
     np.random.seed(args.seed)
-    samples = np.random.choice(np.arange(num_samples), size=total, replace=False)
+    samples = np.random.choice(np.arange(num_samples), size=sum(sizes), replace=False)
     np.save(base + ".augmented_samples.npy", samples)
 
-    n = 2
+    manifest = {"input": args.input, "num_samples": num_samples, "seed": args.seed}
+    stages = [] if args.restart else load_manifest(manifest_file, manifest)
+    match = [stage for stage in stages if stage["stage"] == "match"]
+    if len(match) > 0 and os.path.exists(match[0]["file"]):
+        print("All stages already complete, output in", final_file)
+        return
+    manifest["stages"], ancestors_ts = resume_augment(stages)
+    if ancestors_ts is None:
+        ancestors_ts = tskit.load(base + ".ancestors.trees")
+    else:
+        print("Resuming after stage", manifest["stages"][-1]["stage"])
+
     j = 0
-    while n < num_samples // 4:
+    for n in sizes:
         augmented_file = base + ".augmented_{}.ancestors.trees".format(n)
-        final_file = base + ".augmented_{}.nosimplify.trees".format(n)
-        subset = samples[j: j + n]
-        subset.sort()
-        ancestors_ts = run_augment(sample_data, ancestors_ts, subset, args.num_threads)
-        ancestors_ts.dump(augmented_file)
+        if j + n > sum(stage["n"] for stage in manifest["stages"]):
+            subset = samples[j: j + n]
+            subset.sort()
+            record = {"stage": "augment_{}".format(n), "n": n, "file": augmented_file}
+            ancestors_ts = run_stage(
+                record, run_augment, sample_data, ancestors_ts, subset, args.num_threads
+            )
+            ancestors_ts.dump(augmented_file)
+            manifest["stages"].append(record)
+            write_manifest(manifest_file, manifest)
         j += n
-        n *= 2
 
-    final_ts = run_match_samples(sample_data, ancestors_ts, args.num_threads)
+    record = {"stage": "match", "file": final_file}
+    final_ts = run_stage(
+        record, run_match_samples, sample_data, ancestors_ts, args.num_threads
+    )
     final_ts.dump(final_file)
+    manifest["stages"].append(record)
+    write_manifest(manifest_file, manifest)
 
 
-def run_benchmark_tskit(args):
+# Fractional slowdown of the best time against the baseline that is reported as
+# a regression by the benchmark commands' compare mode.
+BENCHMARK_THRESHOLD = 0.1
 
-    before = time.perf_counter()
-    ts = tskit.load(args.input)
-    duration = time.perf_counter() - before
-    print("Loaded in {:.2f}s".format(duration))
 
+def drop_page_cache(path):
+    """
+    Asks the kernel to evict the specified file from the page cache, so that the
+    next read of it is cold. Does nothing where this isn't supported.
+    """
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def run_benchmarks(args, benchmarks, info):
+    """
+    Runs each of the specified (name, function, reads_input) benchmarks
+    args.repeats times. For benchmarks that read the input file, it is dropped
+    from the page cache before the first run, which is recorded as the cold time
+    and the rest as warm. Benchmarks on data already in memory have no cold run,
+    so all their runs are warm and the cold time is None. Each function returns
+    a dictionary of the counts of what it processed, which are stored alongside
+    the times. The results are written as JSON to args.output if given, and
+    compared to the baseline file args.compare if given.
+    """
+    results = {}
+    for name, func, reads_input in benchmarks:
+        if args.benchmarks is not None and name not in args.benchmarks:
+            continue
+        if reads_input:
+            drop_page_cache(args.input)
+        times = []
+        for _ in range(args.repeats):
+            before = time.perf_counter()
+            counts = func()
+            times.append(time.perf_counter() - before)
+        cold = times[0] if reads_input else None
+        warm = times[1:] if reads_input else times
+        timed = warm if len(warm) > 0 else times
+        results[name] = dict(
+            cold=cold, warm=warm, best=min(timed), mean=np.mean(timed), **counts
+        )
+        print(
+            "{}: cold {}, best {:.3f}s, mean {:.3f}s {}".format(
+                name,
+                "n/a" if cold is None else "{:.3f}s".format(cold),
+                min(timed),
+                np.mean(timed),
+                counts,
+            )
+        )
+    output = {
+        "input": args.input,
+        "size": os.path.getsize(args.input),
+        "repeats": args.repeats,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "info": info,
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_benchmarks(results, baseline["results"], args.threshold) > 0:
+            sys.exit(1)
+
+
+def compare_benchmarks(results, baseline, threshold):
+    """
+    Prints the best time of each benchmark against the baseline results, flagging
+    those more than threshold slower as regressions, and returns how many were.
+    """
+    num_regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            print("{}: not in baseline".format(name))
+            continue
+        change = result["best"] / baseline[name]["best"] - 1
+        regression = change > threshold
+        num_regressions += regression
+        print(
+            "{}: {:.3f}s vs {:.3f}s ({:+.1%}){}".format(
+                name,
+                result["best"],
+                baseline[name]["best"],
+                change,
+                " REGRESSION" if regression else "",
+            )
+        )
+    print("{} regressions in {} benchmarks".format(num_regressions, len(results)))
+    return num_regressions
+
+
+def run_benchmark_tskit(args):
+    ts = tskit.load(args.input)
     print("num_nodes = ", ts.num_nodes)
     print("num_edges = ", ts.num_edges)
     print("num_trees = ", ts.num_trees)
     print("size = ", humanize.naturalsize(os.path.getsize(args.input), binary=True))
 
-    before = time.perf_counter()
-    j = 0
-    for tree in ts.trees(sample_counts=False):
-        j += 1
-    assert j == ts.num_trees
-    duration = time.perf_counter() - before
-    print("Iterated over trees in {:.2f}s".format(duration))
-
-    before = time.perf_counter()
-    num_variants = 0
-    # As of msprime 0.6.1, it's a little bit more efficient to specify the full
-    # samples and use the tree traversal based decoding algorithm than the full
-    # sample-lists for UKBB trees. This'll be fixed in the future.
-    for var in ts.variants(samples=ts.samples()):
-        if num_variants == args.num_variants:
-            break
-        num_variants += 1
-    duration = time.perf_counter() - before
-    total_genotypes = (ts.num_samples * num_variants) / 10 ** 6
-    print(
-        "Iterated over {} variants in {:.2f}s @ {:.2f} M genotypes/s".format(
-            num_variants, duration, total_genotypes / duration
+    def load():
+        tskit.load(args.input)
+        return {}
+
+    def trees():
+        j = 0
+        for tree in ts.trees(sample_counts=False):
+            j += 1
+        assert j == ts.num_trees
+        return {"num_trees": j}
+
+    def variants():
+        num_variants = 0
+        # As of msprime 0.6.1, it's a little bit more efficient to specify the full
+        # samples and use the tree traversal based decoding algorithm than the full
+        # sample-lists for UKBB trees. This'll be fixed in the future.
+        for var in ts.variants(samples=ts.samples()):
+            if num_variants == args.num_variants:
+                break
+            num_variants += 1
+        return {"num_genotypes": ts.num_samples * num_variants}
+
+    def haplotypes():
+        num_haplotypes = 0
+        for h in ts.haplotypes():
+            if num_haplotypes == args.num_haplotypes:
+                break
+            num_haplotypes += 1
+        return {"num_genotypes": ts.num_sites * num_haplotypes}
+
+    def simplify():
+        ts.simplify()
+        return {}
+
+    rng = np.random.RandomState(args.seed)
+    focal = rng.choice(ts.samples(), min(args.num_focal, ts.num_samples), replace=False)
+    focal = focal.astype(np.int32)
+    # One reference set per population, or a single set if there are none.
+    samples = ts.samples().astype(np.int32)
+    population = ts.tables.nodes.population[samples]
+    reference_sets = [samples[population == pop] for pop in np.unique(population)]
+
+    def gnn():
+        ts.genealogical_nearest_neighbours(
+            focal, reference_sets, num_threads=args.num_threads
         )
-    )
+        return {"num_focal": len(focal)}
+
+    # Only load reads the input file; the rest work on the tree sequence loaded
+    # above.
+    benchmarks = [
+        ("load", load, True),
+        ("trees", trees, False),
+        ("variants", variants, False),
+        ("haplotypes", haplotypes, False),
+        ("simplify", simplify, False),
+        ("gnn", gnn, False),
+    ]
+    info = {
+        "tskit": tskit.__version__,
+        "num_nodes": ts.num_nodes,
+        "num_edges": ts.num_edges,
+        "num_trees": ts.num_trees,
+        "num_sites": ts.num_sites,
+        "num_samples": ts.num_samples,
+    }
+    run_benchmarks(args, benchmarks, info)
 
 
 def run_benchmark_vcf(args):
-
-    before = time.perf_counter()
-    records = cyvcf2.VCF(args.input)
-    duration = time.perf_counter() - before
-    print("Read BCF header in {:.2f} seconds".format(duration))
-    before = time.perf_counter()
-    count = 0
-    for record in records:
-        count += 1
-    duration = time.perf_counter() - before
-    print("Read {} VCF records in {:.2f} seconds".format(count, duration))
+    def header():
+        cyvcf2.VCF(args.input)
+        return {}
+
+    def records():
+        count = 0
+        for record in cyvcf2.VCF(args.input):
+            if count == args.num_variants:
+                break
+            count += 1
+        return {"num_records": count}
+
+    def genotypes():
+        count = 0
+        vcf = cyvcf2.VCF(args.input)
+        for record in vcf:
+            if count == args.num_variants:
+                break
+            record.gt_types
+            count += 1
+        return {"num_genotypes": len(vcf.samples) * count}
+
+    benchmarks = [
+        ("header", header, True),
+        ("records", records, True),
+        ("genotypes", genotypes, True),
+    ]
+    run_benchmarks(args, benchmarks, {"cyvcf2": cyvcf2.__version__})
+
+
+# The sample field of the JSON metadata tsinfer writes for sample ancestor nodes.
+SAMPLE_FIELD = re.compile(rb'"sample"\s*:\s*(-?\d+)')
 
 
 def get_augmented_samples(tables):
-    # Shortcut. Iterating over all the IDs is very slow here.
+    """
+    Returns the "sample" metadata field of every node flagged as a sample
+    ancestor. The metadata of these nodes is gathered out of the packed buffer
+    and scanned in a single pass; rows are only decoded one at a time if they do
+    not each hold exactly one integer sample field.
+    """
     # Note that we don't necessarily recover all of the samples that were
     # augmented here because they might have been simplified out.
-    # return np.load("ukbb_chr20.augmented_samples.npy")
     nodes = tables.nodes
     ids = np.where(nodes.flags == tsinfer.NODE_IS_SAMPLE_ANCESTOR)[0]
+    start = nodes.metadata_offset[ids].astype(np.int64)
+    length = nodes.metadata_offset[ids + 1].astype(np.int64) - start
+    offset = np.zeros(len(ids) + 1, dtype=np.int64)
+    offset[1:] = np.cumsum(length)
+    # The position in the packed buffer of each byte of the flagged rows.
+    index = np.arange(offset[-1]) + np.repeat(start - offset[:-1], length)
+    metadata = nodes.metadata[index]
+    matches = list(SAMPLE_FIELD.finditer(metadata.tobytes()))
+    row = np.searchsorted(offset, [m.start() for m in matches], side="right") - 1
+    if np.array_equal(row, np.arange(len(ids))):
+        return np.array([m.group(1) for m in matches], dtype=int)
     sample_ids = np.zeros(len(ids), dtype=int)
-    for j, node_id in enumerate(tqdm.tqdm(ids)):
-        offset = nodes.metadata_offset[node_id: node_id + 2]
-        buff = bytearray(nodes.metadata[offset[0]: offset[1]])
-        md = json.loads(buff.decode())
-        sample_ids[j] = md["sample"]
+    for j, md in enumerate(tskit.unpack_bytes(metadata, offset)):
+        sample_ids[j] = json.loads(md.decode())["sample"]
     return sample_ids
 
 
-def run_compute_ukbb_gnn(args):
-    ts = tskit.load(args.input)
-    tables = ts.tables
-    before = time.time()
-    augmented_samples = set(get_augmented_samples(tables))
-    duration = time.time() - before
-    print("Got augmented:", len(augmented_samples), "in ", duration)
+def load_augmented_samples(ts_file, tables, cache=False):
+    """
+    Returns get_augmented_samples(tables) for the tables loaded from ts_file. If
+    cache is True the result is stored beside the tree sequence file, keyed by its
+    size and modification time, and reused while the file is unchanged.
+    """
+    if not cache:
+        return get_augmented_samples(tables)
+    stat = os.stat(ts_file)
+    key = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    cache_file = ts_file + ".augmented_samples.npz"
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            if np.array_equal(data["key"], key):
+                return data["sample_ids"]
+    sample_ids = get_augmented_samples(tables)
+    with open(cache_file, "wb") as f:
+        np.savez(f, key=key, sample_ids=sample_ids)
+    return sample_ids
 
-    reference_sets_map = collections.defaultdict(list)
-
-    ind_metadata = [None for _ in range(ts.num_individuals)]
-    all_samples = []
-    for ind in ts.individuals():
-        md = json.loads(ind.metadata.decode())
-        ind_metadata[ind.id] = md
-        for node in ind.nodes:
-            if node not in augmented_samples:
-                reference_sets_map[md["CentreName"]].append(node)
-                all_samples.append(node)
-    reference_set_names = list(reference_sets_map.keys())
-    reference_sets = [reference_sets_map[key] for key in reference_set_names]
-
-    cols = {
-        "centre": [
-            ind_metadata[ts.node(u).individual]["CentreName"] for u in all_samples
-        ],
-        "sample_id": [
-            ind_metadata[ts.node(u).individual]["SampleID"] for u in all_samples
-        ],
-        "ethnicity": [
-            ind_metadata[ts.node(u).individual]["Ethnicity"] for u in all_samples
-        ],
-    }
-    print("Computing GNNs for ", len(all_samples), "samples")
-    before = time.time()
-    A = ts.genealogical_nearest_neighbours(
-        all_samples, reference_sets, num_threads=args.num_threads
-    )
-    duration = time.time() - before
-    print("Done in {:.2f} mins".format(duration / 60))
 
-    for j, name in enumerate(reference_set_names):
-        cols[name] = A[:, j]
-    df = pd.DataFrame(cols)
-    df.to_csv(args.output)
+# Number of rows of GNN proportions written to the output at a time.
+GNN_BLOCK_SIZE = 10000
 
+# The individual metadata keys holding the sample name in each dataset, in order
+# of preference.
+GNN_INDIVIDUAL_KEYS = {
+    "1kg": ["individual_id", "name"],
+    "sgdp": ["sgdp_id"],
+    "hgdp": ["sample"],
+    "hgdp_1kg_sgdp": [],
+}
 
-def run_compute_1kg_gnn(args):
-    ts = tskit.load(args.input)
 
-    population_name = []
-    region_name = []
-
-    for population in ts.populations():
-        md = json.loads(population.metadata.decode())
-        name = md["name"]
-        population_name.append(name)
-        if "super_population" in md:
-            region_name.append(md["super_population"])
-        elif "region" in md:
-            region_name.append(md["region"])
-        elif "name" in md:
-            region_name.append(md["name"])
-
-    population = []
-    region = []
-    individual = []
-    for j, u in enumerate(ts.samples()):
-        node = ts.node(u)
-        ind = json.loads(ts.individual(node.individual).metadata.decode())
-        if "individual_id" in ind:
-            individual.append(ind["individual_id"])
-        elif "name" in ind:
-            individual.append(ind["name"])
-        population.append(population_name[node.population])
-        region.append(region_name[node.population])
+def decode_metadata_column(metadata, metadata_offset):
+    """
+    Returns an object array of the decoded JSON metadata of every row of a table,
+    with empty metadata decoded as an empty dict.
+    """
+    values = np.empty(len(metadata_offset) - 1, dtype=object)
+    for j, md in enumerate(tskit.unpack_bytes(metadata, metadata_offset)):
+        values[j] = json.loads(md.decode()) if len(md) > 0 else {}
+    return values
 
-    sample_sets = [ts.samples(pop) for pop in range(ts.num_populations)]
-    print("Computing GNNs")
-    before = time.time()
-    A = ts.genealogical_nearest_neighbours(
-        ts.samples(), sample_sets, num_threads=args.num_threads
-    )
-    duration = time.time() - before
-    print("Done in {:.2f} mins".format(duration / 60))
 
-    cols = {population_name[j]: A[:, j] for j in range(ts.num_populations)}
-    cols["population"] = population
-    cols["region"] = region
-    cols["individual"] = individual
-    df = pd.DataFrame(cols)
-    df.to_csv(args.output)
+def metadata_field(metadata, keys):
+    """
+    Returns an object array of the value of the first of keys present in each of
+    the metadata dicts, or None if none are present.
+    """
+    values = np.full(len(metadata), None, dtype=object)
+    for j, md in enumerate(metadata):
+        for key in keys:
+            if key in md:
+                values[j] = md[key]
+                break
+    return values
 
 
-def run_compute_sgdp_gnn(args):
-    ts = tskit.load(args.input)
+def get_windows(ts, window_size=None):
+    """
+    Returns the list of (left, right) genomic windows of the specified size, or
+    the whole sequence if window_size is None.
+    """
+    if window_size is None:
+        return [(0, ts.sequence_length)]
+    breaks = list(np.arange(0, ts.sequence_length, window_size)) + [ts.sequence_length]
+    return list(zip(breaks[:-1], breaks[1:]))
 
-    population_name = []
-    region_name = []
-
-    for population in ts.populations():
-        md = json.loads(population.metadata.decode())
-        name = md["name"]
-        population_name.append(name)
-        region_name.append(md["region"])
-
-    population = []
-    region = []
-    individual = []
-    for j, u in enumerate(ts.samples()):
-        node = ts.node(u)
-        ind = json.loads(ts.individual(node.individual).metadata.decode())
-        individual.append(ind["sgdp_id"])
-        population.append(population_name[node.population])
-        region.append(region_name[node.population])
 
-    sample_sets = [ts.samples(pop) for pop in range(ts.num_populations)]
-    print("Computing GNNs")
+def compute_gnn(ts, focal, reference_sets, num_threads, block_size=None, windows=None):
+    """
+    Computes the GNN proportions of the focal nodes with respect to the reference
+    sets in each window, and yields tuples (left, right, start, A) where A is the
+    matrix for focal[start: start + block_size] in the window [left, right). The
+    GNN of each focal node only depends on the trees, so computing it in blocks
+    gives the same values as computing it for all nodes at once. Each block is a
+    separate pass over all the trees, though, so the run time grows with the
+    number of blocks: only set block_size when the full focal by reference set
+    matrix does not fit in memory. By default all focal nodes are computed in
+    one pass.
+    """
+    if windows is None:
+        windows = [(0, ts.sequence_length)]
+    if block_size is None:
+        block_size = max(1, len(focal))
+    for left, right in windows:
+        window_ts = ts
+        if (left, right) != (0, ts.sequence_length):
+            window_ts = ts.keep_intervals([[left, right]], simplify=False).trim()
+        for start in range(0, len(focal), block_size):
+            A = window_ts.genealogical_nearest_neighbours(
+                focal[start: start + block_size],
+                reference_sets,
+                num_threads=num_threads,
+            )
+            yield left, right, start, A
+
+
+def gnn_frames(
+    blocks, reference_set_names, columns, windowed=False, metadata_first=False
+):
+    """
+    Yields DataFrames of at most GNN_BLOCK_SIZE rows for the blocks from
+    compute_gnn, with a column of GNN proportions for each reference set and the
+    slices of the per-focal node metadata columns. The metadata columns follow
+    the GNN columns unless metadata_first is True.
+    """
+    row = 0
+    for left, right, block_start, A in blocks:
+        for offset in range(0, A.shape[0], GNN_BLOCK_SIZE):
+            proportions = A[offset: offset + GNN_BLOCK_SIZE]
+            start = block_start + offset
+            n = proportions.shape[0]
+            cols = {}
+            if windowed:
+                cols["window_left"] = np.full(n, left)
+                cols["window_right"] = np.full(n, right)
+            gnn_cols = {
+                name: proportions[:, j] for j, name in enumerate(reference_set_names)
+            }
+            metadata_cols = {
+                name: values[start: start + n] for name, values in columns.items()
+            }
+            if metadata_first:
+                cols.update(metadata_cols)
+                cols.update(gnn_cols)
+            else:
+                cols.update(gnn_cols)
+                cols.update(metadata_cols)
+            yield pd.DataFrame(cols, index=np.arange(row, row + n))
+            row += n
+
+
+def create_column_array(group, name, dtype):
+    """
+    Creates an empty one-dimensional array in the zarr group to append a column
+    of the specified dtype to, using the API of the installed zarr version. Object
+    columns are stored as variable length strings.
+    """
+    if hasattr(group, "create_array"):
+        # zarr >= 3
+        return group.create_array(
+            name,
+            shape=(0,),
+            chunks=(GNN_BLOCK_SIZE,),
+            dtype=str if dtype == object else dtype,
+        )
+    return group.create_dataset(
+        name,
+        shape=(0,),
+        chunks=(GNN_BLOCK_SIZE,),
+        dtype=dtype,
+        object_codec=numcodecs.VLenUTF8() if dtype == object else None,
+    )
+
+
+def write_frames(output, frames):
+    """
+    Writes the data frames to output as they are produced, so that only one
+    block is in memory at a time. If output ends with ".zarr", each column is
+    appended to an array of the same name in a zarr group; otherwise the frames
+    are appended to a CSV file.
+    """
+    group = None
+    for j, df in enumerate(frames):
+        if output.endswith(".zarr"):
+            # Non-numeric columns are stored as variable length strings.
+            columns = {}
+            for name, column in df.items():
+                values = column.to_numpy()
+                if values.dtype.kind not in "biuf":
+                    values = values.astype(str).astype(object)
+                columns[name] = values
+            if group is None:
+                group = zarr.open_group(output, mode="w")
+                for name, values in columns.items():
+                    create_column_array(group, name, values.dtype)
+            for name, values in columns.items():
+                group[name].append(values)
+        else:
+            df.to_csv(output, mode="w" if j == 0 else "a", header=j == 0)
+
+
+def run_gnn(
+    args, ts, focal, reference_sets, reference_set_names, columns, metadata_first=False
+):
+    print("Computing GNNs for ", len(focal), "samples")
     before = time.time()
-    A = ts.genealogical_nearest_neighbours(
-        ts.samples(), sample_sets, num_threads=args.num_threads
+    windows = get_windows(ts, args.window_size)
+    blocks = compute_gnn(
+        ts, focal, reference_sets, args.num_threads, args.block_size, windows
+    )
+    frames = gnn_frames(
+        blocks,
+        reference_set_names,
+        columns,
+        windowed=args.window_size is not None,
+        metadata_first=metadata_first,
     )
+    write_frames(args.output, frames)
     duration = time.time() - before
     print("Done in {:.2f} mins".format(duration / 60))
 
-    cols = {population_name[j]: A[:, j] for j in range(ts.num_populations)}
-    cols["population"] = population
-    cols["region"] = region
-    cols["individual"] = individual
-    df = pd.DataFrame(cols)
-    df.to_csv(args.output)
-
 
-def run_compute_hgdp_gnn(args):
+def run_compute_ukbb_gnn(args):
     ts = tskit.load(args.input)
-
-    population_name = []
-    region_name = []
-
-    for population in ts.populations():
-        md = json.loads(population.metadata.decode())
-        name = md["name"]
-        population_name.append(name)
-        region_name.append(md["region"])
-
-    population = []
-    region = []
-    individual = []
-    for j, u in enumerate(ts.samples()):
-        node = ts.node(u)
-        ind = json.loads(ts.individual(node.individual).metadata.decode())
-        individual.append(ind["sample"])
-        population.append(population_name[node.population])
-        region.append(region_name[node.population])
-
-    sample_sets = [ts.samples(pop) for pop in range(ts.num_populations)]
-    print("Computing GNNs")
+    tables = ts.tables
     before = time.time()
-    A = ts.genealogical_nearest_neighbours(
-        ts.samples(), sample_sets, num_threads=args.num_threads
+    augmented_samples = load_augmented_samples(
+        args.input, tables, cache=args.cache_augmented
     )
     duration = time.time() - before
-    print("Done in {:.2f} mins".format(duration / 60))
+    print("Got augmented:", len(augmented_samples), "in ", duration)
 
-    cols = {population_name[j]: A[:, j] for j in range(ts.num_populations)}
-    cols["population"] = population
-    cols["region"] = region
-    cols["individual"] = individual
-    df = pd.DataFrame(cols)
-    df.to_csv(args.output)
+    ind_metadata = decode_metadata_column(
+        tables.individuals.metadata, tables.individuals.metadata_offset
+    )
+    # The nodes of each individual in turn, leaving out augmented samples.
+    node_individual = tables.nodes.individual
+    nodes = np.where(node_individual != tskit.NULL)[0].astype(np.int32)
+    nodes = nodes[np.argsort(node_individual[nodes], kind="stable")]
+    nodes = nodes[~np.isin(nodes, augmented_samples)]
+    individual = node_individual[nodes]
+
+    columns = {
+        "centre": metadata_field(ind_metadata, ["CentreName"])[individual],
+        "sample_id": metadata_field(ind_metadata, ["SampleID"])[individual],
+        "ethnicity": metadata_field(ind_metadata, ["Ethnicity"])[individual],
+    }
+    # One reference set per centre, in order of first appearance.
+    names, first, reference_set = np.unique(
+        columns["centre"].astype(str), return_index=True, return_inverse=True
+    )
+    order = np.argsort(first)
+    reference_set_names = list(names[order])
+    reference_sets = [nodes[reference_set == j] for j in order]
+    # The UKBB output has always had the metadata columns first.
+    run_gnn(
+        args,
+        ts,
+        nodes,
+        reference_sets,
+        reference_set_names,
+        columns,
+        metadata_first=True,
+    )
 
 
-def run_compute_hgdp_1kg_sgdp_gnn(args):
+def run_compute_gnn(args):
+    """
+    Computes the GNN proportions of all samples with respect to the samples of
+    each population, for the 1kg, sgdp, hgdp and hgdp_1kg_sgdp tree sequences.
+    """
     ts = tskit.load(args.input)
+    tables = ts.tables
+    pop_metadata = decode_metadata_column(
+        tables.populations.metadata, tables.populations.metadata_offset
+    )
+    population_name = metadata_field(pop_metadata, ["name"])
+    region_name = metadata_field(pop_metadata, ["super_population", "region", "name"])
+
+    samples = ts.samples()
+    population = tables.nodes.population[samples]
+    columns = {
+        "population": population_name[population],
+        "region": region_name[population],
+    }
+    individual_keys = GNN_INDIVIDUAL_KEYS[args.dataset]
+    if len(individual_keys) > 0:
+        ind_metadata = decode_metadata_column(
+            tables.individuals.metadata, tables.individuals.metadata_offset
+        )
+        individual = tables.nodes.individual[samples]
+        individual_name = metadata_field(ind_metadata, individual_keys)
+        columns["individual"] = individual_name[individual]
 
-    population_name = []
-    region_name = []
+    sample_sets = [ts.samples(pop) for pop in range(ts.num_populations)]
+    run_gnn(args, ts, samples, sample_sets, list(population_name), columns)
 
-    for population in ts.populations():
-        md = json.loads(population.metadata.decode())
-        name = md["name"]
-        population_name.append(name)
 
-        if "super_population" in md:
-            region_name.append(md["super_population"])
-        elif "region" in md:
-            region_name.append(md["region"])
+def sites_alleles(sd):
+    """
+    Returns an object array of the list of alleles of each site, leaving out the
+    None that marks sites with missing data.
+    """
+    alleles = np.empty(sd.num_sites, dtype=object)
+    for j, site_alleles in enumerate(sd.sites_alleles[:]):
+        alleles[j] = [allele for allele in site_alleles if allele is not None]
+    return alleles
 
-    population = []
-    region = []
-    for j, u in enumerate(ts.samples()):
-        node = ts.node(u)
-        population.append(population_name[node.population])
-        region.append(region_name[node.population])
 
-    sample_sets = [ts.samples(pop) for pop in range(ts.num_populations)]
-    print("Computing GNNs")
-    before = time.time()
-    A = ts.genealogical_nearest_neighbours(
-        ts.samples(), sample_sets, num_threads=args.num_threads
-    )
-    duration = time.time() - before
-    print("Done in {:.2f} mins".format(duration / 60))
+# The sorted site positions of the target file, shared with the workers of
+# make_sampledata_compatible.
+target_positions = None
 
-    cols = {population_name[j]: A[:, j] for j in range(ts.num_populations)}
-    cols["population"] = population
-    cols["region"] = region
-    df = pd.DataFrame(cols)
-    df.to_csv(args.output)
+# Number of kept sites whose genotypes are read and written at a time.
+SUBSET_BLOCK_SIZE = 10000
 
 
-def make_sampledata_compatible(args):
+def init_compatible_worker(positions):
+    global target_positions
+    target_positions = positions
+
+
+def write_sites_subset(sd, keep_sites, path, block_size, command):
     """
-    Make a list of sampledata files compatible with the first file.
+    Writes the specified sites of the sampledata file, with all its individuals, to
+    a new sampledata file at path (in memory if path is None), reading and writing
+    the genotypes a block of sites at a time. Returns the new file.
     """
-
-    # Load all the sampledata files into a list
-    print(
-        "Subset sites with {} sampledata files".format(len(args.input_sampledata) - 1)
+    position = sd.sites_position[:]
+    alleles = sites_alleles(sd)
+    metadata = sd.sites_metadata[:]
+    time = sd.sites_time[:]
+    with tsinfer.SampleData(path=path, sequence_length=sd.sequence_length) as subset:
+        for population in sd.populations():
+            subset.add_population(population.metadata)
+        for individual in sd.individuals():
+            subset.add_individual(
+                location=individual.location,
+                metadata=individual.metadata,
+                time=individual.time,
+                population=individual.population,
+                ploidy=len(individual.samples),
+                flags=individual.flags,
+            )
+        for start in range(0, len(keep_sites), block_size):
+            sites = keep_sites[start: start + block_size]
+            genotypes = sd.sites_genotypes.get_orthogonal_selection(
+                (sites, slice(None))
+            )
+            for site, site_genotypes in zip(sites, genotypes):
+                subset.add_site(
+                    position=position[site],
+                    genotypes=site_genotypes,
+                    alleles=alleles[site],
+                    metadata=metadata[site],
+                    time=time[site],
+                )
+        for timestamp, record in sd.provenances():
+            subset.add_provenance(timestamp, record)
+        subset.record_provenance(command=command)
+    return subset
+
+
+def subset_to_target(job):
+    """
+    Writes the sites of the specified sampledata file that are also in the target
+    file to a ".subset.samples" file beside it. Nothing is written if there are no
+    such sites, as a sampledata file must have at least one site, and the returned
+    name is None.
+    """
+    fn, block_size = job
+    cur_sd = tsinfer.load(fn)
+    position = cur_sd.sites_position[:]
+    index = np.searchsorted(target_positions, position)
+    # Positions beyond the last target site, or any position if the target has
+    # no sites, get the index len(target_positions).
+    keep_sites = np.where(index < len(target_positions))[0]
+    keep_sites = keep_sites[target_positions[index[keep_sites]] == position[keep_sites]]
+    if len(keep_sites) == 0:
+        return fn, None, 0
+    newname = fn[: -len(".samples")] + ".subset.samples"
+    write_sites_subset(
+        cur_sd, keep_sites, newname, block_size, "make-sampledata-compatible"
     )
-    for index, fn in enumerate(args.input_sampledata):
-        fn = fn.rstrip("\n")
-        if index == 0:
-            target_sd = tsinfer.load(fn)
-            print("Loaded First sampledata file")
-            continue
-        cur_sd = tsinfer.load(fn)
-        print("Loaded sampledata file # {}".format(index))
-        keep_sites = np.where(
-            np.isin(cur_sd.sites_position[:], target_sd.sites_position[:])
-        )[0]
-        print("Subsetting to {} sites".format(len(keep_sites)))
-        small_cur_sd = cur_sd.subset(sites=keep_sites)
-        print("Done with subset")
-        newname = fn[: -len(".samples")] + ".subset.samples"
-        small_cur_sd_copy = small_cur_sd.copy(newname)
-        small_cur_sd_copy.finalise()
-        print(
-            "Subsetted to {} sites from {}. Output can be found at {}.".format(
-                len(keep_sites), fn, newname
+    return fn, newname, len(keep_sites)
+
+
+def make_sampledata_compatible(args):
+    """
+    Make a list of sampledata files compatible with the first file. The site
+    positions of the first file are read once and shared with a pool of workers,
+    each of which subsets one of the other files.
+    """
+    fns = [fn.rstrip("\n") for fn in args.input_sampledata]
+    print("Subset sites with {} sampledata files".format(len(fns) - 1))
+    target_sd = tsinfer.load(fns[0])
+    positions = target_sd.sites_position[:]
+    print("Loaded First sampledata file")
+    num_processes = args.num_threads if args.num_threads > 0 else max(1, len(fns) - 1)
+    jobs = [(fn, args.block_size) for fn in fns[1:]]
+    with multiprocessing.Pool(
+        processes=num_processes,
+        initializer=init_compatible_worker,
+        initargs=(positions,),
+    ) as pool:
+        for fn, newname, num_sites in pool.imap(subset_to_target, jobs):
+            if newname is None:
+                print("No sites of {} are in the target file, skipping.".format(fn))
+                continue
+            print(
+                "Subsetted to {} sites from {}. Output can be found at {}.".format(
+                    num_sites, fn, newname
+                )
             )
-        )
 
 
 def add_indiv_times(args):
@@ -419,31 +891,143 @@ def add_indiv_times(args):
     copy.finalise()
 
 
+# Number of merged sites whose genotypes are assembled and written at a time.
+MERGE_BLOCK_SIZE = 10000
+
+
+def align_sites(samples):
+    """
+    Aligns the sites of all the sampledata files by position. Returns the sorted
+    union of their site positions and an array holding, for each file, the index
+    of its site at each of these positions or -1 if it has none.
+    """
+    positions = [sd.sites_position[:] for sd in samples]
+    merged = np.unique(np.concatenate(positions))
+    site_index = np.full((len(samples), len(merged)), -1, dtype=np.int64)
+    for j, position in enumerate(positions):
+        site_index[j, np.searchsorted(merged, position)] = np.arange(len(position))
+    return merged, site_index
+
+
+def merge_site_attributes(samples, site_index):
+    """
+    Returns the metadata, time and alleles of the merged sites, and for each file a
+    dictionary mapping the merged sites whose alleles it orders differently to the
+    new index of each of its alleles. Metadata and time come from the first file
+    holding the site; the alleles of later files are appended in order, as when
+    merging the files one at a time. Sites whose ancestral state or time differ
+    between files are an error.
+    """
+    num_sites = site_index.shape[1]
+    source = np.argmax(site_index >= 0, axis=0)
+    metadata = np.empty(num_sites, dtype=object)
+    time = np.zeros(num_sites)
+    alleles = np.empty(num_sites, dtype=object)
+    file_alleles = []
+    for j, sd in enumerate(samples):
+        rows = np.where(source == j)[0]
+        index = site_index[j, rows]
+        metadata[rows] = sd.sites_metadata[:][index]
+        time[rows] = sd.sites_time[:][index]
+        file_alleles.append(sites_alleles(sd))
+        alleles[rows] = file_alleles[j][index]
+    remaps = []
+    for j, sd in enumerate(samples):
+        remap = {}
+        rows = np.where((site_index[j] >= 0) & (source != j))[0]
+        index = site_index[j, rows]
+        other_alleles = file_alleles[j][index]
+        ancestral = np.array([a[0] for a in alleles[rows]])
+        other_ancestral = np.array([a[0] for a in other_alleles])
+        if np.any(ancestral != other_ancestral) or not np.array_equal(
+            time[rows], sd.sites_time[:][index], equal_nan=True
+        ):
+            raise ValueError("Merged sites must have the same ancestral_state and time")
+        for row, site_alleles in zip(rows, other_alleles):
+            if site_alleles != alleles[row]:
+                merged_alleles = list(alleles[row])
+                for allele in site_alleles:
+                    if allele not in merged_alleles:
+                        merged_alleles.append(allele)
+                alleles[row] = merged_alleles
+                # The last entry leaves missing data unchanged.
+                remap[row] = np.array(
+                    [merged_alleles.index(allele) for allele in site_alleles]
+                    + [tskit.MISSING_DATA],
+                    dtype=np.int8,
+                )
+        remaps.append(remap)
+    return metadata, time, alleles, remaps
+
+
 def merge_sampledata_files(args):
+    """
+    Merges all the input sampledata files in a single pass: their sites are
+    aligned by position up front, and the genotypes of each block of merged sites
+    are assembled from all files at once and written to the output. Individuals
+    are added in input order, with missing data for the sites a file lacks.
+    """
     samples = []
     for cur_sample in args.input_sampledata:
         samples.append(tsinfer.load(cur_sample))
-    merged_samples = samples[0]
-    for index, other_samples in enumerate(samples[1:]):
-        print("Loaded sampledata file # {}".format(index))
-        intersect_sites = np.isin(
-            merged_samples.sites_position[:], other_samples.sites_position[:]
-        )
-        other_intersect_sites = np.where(
-            np.isin(other_samples.sites_position[:], merged_samples.sites_position[:])
-        )[0]
-        other_samples_metadata = other_samples.sites_metadata[:]
-        for site_index, site_metadata in zip(
-            other_intersect_sites, merged_samples.sites_metadata[:][intersect_sites]
-        ):
-            other_samples_metadata[site_index] = site_metadata
-        other_samples_copy = other_samples.copy()
-        other_samples_copy.sites_metadata[:] = other_samples_metadata
-        other_samples_copy.finalise()
-        merged_samples = merged_samples.merge(other_samples_copy)
-        print("Merged sampledata file # {}".format(index))
-    merged_copy = merged_samples.copy(args.output)
-    merged_copy.finalise()
+        print("Loaded sampledata file {}".format(cur_sample))
+    sequence_length = samples[0].sequence_length
+    if any(sd.sequence_length != sequence_length for sd in samples):
+        raise ValueError("Sample data files must have the same sequence length")
+    positions, site_index = align_sites(samples)
+    metadata, time, alleles, remaps = merge_site_attributes(samples, site_index)
+    print("Merging {} sites".format(len(positions)))
+    sample_offset = np.cumsum([0] + [sd.num_samples for sd in samples])
+
+    with tsinfer.SampleData(
+        path=args.output, sequence_length=sequence_length
+    ) as merged:
+        population_maps = []
+        for sd in samples:
+            population_map = {tskit.NULL: tskit.NULL}
+            for population in sd.populations():
+                population_map[population.id] = merged.add_population(
+                    population.metadata
+                )
+            population_maps.append(population_map)
+        for sd, population_map in zip(samples, population_maps):
+            for individual in sd.individuals():
+                merged.add_individual(
+                    location=individual.location,
+                    metadata=individual.metadata,
+                    time=individual.time,
+                    flags=individual.flags,
+                    population=population_map[individual.population],
+                    ploidy=len(individual.samples),
+                )
+        for start in tqdm.tqdm(range(0, len(positions), args.block_size)):
+            end = min(start + args.block_size, len(positions))
+            genotypes = np.full(
+                (end - start, sample_offset[-1]), tskit.MISSING_DATA, dtype=np.int8
+            )
+            for j, sd in enumerate(samples):
+                index = site_index[j, start:end]
+                rows = np.where(index >= 0)[0]
+                if len(rows) == 0:
+                    continue
+                # A file's sites within a block of merged sites are contiguous.
+                block = genotypes[:, sample_offset[j]: sample_offset[j + 1]]
+                block[rows] = sd.sites_genotypes[index[rows[0]]: index[rows[-1]] + 1]
+                for row in rows:
+                    if start + row in remaps[j]:
+                        block[row] = remaps[j][start + row][block[row]]
+            for k in range(end - start):
+                merged.add_site(
+                    position=positions[start + k],
+                    genotypes=genotypes[k],
+                    alleles=alleles[start + k],
+                    metadata=metadata[start + k],
+                    time=time[start + k],
+                )
+        for sd in samples:
+            for timestamp, record in sd.provenances():
+                merged.add_provenance(timestamp, record)
+        merged.record_provenance(command="merge-sampledata-files")
 
 
 def remove_moderns_reich(args):
@@ -456,25 +1040,217 @@ def remove_moderns_reich(args):
     copy.finalise()
 
 
-def remove_outliers(args):
-    tree_seq = tskit.load(args.ts) 
+def tree_site_stats(ts):
+    """
+    Returns the number of mutations at each site of the tree sequence, and the
+    parsimony excess: the number of mutations beyond one per distinct derived
+    state, which is the fewest that could explain the site.
+    """
+    tables = ts.tables
+    site = tables.mutations.site
+    num_mutations = np.bincount(site, minlength=ts.num_sites)
+    states = tskit.unpack_strings(
+        tables.mutations.derived_state, tables.mutations.derived_state_offset
+    )
+    ancestral = tskit.unpack_strings(
+        tables.sites.ancestral_state, tables.sites.ancestral_state_offset
+    )
+    codes, uniques = pd.factorize(np.array(ancestral + states, dtype=object))
+    state = codes[ts.num_sites:]
+    # Mutations back to the ancestral state add no new allele.
+    derived = state != codes[site]
+    pairs = np.unique(site[derived] * len(uniques) + state[derived])
+    num_derived = np.bincount(pairs // len(uniques), minlength=ts.num_sites)
+    return num_mutations, num_mutations - num_derived
+
+
+def sample_site_stats(samples, block_size):
+    """
+    Returns the derived allele frequency among the non-missing samples and the
+    fraction of missing samples at each site, reading the genotypes a block of
+    sites at a time.
+    """
+    num_derived = np.zeros(samples.num_sites)
+    num_missing = np.zeros(samples.num_sites)
+    for start in tqdm.tqdm(range(0, samples.num_sites, block_size)):
+        genotypes = samples.sites_genotypes[start: start + block_size]
+        num_derived[start: start + len(genotypes)] = np.sum(genotypes > 0, axis=1)
+        num_missing[start: start + len(genotypes)] = np.sum(
+            genotypes == tskit.MISSING_DATA, axis=1
+        )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        frequency = num_derived / (samples.num_samples - num_missing)
+    return frequency, num_missing / samples.num_samples
+
+
+def ts_site_index(position, ts):
+    """
+    Returns the index in the sorted sampledata site positions of each site of the
+    tree sequence, raising a ValueError if any of them is not in the sampledata.
+    """
+    ts_position = ts.tables.sites.position
+    index = np.searchsorted(position, ts_position)
+    # Sites beyond the last sampledata position get the index len(position).
+    if np.any(index == len(position)) or not np.array_equal(
+        position[index], ts_position
+    ):
+        raise ValueError("Tree sequence sites must all be in the sampledata file")
+    return index
+
+
+def site_qc(ts, samples, args):
+    """
+    Returns a DataFrame of the QC statistics and filter results for each site of
+    the sampledata file, computed along with the tree sequence inferred from it.
+    The "remove" column marks the sites failing any of the filters.
+    """
+    position = samples.sites_position[:]
+    # The tree sequence statistics are held against the samples sites, with NaN
+    # for sites that are not in the tree sequence.
+    ts_site = ts_site_index(position, ts)
+    stats = pd.DataFrame({"position": position})
+    num_mutations, parsimony_excess = tree_site_stats(ts)
+    for name, values in [
+        ("num_mutations", num_mutations),
+        ("parsimony_excess", parsimony_excess),
+    ]:
+        stats[name] = np.nan
+        stats.loc[ts_site, name] = values
+    stats["frequency"], stats["missing"] = sample_site_stats(samples, args.block_size)
+
+    # Mutation count outliers are relative to the sites with any mutations.
+    mutated = stats.num_mutations[stats.num_mutations > 0]
+    print("Mean number of muts per site: ", mutated.mean())
+    print("Std number of muts per site: ", mutated.std(ddof=0))
+    filters = {
+        "outlier": stats.num_mutations
+        > mutated.mean() + args.max_mutations_sd * mutated.std(ddof=0)
+    }
+    if args.max_mutations is not None:
+        filters["max_mutations"] = stats.num_mutations > args.max_mutations
+    if args.max_parsimony_excess is not None:
+        filters["parsimony_excess"] = stats.parsimony_excess > args.max_parsimony_excess
+    if args.min_frequency is not None:
+        filters["min_frequency"] = stats.frequency < args.min_frequency
+    if args.max_frequency is not None:
+        filters["max_frequency"] = stats.frequency > args.max_frequency
+    if args.max_missing is not None:
+        filters["missing"] = stats.missing > args.max_missing
+    stats["remove"] = False
+    for name, failed in filters.items():
+        print("Sites failing {}: {}".format(name, np.sum(failed)))
+        stats["fail_" + name] = failed
+        stats["remove"] |= failed
+    print("Number of sites removed: ", np.sum(stats.remove))
+    return stats
+
+
+def remove_qc_sites(ts, stats):
+    """
+    Returns the tree sequence without the sites marked for removal in the stats.
+    """
+    remove = stats.position[stats.remove].values
+    return ts.delete_sites(np.where(np.isin(ts.tables.sites.position, remove))[0])
+
+
+def run_site_qc(args):
+    """
+    Computes per-site QC statistics for a tree sequence and the sampledata file it
+    was inferred from, and removes the sites failing any of the filters from both.
+    The tree sequence is read once, and optionally preprocessed for tsdate first.
+    """
+    ts = tskit.load(args.ts)
+    if args.preprocess:
+        ts = tsdate.preprocess_ts(ts)
     samples = tsinfer.load(args.samples)
-    # Find number of mutations per site
-    muts_per_site = np.unique(tree_seq.tables.mutations.site, return_counts=True)
-    mean_muts_per_site = np.mean(muts_per_site[1])
-    std_muts_per_site = np.std(muts_per_site[1])
-    print("Mean number of muts per site: ", mean_muts_per_site)
-    print("Std number of muts per site: ", std_muts_per_site)
-    # Find outliers: greater than 3 standard deviations from the mean number of mutations
-    # per site
-    outliers = muts_per_site[1] > mean_muts_per_site + 3 * std_muts_per_site
-    # Remove outlier sites from tree sequence and sampledata files
-    tree_seq = tree_seq.delete_sites(np.where(muts_per_site[0][outliers])[0])
-    tree_seq.dump(args.output_ts)
-    samples_subset = samples.subset(sites=np.where(muts_per_site[0][~outliers])[0])
-    samples_subset_copy = samples_subset.copy(args.output_samples)
-    samples_subset_copy.finalise()
-    print(" Number of muts removed: ", np.sum(outliers))
+    stats = site_qc(ts, samples, args)
+    if args.output_stats is not None:
+        stats.to_csv(args.output_stats, index=False)
+    if args.output_ts is not None:
+        remove_qc_sites(ts, stats).dump(args.output_ts)
+    if args.output_samples is not None:
+        keep_sites = np.where(~stats.remove)[0]
+        write_sites_subset(
+            samples, keep_sites, args.output_samples, args.block_size, "site-qc"
+        )
+
+
+def pipeline_simplify(state, args):
+    state["ts"] = state["ts"].simplify()
+
+
+def pipeline_preprocess(state, args):
+    state["ts"] = tsdate.preprocess_ts(state["ts"])
+
+
+def pipeline_site_qc(state, args):
+    stats = site_qc(state["ts"], state["samples"], args)
+    if args.output_stats is not None:
+        stats.to_csv(args.output_stats, index=False)
+    state["ts"] = remove_qc_sites(state["ts"], stats)
+    keep_sites = np.where(~stats.remove)[0]
+    state["samples"] = write_sites_subset(
+        state["samples"], keep_sites, None, args.block_size, "site-qc"
+    )
+
+
+def pipeline_date(state, args):
+    state["ts"] = tsdate.date(
+        state["ts"],
+        args.Ne,
+        mutation_rate=args.mutation_rate,
+        progress=args.progress,
+        num_threads=args.num_threads,
+        ignore_oldest_root=args.ignore_oldest,
+    )
+
+
+def pipeline_dated_samples(state, args):
+    # Sites that are not in the tree sequence keep their times.
+    copy = state["samples"].copy()
+    sites_time = copy.sites_time[:]
+    ts_site = ts_site_index(copy.sites_position[:], state["ts"])
+    sites_time[ts_site] = tsdate.get_sites_time(state["ts"])
+    copy.sites_time[:] = sites_time
+    copy.finalise()
+    state["samples"] = copy
+
+
+# The steps of the pipeline command, and whether each needs the sampledata file.
+PIPELINE_STEPS = {
+    "simplify": (pipeline_simplify, False),
+    "preprocess": (pipeline_preprocess, False),
+    "site-qc": (pipeline_site_qc, True),
+    "date": (pipeline_date, False),
+    "dated-samples": (pipeline_dated_samples, True),
+}
+
+
+def run_pipeline(args):
+    """
+    Runs the specified steps in turn in this process, passing the tree sequence
+    and sampledata file from each step to the next in memory. Only the final tree
+    sequence and sampledata file are written, if output files are given for them.
+    The peak memory of each step is sampled while it runs, and so includes the
+    objects handed on from earlier steps.
+    """
+    needs_samples = any(PIPELINE_STEPS[step][1] for step in args.steps)
+    if needs_samples and args.samples is None:
+        raise ValueError("The site-qc and dated-samples steps need --samples")
+    state = {"ts": tskit.load(args.ts), "samples": None}
+    if args.samples is not None:
+        state["samples"] = tsinfer.load(args.samples)
+    records = []
+    for step in args.steps:
+        record = {"stage": step}
+        run_stage(record, PIPELINE_STEPS[step][0], state, args)
+        records.append(record)
+    print(pd.DataFrame(records).set_index("stage").to_string())
+    if args.output_ts is not None:
+        state["ts"].dump(args.output_ts)
+    if args.output_samples is not None:
+        copy = state["samples"].copy(args.output_samples)
+        copy.finalise()
 
 
 def combined_ts_constrained_samples(args):
@@ -494,6 +1270,39 @@ def combined_ts_constrained_samples(args):
     high_cov_samples_copy.finalise()
 
 
+def add_site_qc_arguments(subparser):
+    subparser.add_argument(
+        "--max-mutations-sd",
+        type=float,
+        default=3,
+        help="Remove sites with more mutations than this many standard deviations \
+            above the mean.",
+    )
+    subparser.add_argument(
+        "--max-mutations", type=int, help="Remove sites with more mutations"
+    )
+    subparser.add_argument(
+        "--max-parsimony-excess",
+        type=int,
+        help="Remove sites with more mutations beyond one per derived allele",
+    )
+    subparser.add_argument(
+        "--min-frequency", type=float, help="Remove sites with lower derived frequency"
+    )
+    subparser.add_argument(
+        "--max-frequency", type=float, help="Remove sites with higher derived frequency"
+    )
+    subparser.add_argument(
+        "--max-missing", type=float, help="Remove sites with more missing data"
+    )
+    subparser.add_argument(
+        "--block-size",
+        type=int,
+        default=SUBSET_BLOCK_SIZE,
+        help="Number of sites whose genotypes are read at a time.",
+    )
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -515,57 +1324,113 @@ def main():
     subparser.add_argument("input", type=str, help="Input tree sequence")
     subparser.add_argument("--num-threads", type=int, default=0)
     subparser.add_argument("--seed", type=int, default=1)
-    subparser.set_defaults(func=run_sequential_augment)
-
-    subparser = subparsers.add_parser("benchmark-tskit")
-    subparser.add_argument("input", type=str, help="Input tree sequence")
     subparser.add_argument(
-        "--num-variants",
-        type=int,
-        default=None,
-        help="Number of variants to benchmark genotypes decoding performance on",
+        "--restart",
+        action="store_true",
+        help="Ignore the stages recorded in the manifest and start from scratch.",
     )
-    subparser.set_defaults(func=run_benchmark_tskit)
-
-    subparser = subparsers.add_parser("benchmark-vcf")
-    subparser.add_argument("input", type=str, help="Input VCF")
-    subparser.add_argument(
-        "--num-variants",
-        type=int,
-        default=None,
-        help="Number of variants to benchmark genotypes decoding performance on",
-    )
-    subparser.set_defaults(func=run_benchmark_vcf)
-
-    subparser = subparsers.add_parser("compute-ukbb-gnn")
-    subparser.add_argument("input", type=str, help="Input tree sequence")
-    subparser.add_argument("output", type=str, help="Filename to write CSV to.")
-    subparser.add_argument("--num-threads", type=int, default=16)
-    subparser.set_defaults(func=run_compute_ukbb_gnn)
-
-    subparser = subparsers.add_parser("compute-1kg-gnn")
-    subparser.add_argument("input", type=str, help="Input tree sequence")
-    subparser.add_argument("output", type=str, help="Filename to write CSV to.")
-    subparser.add_argument("--num-threads", type=int, default=16)
-    subparser.set_defaults(func=run_compute_1kg_gnn)
-
-    subparser = subparsers.add_parser("compute-sgdp-gnn")
-    subparser.add_argument("input", type=str, help="Input tree sequence")
-    subparser.add_argument("output", type=str, help="Filename to write CSV to.")
-    subparser.add_argument("--num-threads", type=int, default=16)
-    subparser.set_defaults(func=run_compute_sgdp_gnn)
+    subparser.set_defaults(func=run_sequential_augment)
 
-    subparser = subparsers.add_parser("compute-hgdp-gnn")
-    subparser.add_argument("input", type=str, help="Input tree sequence")
-    subparser.add_argument("output", type=str, help="Filename to write CSV to.")
-    subparser.add_argument("--num-threads", type=int, default=16)
-    subparser.set_defaults(func=run_compute_hgdp_gnn)
+    tskit_benchmarks = ["load", "trees", "variants", "haplotypes", "simplify", "gnn"]
+    vcf_benchmarks = ["header", "records", "genotypes"]
+    for command, benchmarks in [
+        ("benchmark-tskit", tskit_benchmarks),
+        ("benchmark-vcf", vcf_benchmarks),
+    ]:
+        subparser = subparsers.add_parser(command)
+        if command == "benchmark-tskit":
+            subparser.add_argument("input", type=str, help="Input tree sequence")
+            subparser.add_argument(
+                "--num-haplotypes",
+                type=int,
+                default=None,
+                help="Number of haplotypes to benchmark haplotype decoding on",
+            )
+            subparser.add_argument(
+                "--num-focal",
+                type=int,
+                default=100,
+                help="Number of random samples to compute GNNs for",
+            )
+            subparser.add_argument("--num-threads", type=int, default=0)
+            subparser.add_argument("--seed", type=int, default=1)
+            subparser.set_defaults(func=run_benchmark_tskit)
+        else:
+            subparser.add_argument("input", type=str, help="Input VCF")
+            subparser.set_defaults(func=run_benchmark_vcf)
+        subparser.add_argument(
+            "--num-variants",
+            type=int,
+            default=None,
+            help="Number of variants to benchmark genotypes decoding performance on",
+        )
+        subparser.add_argument(
+            "--benchmarks",
+            nargs="+",
+            choices=benchmarks,
+            default=None,
+            help="The benchmarks to run; defaults to all of them.",
+        )
+        subparser.add_argument(
+            "--repeats",
+            type=int,
+            default=3,
+            help="Number of times to run each benchmark. The first run is cold.",
+        )
+        subparser.add_argument(
+            "--output", type=str, default=None, help="JSON file to write results to."
+        )
+        subparser.add_argument(
+            "--compare",
+            type=str,
+            default=None,
+            help="Compare the results to those in this JSON file, exiting with an \
+                error if any have regressed.",
+        )
+        subparser.add_argument(
+            "--threshold",
+            type=float,
+            default=BENCHMARK_THRESHOLD,
+            help="Fractional slowdown of the best time reported as a regression.",
+        )
 
-    subparser = subparsers.add_parser("compute-hgdp-1kg-sgdp-gnn")
-    subparser.add_argument("input", type=str, help="Input tree sequence")
-    subparser.add_argument("output", type=str, help="Filename to write CSV to.")
-    subparser.add_argument("--num-threads", type=int, default=16)
-    subparser.set_defaults(func=run_compute_hgdp_1kg_sgdp_gnn)
+    for dataset in ["ukbb", "1kg", "sgdp", "hgdp", "hgdp_1kg_sgdp"]:
+        subparser = subparsers.add_parser(
+            "compute-{}-gnn".format(dataset.replace("_", "-"))
+        )
+        subparser.add_argument("input", type=str, help="Input tree sequence")
+        subparser.add_argument(
+            "output",
+            type=str,
+            help="Filename to write CSV to, or a zarr group if it ends with .zarr.",
+        )
+        subparser.add_argument("--num-threads", type=int, default=16)
+        subparser.add_argument(
+            "--block-size",
+            type=int,
+            default=None,
+            help="Compute the GNNs of this many focal samples per pass over the \
+                trees, to bound memory. Each pass traverses all the trees, so \
+                the run time grows with the number of blocks. By default all \
+                samples are computed in one pass.",
+        )
+        subparser.add_argument(
+            "--window-size",
+            type=float,
+            default=None,
+            help="Compute GNNs in genomic windows of this size rather than over \
+                the whole sequence.",
+        )
+        if dataset == "ukbb":
+            subparser.add_argument(
+                "--cache-augmented",
+                action="store_true",
+                help="Store the augmented sample IDs beside the input tree sequence \
+                    and reuse them on later runs.",
+            )
+            subparser.set_defaults(func=run_compute_ukbb_gnn)
+        else:
+            subparser.set_defaults(func=run_compute_gnn, dataset=dataset)
 
     subparser = subparsers.add_parser("make-sampledata-compatible")
     subparser.add_argument(
@@ -575,6 +1440,18 @@ def main():
         help="Input sample files to merge.",
         required=True,
     )
+    subparser.add_argument(
+        "--num-threads",
+        type=int,
+        default=0,
+        help="Number of worker processes. Defaults to one per file to subset.",
+    )
+    subparser.add_argument(
+        "--block-size",
+        type=int,
+        default=SUBSET_BLOCK_SIZE,
+        help="Number of sites whose genotypes are written at a time.",
+    )
     subparser.set_defaults(func=make_sampledata_compatible)
 
     subparser = subparsers.add_parser("output-indiv-times")
@@ -595,6 +1472,12 @@ def main():
         required=True,
     )
     subparser.add_argument("--output", type=str, required=True)
+    subparser.add_argument(
+        "--block-size",
+        type=int,
+        default=MERGE_BLOCK_SIZE,
+        help="Number of merged sites whose genotypes are written at a time.",
+    )
     subparser.set_defaults(func=merge_sampledata_files)
 
     subparser = subparsers.add_parser("remove-moderns-reich")
@@ -606,20 +1489,60 @@ def main():
     subparser.add_argument("output", type=str, help="Output sampledata file name")
     subparser.set_defaults(func=remove_moderns_reich)
 
-    subparser = subparsers.add_parser("remove-outliers")
+    # remove-outliers is the old name of site-qc, whose default filters are the
+    # 3 standard deviation mutation count threshold it applied.
+    subparser = subparsers.add_parser("site-qc", aliases=["remove-outliers"])
+    subparser.add_argument("--ts", type=str, help="Input tree sequence", required=True)
+    subparser.add_argument(
+        "--samples", type=str, help="Input sampledata file", required=True
+    )
+    subparser.add_argument("--output-ts", type=str, help="Output tree sequence")
     subparser.add_argument(
-        "--samples", type=str, help="Sampledata filename"
+        "--output-samples", type=str, help="Output sampledata filename"
     )
     subparser.add_argument(
-        "--ts", type=str, help="Inferred Tree Sequence.",
+        "--output-stats", type=str, help="CSV file to write per-site statistics to"
     )
+    subparser.add_argument(
+        "--preprocess",
+        action="store_true",
+        help="Run tsdate preprocessing on the tree sequence before the QC.",
+    )
+    add_site_qc_arguments(subparser)
+    subparser.set_defaults(func=run_site_qc)
+
+    subparser = subparsers.add_parser("pipeline")
+    subparser.add_argument("--ts", type=str, help="Input tree sequence", required=True)
+    subparser.add_argument("--samples", type=str, help="Input sampledata file")
+    subparser.add_argument(
+        "--steps",
+        nargs="+",
+        choices=list(PIPELINE_STEPS.keys()),
+        required=True,
+        help="The steps to run, in order.",
+    )
+    subparser.add_argument("--output-ts", type=str, help="Output tree sequence")
     subparser.add_argument(
         "--output-samples", type=str, help="Output sampledata filename"
     )
     subparser.add_argument(
-        "--output-ts", type=str, help="Output tree sequence filename"
+        "--output-stats", type=str, help="CSV file to write site-qc statistics to"
+    )
+    add_site_qc_arguments(subparser)
+    subparser.add_argument(
+        "--Ne", type=float, default=10000, help="Effective population size for tsdate"
+    )
+    subparser.add_argument(
+        "-m", "--mutation-rate", type=float, default=1e-8, help="Mutation rate"
+    )
+    subparser.add_argument(
+        "--ignore-oldest",
+        action="store_true",
+        help="Ignore the oldest root when dating, as tsdate date --ignore-oldest.",
     )
-    subparser.set_defaults(func=remove_outliers)
+    subparser.add_argument("-t", "--num-threads", type=int, default=0)
+    subparser.add_argument("-p", "--progress", action="store_true")
+    subparser.set_defaults(func=run_pipeline)
 
     subparser = subparsers.add_parser("combined-ts-dated-samples")
     subparser.add_argument(
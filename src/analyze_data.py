@@ -3,11 +3,11 @@ Analyses real data in all-data directory. Outputs csvs for
 plotting in plot.py
 """
 import argparse
+import collections
 import os.path
 import json
-import itertools
-import operator
 import pickle
+import shutil
 
 import numpy as np
 import pandas as pd
@@ -28,31 +28,25 @@ def get_relate_tgp_age_df():
     #    if path.exists("all-data/1kg_chr20_relate_mutation_ages_geometric.csv"):
     #        relate_ages = pd.read_csv("all-data/1kg_chr20_relate_mutation_ages_geometric.csv", index_col=0)
     #    else:
-    relate_ts = tskit.load("/home/jk/large_files/relate/relate_chr20_metdata.trees")
+    relate_file = "/home/jk/large_files/relate/relate_chr20_metdata.trees"
+    relate_ts = tskit.load(relate_file)
+    annotations = load_mutation_annotations(relate_file, relate_ts)
     relate_mut_ages, relate_mut_upper_bound, mut_ids = get_mut_ages(
-        relate_ts, unconstrained=False, geometric=False
+        relate_ts,
+        unconstrained=False,
+        geometric=False,
+        parents=annotations["parent"],
     )
-    relate_frequencies = get_site_frequencies(relate_ts)
     relate_ages = pd.DataFrame(
         {
-            "position": relate_ts.tables.sites.position[
-                relate_ts.tables.mutations.site
-            ][mut_ids],
+            "position": relate_ts.tables.sites.position[annotations["site"]][mut_ids],
             "relate_age": relate_mut_ages,
             "relate_upper_bound": relate_mut_upper_bound,
-            "relate_ancestral_allele": np.array(
-                tskit.unpack_strings(
-                    relate_ts.tables.sites.ancestral_state,
-                    relate_ts.tables.sites.ancestral_state_offset,
-                )
-            )[relate_ts.tables.mutations.site][mut_ids],
-            "relate_derived_allele": np.array(
-                tskit.unpack_strings(
-                    relate_ts.tables.mutations.derived_state,
-                    relate_ts.tables.mutations.derived_state_offset,
-                )
-            )[mut_ids],
-            "relate_frequency": relate_frequencies,
+            "relate_ancestral_allele": annotations["ancestral_state"][
+                annotations["site"]
+            ][mut_ids],
+            "relate_derived_allele": annotations["derived_state"][mut_ids],
+            "relate_frequency": annotations["frequency"],
         }
     )
     relate_ages.to_csv("all-data/1kg_chr20_relate_mutation_ages_geometric.csv")
@@ -81,51 +75,38 @@ def get_geva_tgp_age_df():
 
 
 def get_tsdate_tgp_age_df():
-    if os.path.exists(
-        """all-data/tsdate_ages_1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.
-            simplified.dated.insideoutside.trees"""
-    ):
-        tsdate_ages = pd.read_csv(
-            """all-data/tsdate_ages_1kg_chr20.iter.dated.
-                binned_ma0.1_ms0.1_NNone_p16.simplified.dated.insideoutside.trees""",
-            index_col=0,
-        )
+    ts_file = (
+        "all-data/1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified."
+        "dated.insideoutside.trees"
+    )
+    ages_file = (
+        "all-data/tsdate_ages_1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16."
+        "simplified.dated.insideoutside.trees"
+    )
+    if os.path.exists(ages_file):
+        tsdate_ages = pd.read_csv(ages_file, index_col=0)
 
     else:
 
-        tgp_chr20 = tskit.load(
-            """all-data/1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.
-            dated.insideoutside.trees"""
-        )
+        tgp_chr20 = tskit.load(ts_file)
+        annotations = load_mutation_annotations(ts_file, tgp_chr20)
 
         posterior_mut_ages, posterior_upper_bound, oldest_mut_nodes = get_mut_ages(
-            tgp_chr20, unconstrained=False
+            tgp_chr20, unconstrained=False, parents=annotations["parent"]
         )
-        site_frequencies = get_site_frequencies(tgp_chr20)
         tsdate_ages = pd.DataFrame(
             {
                 "position": tgp_chr20.tables.sites.position,
                 "tsdate_age": posterior_mut_ages,
                 "tsdate_upper_bound": posterior_upper_bound,
-                "tsdate_frequency": site_frequencies,
-                "tsdate_ancestral_allele": np.array(
-                    tskit.unpack_strings(
-                        tgp_chr20.tables.sites.ancestral_state,
-                        tgp_chr20.tables.sites.ancestral_state_offset,
-                    )
-                ),
-                "tsdate_derived_allele": np.array(
-                    tskit.unpack_strings(
-                        tgp_chr20.tables.mutations.derived_state,
-                        tgp_chr20.tables.mutations.derived_state_offset,
-                    )
-                )[oldest_mut_nodes],
+                "tsdate_frequency": annotations["frequency"],
+                "tsdate_ancestral_allele": annotations["ancestral_state"],
+                "tsdate_derived_allele": annotations["derived_state"][
+                    oldest_mut_nodes
+                ],
             }
         )
-        tsdate_ages.to_csv(
-            """all-data/tsdate_ages_1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.
-            simplified.dated.insideoutside.trees"""
-        )
+        tsdate_ages.to_csv(ages_file)
     return tsdate_ages
 
 
@@ -155,28 +136,155 @@ def tgp_date_estimates(args):
     merged.to_csv("all-data/tgp_mutations.csv")
 
 
-def get_site_frequencies(ts):
+def get_allele_indexes(ts):
+    """
+    Returns the index of each mutation's derived state in the alleles of its site's
+    variant: 0 for the ancestral state, then the derived states in the order they
+    first appear among the site's mutations.
+    """
+    tables = ts.tables
+    site = tables.mutations.site
+    ancestral = np.array(
+        tskit.unpack_strings(
+            tables.sites.ancestral_state, tables.sites.ancestral_state_offset
+        ),
+        dtype=object,
+    )
+    mutations = pd.DataFrame(
+        {
+            "site": site,
+            "state": tskit.unpack_strings(
+                tables.mutations.derived_state, tables.mutations.derived_state_offset
+            ),
+        }
+    )
+    derived = mutations[mutations.state.values != ancestral[site]]
+    derived = derived.drop_duplicates(["site", "state"])
+    index = derived.groupby("site").cumcount() + 1
+    alleles = dict(zip(zip(derived.site, derived.state), index))
+    return np.array(
+        [alleles.get(key, 0) for key in zip(mutations.site, mutations.state)],
+        dtype=np.int64,
+    )
+
+
+def get_mutation_sample_counts(ts):
+    """
+    Returns the number of samples below each mutation's node in the tree at its
+    site, whether each mutation is on an isolated sample, and the number of
+    isolated samples at each site, in a single pass over the trees.
+    """
+    tables = ts.tables
+    mutations = tables.mutations
+    is_sample = np.zeros(ts.num_nodes, dtype=bool)
+    is_sample[ts.samples()] = True
+    # The sites and mutations in each tree are contiguous ranges of the tables.
+    site_bounds = np.searchsorted(tables.sites.position, list(ts.breakpoints()))
+    mut_bounds = np.searchsorted(mutations.site, site_bounds)
+    mutation_node = mutations.node
+    num_below = np.zeros(ts.num_mutations, dtype=np.int64)
+    isolated = np.zeros(ts.num_mutations, dtype=bool)
+    num_isolated = np.zeros(ts.num_sites, dtype=np.int64)
+    for tree in tqdm(ts.trees(), total=ts.num_trees, desc="Count mutation samples"):
+        first_site, last_site = site_bounds[tree.index], site_bounds[tree.index + 1]
+        if first_site == last_site:
+            continue
+        num_isolated[first_site:last_site] = sum(
+            1 for root in tree.roots if is_sample[root] and tree.is_leaf(root)
+        )
+        for j in range(mut_bounds[tree.index], mut_bounds[tree.index + 1]):
+            node = mutation_node[j]
+            num_below[j] = tree.num_samples(node)
+            isolated[j] = (
+                is_sample[node] and tree.is_leaf(node) and tree.parent(node) == -1
+            )
+    return num_below, isolated, num_isolated
+
+
+def get_site_frequencies(ts, sample_counts=None):
     """
     Calculate frequency of each site and return numpy 1d array of len num_mutations
     with frequency as values. This assumes that if there are multiple mutations at a
     site they are recurrent.
+
+    The frequency is the sum of the genotypes over the number of samples, as when
+    decoding variants, but it is computed from the number of samples below each
+    mutation. The samples inheriting each mutation are those below its node less
+    those below the mutations nested beneath it, and isolated samples without a
+    mutation count as missing data (-1). sample_counts is the output of
+    get_mutation_sample_counts, which is computed if not given.
     """
-    site_freq = np.zeros(ts.num_sites)
-    for var in tqdm(ts.variants(), total=ts.num_sites, desc="Get mutation frequencies"):
-        site_freq[var.site.id] = np.sum(var.genotypes) / ts.num_samples
-    return site_freq
+    mutations = ts.tables.mutations
+    if sample_counts is None:
+        sample_counts = get_mutation_sample_counts(ts)
+    num_below, isolated, num_missing = sample_counts
+    num_missing = num_missing.copy()
+    has_parent = mutations.parent != tskit.NULL
+    num_inherited = num_below - np.bincount(
+        mutations.parent[has_parent],
+        weights=num_below[has_parent],
+        minlength=ts.num_mutations,
+    )
+    # Isolated samples with mutations above them are not missing.
+    isolated_nodes = np.unique(
+        np.stack([mutations.site[isolated], mutations.node[isolated]]), axis=1
+    )
+    num_missing -= np.bincount(isolated_nodes[0], minlength=ts.num_sites)
+    genotype_sum = np.bincount(
+        mutations.site,
+        weights=num_inherited * get_allele_indexes(ts),
+        minlength=ts.num_sites,
+    )
+    return (genotype_sum - num_missing) / ts.num_samples
+
+
+def get_mutation_parents(ts):
+    """
+    Returns the parent of each mutation's node in the tree at its site, or -1 if
+    the node is a root there. The edges are sorted by child and then left
+    coordinate, and the edge covering each mutation is found by binary search.
+    """
+    tables = ts.tables
+    edges = tables.edges
+    node = tables.mutations.node
+    if len(edges) == 0:
+        return np.full(len(node), tskit.NULL, dtype=np.int32)
+    position = tables.sites.position[tables.mutations.site]
+    # Rank the coordinates so that (child, left) pairs sort as exact integers.
+    coords = np.unique(np.concatenate([edges.left, position]))
+    edge_key = edges.child.astype(np.int64) * len(coords) + np.searchsorted(
+        coords, edges.left
+    )
+    order = np.argsort(edge_key)
+    mut_key = node.astype(np.int64) * len(coords) + np.searchsorted(coords, position)
+    index = order[np.maximum(np.searchsorted(edge_key[order], mut_key, "right") - 1, 0)]
+    covered = (
+        (edges.child[index] == node)
+        & (edges.left[index] <= position)
+        & (position < edges.right[index])
+    )
+    return np.where(covered, edges.parent[index], tskit.NULL)
 
 
-def get_mut_ages(ts, unconstrained=True, ignore_sample_muts=False, geometric=True):
+def get_mut_ages(
+    ts, unconstrained=True, ignore_sample_muts=False, geometric=True, parents=None
+):
+    """
+    Returns the age of the oldest mutation at each site, the age of the parent
+    node above it and its ID, with zeros for sites with no mutations. parents is
+    the parent node of each mutation, which is computed if not given.
+    """
     mut_ages = np.zeros(ts.num_sites)
     mut_upper_bounds = np.zeros(ts.num_sites)
-    node_ages = ts.tables.nodes.time
+    node_ages = ts.tables.nodes.time.copy()
     oldest_mut_ids = np.zeros(ts.num_sites)
     if unconstrained:
         metadata = ts.tables.nodes.metadata[:]
         metadata_offset = ts.tables.nodes.metadata_offset[:]
+        is_sample = np.zeros(ts.num_nodes, dtype=bool)
+        is_sample[ts.samples()] = True
         for index, met in enumerate(tskit.unpack_bytes(metadata, metadata_offset)):
-            if index not in ts.samples():
+            if not is_sample[index]:
                 node_ages[index] = json.loads(met.decode())["mn"]
     if ignore_sample_muts:
         mutations_table = ts.tables.mutations
@@ -186,21 +294,104 @@ def get_mut_ages(ts, unconstrained=True, ignore_sample_muts=False, geometric=Tru
             np.isin(mutations_table.site, unique_sites),
             np.isin(mutations_table.node, ts.samples()),
         )
-    for tree in tqdm(ts.trees(), total=ts.num_trees, desc="Finding mutation ages"):
-        for site in tree.sites():
-            for mut in site.mutations:
-                parent_age = node_ages[tree.parent(mut.node)]
-                if geometric:
-                    age = np.sqrt(node_ages[mut.node] * parent_age)
-                else:
-                    age = (node_ages[mut.node] + parent_age) / 2
-                if mut_ages[site.id] < age:
-                    mut_upper_bounds[site.id] = parent_age
-                    mut_ages[site.id] = age
-                    oldest_mut_ids[site.id] = mut.id
+    mutations = ts.tables.mutations
+    if parents is None:
+        parents = get_mutation_parents(ts)
+    # As tree.parent returns -1 for roots, their parent age is that of the last node.
+    parent_age = node_ages[parents]
+    if geometric:
+        age = np.sqrt(node_ages[mutations.node] * parent_age)
+    else:
+        age = (node_ages[mutations.node] + parent_age) / 2
+    # The oldest mutation at each site, taking the first of any ties. Sites keep
+    # zeros unless a mutation is older than zero.
+    mut_id = np.where(age > 0)[0]
+    order = np.lexsort((mut_id, -age[mut_id], mutations.site[mut_id]))
+    mut_id = mut_id[order]
+    site = mutations.site[mut_id]
+    first = np.ones(len(mut_id), dtype=bool)
+    first[1:] = site[1:] != site[:-1]
+    mut_id = mut_id[first]
+    site = site[first]
+    mut_ages[site] = age[mut_id]
+    mut_upper_bounds[site] = parent_age[mut_id]
+    oldest_mut_ids[site] = mut_id
     return mut_ages, mut_upper_bounds, oldest_mut_ids.astype(int)
 
 
+def file_key(path):
+    """
+    Returns a key that changes when the specified file is rewritten: its size and
+    modification time, which only need a stat rather than reading the file.
+    """
+    stat = os.stat(path)
+    return "{}.{}".format(stat.st_size, stat.st_mtime_ns)
+
+
+def compute_mutation_annotations(ts):
+    """
+    Returns a dictionary of the per-mutation and per-site annotations used by the
+    analyses of dated tree sequences. Ages use the node times in the tree
+    sequence, with the parent of a root taken as the last node as in get_mut_ages.
+    """
+    tables = ts.tables
+    mutations = tables.mutations
+    node_time = tables.nodes.time
+    parents = get_mutation_parents(ts)
+    sample_counts = get_mutation_sample_counts(ts)
+    parent_time = node_time[parents]
+    return {
+        "site": mutations.site.copy(),
+        "parent": parents.astype(np.int32),
+        "parent_time": parent_time,
+        "geometric_age": np.sqrt(node_time[mutations.node] * parent_time),
+        "num_samples": sample_counts[0],
+        "derived_state": np.array(
+            tskit.unpack_strings(
+                mutations.derived_state, mutations.derived_state_offset
+            ),
+            dtype=str,
+        ),
+        "frequency": get_site_frequencies(ts, sample_counts),
+        "ancestral_state": np.array(
+            tskit.unpack_strings(
+                tables.sites.ancestral_state, tables.sites.ancestral_state_offset
+            ),
+            dtype=str,
+        ),
+    }
+
+
+def load_mutation_annotations(ts_file, ts=None):
+    """
+    Returns the annotations of the specified tree sequence file as a dictionary of
+    memory-mapped arrays. They are computed once and stored as one .npy file per
+    column in a directory next to the tree sequence, keyed by the size and
+    modification time of the file so that a changed file is annotated again.
+    """
+    store = "{}.{}.annotations".format(ts_file, file_key(ts_file))
+    if not os.path.exists(store):
+        if ts is None:
+            ts = tskit.load(ts_file)
+        annotations = compute_mutation_annotations(ts)
+        tmp_store = "{}.{}.tmp".format(store, os.getpid())
+        os.makedirs(tmp_store, exist_ok=True)
+        for name, values in annotations.items():
+            np.save(os.path.join(tmp_store, name + ".npy"), values)
+        try:
+            os.replace(tmp_store, store)
+        except OSError:
+            # A concurrent run stored the same annotations first; use its copy.
+            shutil.rmtree(tmp_store)
+            if not os.path.isdir(store):
+                raise
+    return {
+        filename[: -len(".npy")]: np.load(os.path.join(store, filename), mmap_mode="r")
+        for filename in os.listdir(store)
+        if filename.endswith(".npy")
+    }
+
+
 def get_ancient_constraints_tgp(args):
     if os.path.exists("all-data/1kg_ancients_only_chr20.samples"):
         ancient_samples = tsinfer.load("all-data/1kg_ancients_only_chr20.samples")
@@ -262,46 +453,36 @@ def get_ancient_constraints_tgp(args):
     tgp_muts_constraints.to_csv("all-data/tgp_muts_constraints.csv")
 
 
-def get_recurrent_mutations(ts):
+def get_recurrent_mutations(ts, num_below=None):
     """
-    Get number of mutations per site.
+    Get number of mutations per site: the number of sites with each count of
+    mutations, of mutations not above samples, and of mutations above more than
+    two samples, along with the number of samples below the mutations not above
+    samples at sites with two of them. num_below is the number of samples below
+    each mutation, which is computed if not given.
     """
-    mutations_sites = ts.tables.mutations.site
+    mutations = ts.tables.mutations
+    if num_below is None:
+        num_below = get_mutation_sample_counts(ts)[0]
+    mutations_sites = mutations.site
     muts_per_site = np.unique(mutations_sites, return_counts=True)[1]
     sites_by_muts = np.unique(muts_per_site, return_counts=True)[1]
 
     # Exclude mutations above samples, this is simplier as there are no singletons
-    mutations_sites = mutations_sites[~np.isin(ts.tables.mutations.node, ts.samples())]
-    muts_per_site = np.unique(mutations_sites, return_counts=True)[1]
-    sites_by_muts_nosamples = np.unique(muts_per_site, return_counts=True)[1]
-    # Exclude mutations above two samples
-    muts_non_sample_edge = np.where(~np.isin(ts.tables.mutations.node, ts.samples()))[0]
-    muts_non_sample_edge_set = set(muts_non_sample_edge)
-    mut_sites_nodouble = list()
-    for tree in ts.trees():
-        for site in tree.sites():
-            for mutation in site.mutations:
-                if tree.num_samples(mutation.node) > 2:
-                    mut_sites_nodouble.append(mutation.site)
-    unique_sites_counts_nodouble = np.unique(
-        np.array(mut_sites_nodouble), return_counts=True
-    )[1]
-    sites_by_muts_nodouble = np.unique(
-        unique_sites_counts_nodouble, return_counts=True
+    is_sample = np.zeros(ts.num_nodes, dtype=bool)
+    is_sample[ts.samples()] = True
+    non_sample = ~is_sample[mutations.node]
+    muts_per_site = np.bincount(mutations_sites[non_sample], minlength=ts.num_sites)
+    sites_by_muts_nosamples = np.unique(
+        muts_per_site[muts_per_site > 0], return_counts=True
     )[1]
+    # Exclude mutations above two samples
+    nodouble_per_site = np.unique(mutations_sites[num_below > 2], return_counts=True)[1]
+    sites_by_muts_nodouble = np.unique(nodouble_per_site, return_counts=True)[1]
 
-    # Tips below mutations at sites with two mutations
-    two_mutations_id = set(
-        muts_non_sample_edge[
-            np.where(np.unique(mutations_sites, return_counts=True)[1] == 2)[0]
-        ]
-    )
-    num_samples_muts = list()
-    for tree in ts.trees():
-        for site in tree.sites():
-            for mutation in site.mutations:
-                if mutation.id in two_mutations_id:
-                    num_samples_muts.append(tree.num_samples(mutation.node))
+    # Tips below mutations not above samples at sites with two of them
+    two_mutations = non_sample & (muts_per_site[mutations_sites] == 2)
+    num_samples_muts = list(num_below[two_mutations])
 
     return (
         sites_by_muts,
@@ -317,91 +498,61 @@ def get_mutations_by_sample():
     """
 
 
-def get_tgp_recurrent_mutations(args):
-    filename = os.path.join(
-        data_prefix,
-        """1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.dated.
-            insideoutside.trees""",
-    )
+# The tree sequence in the data directory and the output prefix of the recurrent
+# mutation counts for each dataset.
+RECURRENT_MUTATION_DATASETS = {
+    "tgp": (
+        "1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.dated."
+        "insideoutside.trees",
+        "data/1kg_chr20_ma0.1_ms0.1_p16",
+    ),
+    "hgdp": (
+        "hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.trees",
+        "data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify",
+    ),
+    "sgdp": ("sgdp_chr20.tsinferred.trees", "data/sgdp_chr20.tsinferred"),
+}
 
-    ts = tskit.load(filename)
+
+def write_recurrent_mutations(dataset):
+    filename, prefix = RECURRENT_MUTATION_DATASETS[dataset]
+    ts_file = os.path.join(data_prefix, filename)
+    ts = tskit.load(ts_file)
+    annotations = load_mutation_annotations(ts_file, ts)
     (
         recurrent_counts,
         recurrent_counts_nosamples,
         sites_by_muts_nodouble,
         recurrent_counts_two_muts,
-    ) = get_recurrent_mutations(ts)
+    ) = get_recurrent_mutations(ts, annotations["num_samples"])
     df = pd.DataFrame(recurrent_counts, columns=["recurrent_counts"])
-    df.to_csv("data/1kg_chr20_ma0.1_ms0.1_p16.recurrent_counts.csv")
+    df.to_csv(prefix + ".recurrent_counts.csv")
     df = pd.DataFrame(
         recurrent_counts_nosamples, columns=["recurrent_counts_nosamples"]
     )
-    df.to_csv("data/1kg_chr20_ma0.1_ms0.1_p16.recurrent_counts_nosamples.csv")
+    df.to_csv(prefix + ".recurrent_counts_nosamples.csv")
     df = pd.DataFrame(sites_by_muts_nodouble, columns=["recurrent_counts_nodouble"])
-    df.to_csv("data/1kg_chr20_ma0.1_ms0.1_p16.recurrent_counts_nodouble.csv")
+    df.to_csv(prefix + ".recurrent_counts_nodouble.csv")
 
     df = pd.DataFrame(recurrent_counts_two_muts, columns=["recurrent_counts_two_muts"])
-    df.to_csv("data/1kg_chr20_ma0.1_ms0.1_p16.recurrent_counts_nosamples_two_muts.csv")
+    df.to_csv(prefix + ".recurrent_counts_nosamples_two_muts.csv")
 
 
-def get_hgdp_recurrent_mutations(args):
-    filename = os.path.join(
-        data_prefix, "hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.trees"
-    )
+def get_tgp_recurrent_mutations(args):
+    write_recurrent_mutations("tgp")
 
-    ts = tskit.load(filename)
-    (
-        recurrent_counts,
-        recurrent_counts_nosamples,
-        sites_by_muts_nodouble,
-        recurrent_counts_two_muts,
-    ) = get_recurrent_mutations(ts)
-    df = pd.DataFrame(recurrent_counts, columns=["recurrent_counts"])
-    df.to_csv(
-        """data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.
-            recurrent_counts.csv"""
-    )
-    df = pd.DataFrame(
-        recurrent_counts_nosamples, columns=["recurrent_counts_nosamples"]
-    )
-    df.to_csv(
-        """data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.
-            recurrent_counts_nosamples.csv"""
-    )
-    df = pd.DataFrame(sites_by_muts_nodouble, columns=["recurrent_counts_nodouble"])
-    df.to_csv(
-        """data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.
-            recurrent_counts_nodouble.csv"""
-    )
 
-    df = pd.DataFrame(recurrent_counts_two_muts, columns=["recurrent_counts_two_muts"])
-    df.to_csv(
-        """data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.
-            recurrent_counts_nosamples_two_muts.csv"""
-    )
+def get_hgdp_recurrent_mutations(args):
+    write_recurrent_mutations("hgdp")
 
 
 def get_sgdp_recurrent_mutations(args):
-    filename = os.path.join(data_prefix, "sgdp_chr20.tsinferred.trees")
+    write_recurrent_mutations("sgdp")
 
-    ts = tskit.load(filename)
-    (
-        recurrent_counts,
-        recurrent_counts_nosamples,
-        sites_by_muts_nodouble,
-        recurrent_counts_two_muts,
-    ) = get_recurrent_mutations(ts)
-    df = pd.DataFrame(recurrent_counts, columns=["recurrent_counts"])
-    df.to_csv("data/sgdp_chr20.tsinferred.recurrent_counts.csv")
-    df = pd.DataFrame(
-        recurrent_counts_nosamples, columns=["recurrent_counts_nosamples"]
-    )
-    df.to_csv("data/sgdp_chr20.tsinferred.recurrent_counts_nosamples.csv")
-    df = pd.DataFrame(sites_by_muts_nodouble, columns=["recurrent_counts_nodouble"])
-    df.to_csv("data/sgdp_chr20.tsinferred.recurrent_counts_nodouble.csv")
 
-    df = pd.DataFrame(recurrent_counts_two_muts, columns=["recurrent_counts_two_muts"])
-    df.to_csv("data/sgdp_chr20.tsinferred.recurrent_counts_nosamples_two_muts.csv")
+def get_all_recurrent_mutations(args):
+    for dataset in RECURRENT_MUTATION_DATASETS:
+        write_recurrent_mutations(dataset)
 
 
 def min_site_times_ancients(args):
@@ -412,54 +563,49 @@ def min_site_times_ancients(args):
 
 
 class AncestralGeography:
+    """
+    Places each ancestral node at the geographic center of its children, weighted
+    by the span of the edges to them. Locations are averaged as unit vectors,
+    working up from the samples in batches of parents whose children all have
+    known locations.
+    """
+
     def __init__(self, ts):
         self.ts = ts
-        self.fixed_nodes = set(ts.samples())
+        self.fixed_nodes = np.zeros(ts.num_nodes, dtype=bool)
+        self.fixed_nodes[ts.samples()] = True
         self.locations = np.zeros((self.ts.num_nodes, 2))
 
-    def get_parent_age(self, edge):
-        times = self.ts.tables.nodes.time[:]
-        return times[operator.attrgetter("parent")(edge)]
-
-    def edges_by_parent_age_asc(self):
-        return itertools.groupby(self.ts.edges(), self.get_parent_age)
-
-    def edges_by_parent_asc(self):
+    def parent_batches(self, parents, children, starts):
         """
-        Return an itertools.groupby object of edges grouped by parent in ascending order
-        of the time of the parent. Since tree sequence properties guarantee that edges
-        are listed in nondecreasing order of parent time
-        (https://tskit.readthedocs.io/en/latest/data-model.html#edge-requirements)
-        we can simply use the standard edge order
+        Yields ranges of the parents, which are in nondecreasing order of time, in
+        which no parent is a child of another. starts is the index of the first
+        edge of each parent in children.
         """
-        return itertools.groupby(self.ts.edges(), operator.attrgetter("parent"))
-
-    def parents_in_epoch(parents):
-        return itertools.groupby(parents, operator.attrgetter("parent"))
-
-    def edge_span(self, edge):
-        return edge.right - edge.left
-
-    def average_edges(self, parent_edges):
-        parent = parent_edges[0]
-        edges = parent_edges[1]
-
-        child_spanfracs = list()
-        child_lats = list()
-        child_longs = list()
-
-        for edge in edges:
-            child_spanfracs.append(self.edge_span(edge))
-            child_lats.append(self.locations[edge.child][0])
-            child_longs.append(self.locations[edge.child][1])
-        val = utility.weighted_geographic_center(
-            child_lats, child_longs, np.ones_like(len(child_lats))
-        )
-        return parent, val
-
-    def get_ancestral_geography(self, pop_lats, pop_longs, show_progress=False):
+        rank = np.full(self.ts.num_nodes, -1)
+        rank[parents] = np.arange(len(parents))
+        # The last parent before each parent's children are all placed.
+        needs = np.maximum.reduceat(rank[children], starts)
+        start = 0
+        while start < len(parents):
+            end = start + 1
+            chunk_size = 1024
+            while end < len(parents):
+                blocked = np.flatnonzero(needs[end : end + chunk_size] >= start)
+                if len(blocked) > 0:
+                    end += blocked[0]
+                    break
+                end += chunk_size
+                chunk_size *= 2
+            end = min(end, len(parents))
+            yield start, end
+            start = end
+
+    def place_nodes(self, pop_lats, pop_longs, show_progress=False):
         """
-        Use dynamic programming to find approximate posterior to sample from
+        Places the samples and then the ancestral nodes, yielding the IDs of each
+        batch of nodes once their locations are set. The ancestral nodes are
+        yielded in nondecreasing order of time.
         """
 
         # Set lat and long for sample nodes
@@ -476,17 +622,120 @@ class AncestralGeography:
             else:
                 for node in indiv.nodes:
                     self.locations[node] = (indiv.location[0], indiv.location[1])
-        # Iterate through the nodes via groupby on parent node
-        for parent_edges in tqdm(
-            self.edges_by_parent_asc(),
-            total=self.ts.num_nodes,
-            disable=not show_progress,
-        ):
-            if parent_edges[0] not in self.fixed_nodes:
-                parent, val = self.average_edges(parent_edges)
-                self.locations[parent] = val
+        yield np.flatnonzero(self.fixed_nodes)
+        vectors = utility.geographic_to_unit_vectors(
+            self.locations[:, 0], self.locations[:, 1]
+        )
+        # Edges are sorted by parent time and then parent, so each parent's edges
+        # are contiguous and come after those of its children.
+        edges = self.ts.tables.edges
+        keep = ~self.fixed_nodes[edges.parent]
+        edge_parents = edges.parent[keep]
+        children = edges.child[keep]
+        spans = (edges.right - edges.left)[keep]
+        if len(edge_parents) == 0:
+            return
+        starts = np.flatnonzero(
+            np.concatenate([[True], edge_parents[1:] != edge_parents[:-1]])
+        )
+        parents = edge_parents[starts]
+        ends = np.append(starts[1:], len(edge_parents))
+        with tqdm(total=len(parents), disable=not show_progress) as progress:
+            for start, end in self.parent_batches(parents, children, starts):
+                first, last = starts[start], ends[end - 1]
+                weighted = vectors[children[first:last]] * spans[first:last, None]
+                sums = np.add.reduceat(weighted, starts[start:end] - first, axis=0)
+                lats, longs = utility.unit_vectors_to_geographic(sums)
+                batch = parents[start:end]
+                self.locations[batch, 0] = lats
+                self.locations[batch, 1] = longs
+                vectors[batch] = utility.geographic_to_unit_vectors(lats, longs)
+                progress.update(end - start)
+                yield batch
+
+    def get_ancestral_geography(self, pop_lats, pop_longs, show_progress=False):
+        """
+        Use dynamic programming to find approximate posterior to sample from
+        """
+        for _ in self.place_nodes(pop_lats, pop_longs, show_progress):
+            pass
         return self.locations
 
+    def node_spans(self):
+        """
+        Returns the span of the genome each node is ancestral to: the total span of
+        the edges above it, or for nodes that are only roots, of their longest edge
+        below.
+        """
+        edges = self.ts.tables.edges
+        spans = edges.right - edges.left
+        node_spans = np.bincount(
+            edges.child, weights=spans, minlength=self.ts.num_nodes
+        )
+        root_spans = np.zeros(self.ts.num_nodes)
+        np.maximum.at(root_spans, edges.parent, spans)
+        return np.where(node_spans > 0, node_spans, root_spans)
+
+    def write_epochs(
+        self,
+        pop_lats,
+        pop_longs,
+        epoch_length,
+        prefix,
+        grid_resolution=1,
+        show_progress=False,
+    ):
+        """
+        Places the nodes as in get_ancestral_geography, writing the nodes with
+        times in each epoch of epoch_length generations to prefix.epoch_<k>.npz as
+        soon as all of them are placed. Each file holds the epoch's node IDs,
+        times and locations, and the span-weighted density of the nodes on a
+        latitude/longitude grid of grid_resolution degrees. Every epoch up to the
+        oldest node is written, so that the files are contiguous animation frames.
+        """
+        times = self.ts.tables.nodes.time
+        node_spans = self.node_spans()
+        lat_bins = np.linspace(-90, 90, int(round(180 / grid_resolution)) + 1)
+        long_bins = np.linspace(-180, 180, int(round(360 / grid_resolution)) + 1)
+        pending = collections.defaultdict(list)
+        next_epoch = 0
+
+        def write_epoch(epoch):
+            nodes = pending.pop(epoch, [])
+            nodes = np.concatenate(nodes) if nodes else np.zeros(0, dtype=np.int32)
+            lats, longs = self.locations[nodes, 0], self.locations[nodes, 1]
+            density = np.histogram2d(
+                lats, longs, bins=[lat_bins, long_bins], weights=node_spans[nodes]
+            )[0]
+            np.savez_compressed(
+                "{}.epoch_{:04d}.npz".format(prefix, epoch),
+                start_time=epoch * epoch_length,
+                end_time=(epoch + 1) * epoch_length,
+                node=nodes.astype(np.int32),
+                time=times[nodes],
+                latitude=lats.astype(np.float32),
+                longitude=longs.astype(np.float32),
+                lat_bins=lat_bins,
+                long_bins=long_bins,
+                density=density.astype(np.float32),
+            )
+
+        placed = np.zeros(self.ts.num_nodes, dtype=bool)
+        for batch in self.place_nodes(pop_lats, pop_longs, show_progress):
+            placed[batch] = True
+            epochs = (times[batch] // epoch_length).astype(int)
+            for epoch in np.unique(epochs):
+                pending[epoch].append(batch[epochs == epoch])
+            # All later nodes are at least as old as the last of this batch.
+            if not self.fixed_nodes[batch[-1]]:
+                current_epoch = int(times[batch[-1]] // epoch_length)
+                for epoch in range(next_epoch, current_epoch):
+                    write_epoch(epoch)
+                next_epoch = max(next_epoch, current_epoch)
+        last_epoch = int(times[placed].max() // epoch_length) if np.any(placed) else -1
+        for epoch in range(next_epoch, last_epoch + 1):
+            write_epoch(epoch)
+
 
 def find_ancestral_geographies(args):
     """
@@ -521,6 +770,16 @@ def find_ancestral_geographies(args):
     pop_lats["Denisovan"] = 51.3975
     pop_longs["Denisovan"] = 84.67611111
     hgdp_sgdp_ancients_geo = AncestralGeography(hgdp_sgdp_ancients)
+    if args.epoch_length is not None:
+        hgdp_sgdp_ancients_geo.write_epochs(
+            pop_lats,
+            pop_longs,
+            args.epoch_length,
+            "all-data/hgdp_sgdp_ancients_ancestor_coordinates",
+            grid_resolution=args.grid_resolution,
+            show_progress=True,
+        )
+        return
     ancestor_coordinates = hgdp_sgdp_ancients_geo.get_ancestral_geography(
         pop_lats, pop_longs, show_progress=True
     )
@@ -638,42 +897,186 @@ def find_ancient_descendants(args):
     )
 
 
-def find_descent(ts, proxy_nodes, descent_cutoff, exclude_pop, ref_set_map, pop_names):
+def find_descent_intervals(ts, focal_nodes):
+    """
+    Returns a DataFrame of the maximal intervals over which each sample descends
+    from each of the focal nodes, with columns sample, left, right and focal. The
+    trees are visited once for all focal nodes: a focal node's descendants are
+    only recomputed in trees where an edge below it has changed, which is found
+    by walking up from the parents of the edges removed and inserted.
+    """
+    focal_nodes = np.unique(focal_nodes)
+    is_focal = np.zeros(ts.num_nodes, dtype=bool)
+    is_focal[focal_nodes] = True
+    is_sample = np.zeros(ts.num_nodes, dtype=bool)
+    is_sample[ts.samples()] = True
+    # The sorted descendant samples of each focal node and where their runs began.
+    descendants = {focal: np.zeros(0, dtype=np.int32) for focal in focal_nodes}
+    run_starts = {focal: np.zeros(0) for focal in focal_nodes}
+    intervals = []
+
+    def add_changed(tree, node, visited, changed):
+        while node != tskit.NULL and node not in visited:
+            visited.add(node)
+            if is_focal[node]:
+                changed.add(node)
+            node = tree.parent(node)
+
+    def end_runs(focal, ended, right):
+        samples = descendants[focal][ended]
+        intervals.append(
+            (samples, run_starts[focal][ended], np.full(len(samples), right), focal)
+        )
+
+    tree = tskit.Tree(ts)
+    for (left, _), edges_out, edges_in in tqdm(
+        ts.edge_diffs(), total=ts.num_trees, desc="Descent intervals"
+    ):
+        changed = set()
+        visited = set()
+        for edge in edges_out:
+            add_changed(tree, edge.parent, visited, changed)
+        tree.next()
+        visited = set()
+        for edge in edges_in:
+            add_changed(tree, edge.parent, visited, changed)
+        for focal in changed:
+            nodes = tree.preorder(focal)[1:]
+            samples = np.sort(nodes[is_sample[nodes]])
+            previous = descendants[focal]
+            index = np.searchsorted(previous, samples)
+            kept = index < len(previous)
+            kept[kept] = previous[index[kept]] == samples[kept]
+            end_runs(focal, ~np.isin(previous, samples), left)
+            starts = np.full(len(samples), left)
+            starts[kept] = run_starts[focal][index[kept]]
+            descendants[focal] = samples
+            run_starts[focal] = starts
+    for focal in focal_nodes:
+        end_runs(focal, slice(None), ts.sequence_length)
+    return pd.DataFrame(
+        {
+            "sample": np.concatenate([samples for samples, _, _, _ in intervals]),
+            "left": np.concatenate([lefts for _, lefts, _, _ in intervals]),
+            "right": np.concatenate([rights for _, _, rights, _ in intervals]),
+            "focal": np.concatenate(
+                [np.full(len(samples), focal) for samples, _, _, focal in intervals]
+            ),
+        }
+    )
+
+
+def rasterize_descent(ts, intervals, bin_size=1000, block_size=1024):
+    """
+    Returns a bit-packed array with a row for each sample and a bit for each
+    bin_size chunk of the genome, which is set where the sample descends from any
+    of the focal nodes of the intervals. Interval ends are rounded to the nearest
+    chunk. Rows are unpacked block_size samples at a time.
+    """
+    num_bins = int(ts.sequence_length / bin_size)
+    sample_index = np.zeros(ts.num_nodes, dtype=int)
+    sample_index[ts.samples()] = np.arange(ts.num_samples)
+    rows = sample_index[intervals["sample"].values]
+    starts = np.minimum(np.round(intervals["left"].values / bin_size), num_bins)
+    ends = np.minimum(np.round(intervals["right"].values / bin_size), num_bins)
+    order = np.argsort(rows, kind="stable")
+    rows, starts, ends = rows[order], starts[order].astype(int), ends[order].astype(int)
+    packed = np.zeros((ts.num_samples, (num_bins + 7) // 8), dtype=np.uint8)
+    for first in range(0, ts.num_samples, block_size):
+        last = min(first + block_size, ts.num_samples)
+        lo, hi = np.searchsorted(rows, [first, last])
+        # Mark the interval ends in a difference array and accumulate along rows.
+        changes = np.zeros((last - first, num_bins + 1), dtype=np.int32)
+        np.add.at(changes, (rows[lo:hi] - first, starts[lo:hi]), 1)
+        np.add.at(changes, (rows[lo:hi] - first, ends[lo:hi]), -1)
+        packed[first:last] = np.packbits(np.cumsum(changes[:, :-1], axis=1) > 0, axis=1)
+    return packed, num_bins
+
+
+def save_packed_descent(filename, packed, num_bins):
+    np.savez_compressed(filename, packed=packed, num_bins=num_bins)
+
+
+def load_packed_descent(filename, unpack=False):
+    """
+    Returns the packed descent array and its number of bins saved by
+    save_packed_descent, or the unpacked 0/1 array if unpack is True.
+    """
+    data = np.load(filename)
+    packed, num_bins = data["packed"], int(data["num_bins"])
+    if unpack:
+        return np.unpackbits(packed, axis=1, count=num_bins)
+    return packed, num_bins
+
+
+# The number of set bits in each byte value, for numpy without bitwise_count.
+BYTE_POPCOUNTS = np.array([bin(j).count("1") for j in range(256)], dtype=np.uint8)
+
+
+def popcount_rows(packed):
+    """
+    Returns the number of set bits in each row of a 2D bit-packed array, which
+    must be uint8 if numpy has no bitwise_count.
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(packed).sum(axis=1, dtype=np.int64)
+    return BYTE_POPCOUNTS[packed].sum(axis=1, dtype=np.int64)
+
+
+def packed_corrcoef(packed, num_bins):
+    """
+    Returns the Pearson correlation coefficients between the rows of a bit-packed
+    0/1 array, as np.corrcoef of the unpacked array. They are computed from the
+    number of set bits in each row and in each pair of rows; padding bits are 0
+    and so do not contribute.
+    """
+    words = packed
+    if hasattr(np, "bitwise_count"):
+        # Count 64 bits at a time.
+        num_bytes = (packed.shape[1] + 7) // 8 * 8
+        words = np.zeros((len(packed), num_bytes), dtype=np.uint8)
+        words[:, : packed.shape[1]] = packed
+        words = words.view(np.uint64)
+    counts = popcount_rows(words)
+    both = np.zeros((len(words), len(words)), dtype=np.int64)
+    for j in range(len(words)):
+        both[j, j:] = popcount_rows(words[j:] & words[j])
+        both[j:, j] = both[j, j:]
+    covariance = num_bins * both - np.outer(counts, counts)
+    variance = num_bins * counts - counts ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corrcoef = covariance / np.sqrt(np.outer(variance, variance))
+    return np.clip(corrcoef, -1, 1)
+
+
+def find_descent(
+    ts, proxy_nodes, descent_cutoff, exclude_pop, ref_set_map, pop_names, intervals
+):
     """
     Get genomic locations of descent from given ancestral nodes in 1Kb chunks
     Chunks are binary: 0 indicates no descent from proxy nodes, 1 indicates descent
     No differentation is given between descent from both proxy nodes or descent from
-    only one.
-    """
-
-    descendants_arr = np.zeros(
-        (ts.num_samples, int(ts.get_sequence_length() / 1000)), dtype=int
-    )
-    for focal_node in proxy_nodes:
-        for tree in tqdm(ts.trees()):
-            stack = list(tree.children(focal_node))
-            while len(stack) != 0:
-                cur_node = stack.pop()
-                if cur_node in ts.samples():
-                    descendants_arr[
-                        cur_node,
-                        int(np.round(tree.interval[0] / 1000)) : int(
-                            np.round(tree.interval[1] / 1000)
-                        ),
-                    ] = 1
-                for child in tree.children(cur_node):
-                    stack.append(child)
+    only one. intervals is the output of find_descent_intervals for a set of focal
+    nodes including the proxy nodes. The chunks are returned bit-packed, along with
+    their number.
+    """
+
+    packed, num_bins = rasterize_descent(
+        ts, intervals[np.isin(intervals["focal"].values, proxy_nodes)]
+    )
     high_descendants = ts.samples()[
-        np.where(np.sum(descendants_arr[ts.samples()], axis=1) > descent_cutoff)[0]
+        np.where(popcount_rows(packed) > descent_cutoff)[0]
     ]
     high_descendants = high_descendants[
         pop_names[ref_set_map[high_descendants]] != exclude_pop
     ]
+    sample_index = np.zeros(ts.num_nodes, dtype=int)
+    sample_index[ts.samples()] = np.arange(ts.num_samples)
     corrcoef_df = pd.DataFrame(
-        np.corrcoef(descendants_arr[high_descendants]),
+        packed_corrcoef(packed[sample_index[high_descendants]], num_bins),
         index=pop_names[ref_set_map[high_descendants]],
     )
-    return descendants_arr[ts.samples()], corrcoef_df, high_descendants
+    return packed, num_bins, corrcoef_df, high_descendants
 
 
 def find_ancient_descent_haplotypes(args):
@@ -692,170 +1095,47 @@ def find_ancient_descent_haplotypes(args):
     afanasievo_proxy = np.where(ts.tables.nodes.time == 164.01)[0]
     ref_set_map = np.loadtxt("data/combined_ts_reference_set_map.csv").astype(int)
     pop_names = np.genfromtxt("data/combined_ts_pop_names.csv", dtype="str")
-    (
-        afanasievo_descent_arr,
-        afanasievo_corrcoef_df,
-        afanasievo_descendants,
-    ) = find_descent(ts, afanasievo_proxy, 100, "Afanasievo", ref_set_map, pop_names)
-    np.savetxt("data/combined_ts_afanasievo_descent_arr.csv", afanasievo_descent_arr)
-    np.savetxt("data/combined_ts_afanasievo_descendants.csv", afanasievo_descendants)
-    afanasievo_corrcoef_df.to_csv("data/combined_ts_afanasievo_corrcoef_df.csv")
-    vindija_descent_arr, vindija_corrcoef_df, vindija_descendants = find_descent(
-        ts, vindija_proxy, 100, "vindija", ref_set_map, pop_names
-    )
-    np.savetxt("data/combined_ts_vindija_descent_arr.csv", vindija_descent_arr)
-    np.savetxt("data/combined_ts_vindija_descendants.csv", vindija_descendants)
-    vindija_corrcoef_df.to_csv("data/combined_ts_vindija_corrcoef_df.csv")
-    denisovan_descent_arr, denisovan_corrcoef_df, denisovan_descendants = find_descent(
-        ts, denisovan_proxy, 100, "denisovan", ref_set_map, pop_names
-    )
-    np.savetxt("data/combined_ts_denisovan_descent_arr.csv", denisovan_descent_arr)
-    np.savetxt("data/combined_ts_denisovan_descendants.csv", denisovan_descendants)
-    denisovan_corrcoef_df.to_csv("data/combined_ts_denisovan_corrcoef_df.csv")
-    (
-        chagyrskaya_descent_arr,
-        chagyrskaya_corrcoef_df,
-        chagyrskaya_descendants,
-    ) = find_descent(ts, chagyrskaya_proxy, 100, "chagyrskaya", ref_set_map, pop_names)
-    np.savetxt("data/combined_ts_chagyrskaya_descent_arr.csv", chagyrskaya_descent_arr)
-    np.savetxt("data/combined_ts_chagyrskaya_descendants.csv", chagyrskaya_descendants)
-    chagyrskaya_corrcoef_df.to_csv("data/combined_ts_chagyrskaya_corrcoef_df.csv")
-
-    altai_descent_arr, altai_corrcoef_df, altai_descendants = find_descent(
-        ts, altai_proxy, 500, "altai", ref_set_map, pop_names
+    intervals = find_descent_intervals(
+        ts,
+        np.concatenate(
+            [
+                afanasievo_proxy,
+                vindija_proxy,
+                denisovan_proxy,
+                chagyrskaya_proxy,
+                altai_proxy,
+            ]
+        ),
     )
-    np.savetxt("data/combined_ts_altai_descent_arr.csv", altai_descent_arr)
-    np.savetxt("data/combined_ts_altai_descendants.csv", altai_descendants)
-    altai_corrcoef_df.to_csv("data/combined_ts_altai_corrcoef_df.csv")
-
-
-def find_archaic_relationships(args):
-    ts = tskit.load(
-        "all-data/merged_hgdp_1kg_sgdp_high_cov_ancients_chr20.dated.binned.historic.snipped.trees"
-    )
-    tables = ts.tables
-    altai_proxy = np.where(ts.tables.nodes.time == 4400.01)[0]
-    chagyrskaya_proxy = np.where(ts.tables.nodes.time == 3200.01)[0]
-    altai = np.where(tables.nodes.population == ts.num_populations - 1)[0]
-    denisovan = np.where(tables.nodes.population == ts.num_populations - 4)[0]
-    denisovan_proxy = np.where(ts.tables.nodes.time == 2556.01)[0]
-    vindija = np.where(tables.nodes.population == ts.num_populations - 3)[0]
-    vindija_proxy = np.where(ts.tables.nodes.time == 2000.01)[0]
-    chagyrskaya = np.where(tables.nodes.population == ts.num_populations - 2)[0]
-    nonarchaic = ts.samples()[:-8]
-
-    # Descent from Vindija: straightforward descent in nonarchaic samples
-    # v=vindija, d=denisovan, c=chagyrskaya, a=altai, m=modern (nonarchaic)
-    v_descent = dict.fromkeys(["total_v_descent", "v_m"], 0)
-
-    for tree in tqdm(ts.trees(), desc="Vindija Descent"):
-        for node in vindija_proxy:
-            leaves = list(tree.leaves(node))
-            if len(leaves) > 1:
-                v_descent["total_v_descent"] += tree.span
-                if len(np.intersect1d(leaves, nonarchaic)) > 0:
-                    v_descent["v_m"] += tree.span
-                else:
-                    raise ValueError("Leaves must be younger than Vindija")
-            elif len(leaves) == 1:
-                assert leaves[0] in vindija_proxy or leaves[0] in vindija
-
-    # Chagyrskaya
-    arrows = ["c_v", "c_d", "c_m", "c_d_v", "c_d_m", "c_v_m"]
-    c_descent = dict.fromkeys(["total_c_descent"] + arrows, 0)
-
-    # Iterate over each tree in the tree sequence
-    for tree in tqdm(ts.trees(), desc="Chagyrskaya Descent"):
-        # Check both archaic chromosome copies
-        for node in chagyrskaya_proxy:
-            leaves = list(tree.leaves(node))
-            # Only investigate tree if > 1 leaves (otherwise check child is archaic)
-            if len(leaves) > 1:
-                # Dictionary of booleans to track of relationships seen at this tree
-                flags = dict.fromkeys(arrows, False)
-                # If any descent, add to total
-                c_descent["total_c_descent"] += tree.span
-                for leaf in leaves:
-                    # First check the c->d relationship
-                    if leaf in denisovan:
-                        flags["c_d"] = True
-                    # Next check vindija, which could be c->v or d->v
-                    elif leaf in vindija:
-                        denisovan_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in chagyrskaya_proxy:
-                            if parent in denisovan_proxy:
-                                denisovan_descendant = True
-                            parent = tree.parent(parent)
-                        # If denisovan is noted along path, then path is d->v
-                        if denisovan_descendant is True:
-                            flags["c_d_v"] = True
-                        # If no denisovan seen on path, then path is c->v
-                        else:
-                            flags["c_v"] = True
-                    # Enumerate possible paths if leaf is nonarchaic
-                    elif leaf in nonarchaic:
-                        vindija_descendant = False
-                        denisovan_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in chagyrskaya_proxy:
-                            if parent in vindija_proxy:
-                                vindija_descendant = True
-                            elif parent in denisovan_proxy:
-                                denisovan_descendant = True
-                            parent = tree.parent(parent)
-                        # If we see vindija, we assign relationship to v->m
-                        if vindija_descendant:
-                            flags["c_v_m"] = True
-                        # If we don't see vindija, but do see denisovan, then it's d->m
-                        elif (
-                            vindija_descendant is False and denisovan_descendant is True
-                        ):
-                            flags["c_d_m"] = True
-                        # If we don't see vindija or denisovan, it's c->m
-                        elif (
-                            vindija_descendant is False
-                            and denisovan_descendant is False
-                        ):
-                            flags["c_m"] = True
-                for path, flag in flags.items():
-                    if flag is True:
-                        c_descent[path] += tree.span
-            else:
-                assert leaves[0] in chagyrskaya or leaves[0] in chagyrskaya_proxy
-
-    # Denisovan
-    arrows = ["d_v", "d_m", "d_v_m"]
-    d_descent = dict.fromkeys(["total_d_descent"] + arrows, 0)
-
-    for tree in tqdm(ts.trees(), desc="Denisovan Descent"):
-        for node in denisovan_proxy:
-            leaves = list(tree.leaves(node))
-            if len(leaves) > 1:
-                flags = dict.fromkeys(arrows, False)
-                d_descent["total_d_descent"] += tree.span
-                for leaf in leaves:
-                    if leaf in vindija:
-                        flags["d_v"] = True
-                    elif leaf in nonarchaic:
-                        vindija_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in denisovan_proxy:
-                            if parent in vindija_proxy:
-                                vindija_descendant = True
-                            parent = tree.parent(parent)
-                        if vindija_descendant is True:
-                            flags["d_v_m"] = True
-                        else:
-                            flags["d_m"] = True
-                for path, flag in flags.items():
-                    if flag is True:
-                        d_descent[path] += tree.span
-            else:
-                assert leaves[0] in denisovan or leaves[0] in denisovan_proxy
-
-    # Altai
-    arrows = [
+    for name, proxy_nodes, descent_cutoff, exclude_pop in [
+        ("afanasievo", afanasievo_proxy, 100, "Afanasievo"),
+        ("vindija", vindija_proxy, 100, "vindija"),
+        ("denisovan", denisovan_proxy, 100, "denisovan"),
+        ("chagyrskaya", chagyrskaya_proxy, 100, "chagyrskaya"),
+        ("altai", altai_proxy, 500, "altai"),
+    ]:
+        packed, num_bins, corrcoef_df, descendants = find_descent(
+            ts,
+            proxy_nodes,
+            descent_cutoff,
+            exclude_pop,
+            ref_set_map,
+            pop_names,
+            intervals,
+        )
+        prefix = "data/combined_ts_" + name
+        save_packed_descent(prefix + "_descent_arr.npz", packed, num_bins)
+        np.savetxt(prefix + "_descendants.csv", descendants)
+        corrcoef_df.to_csv(prefix + "_corrcoef_df.csv")
+
+
+# Descent paths from each archaic: v=vindija, d=denisovan, c=chagyrskaya, a=altai,
+# m=modern (nonarchaic)
+ARCHAIC_ARROWS = {
+    "v": ["v_m"],
+    "c": ["c_v", "c_d", "c_m", "c_d_v", "c_d_m", "c_v_m"],
+    "d": ["d_v", "d_m", "d_v_m"],
+    "a": [
         "a_d",
         "a_c",
         "a_v",
@@ -866,84 +1146,155 @@ def find_archaic_relationships(args):
         "a_d_v",
         "a_d_m",
         "a_v_m",
-    ]
+    ],
+}
+# The leaf categories, in the order in which they are tested
+LEAF_CATEGORIES = ["c", "d", "v", "m"]
+# The bits of the archaic proxy nodes in the set of those on a path
+PROXY_BITS = {"v": 1, "d": 2, "c": 4, "a": 8}
 
-    a_descent = dict.fromkeys(["total_a_descent"] + arrows, 0)
-    for tree in tqdm(ts.trees(), desc="Altai Descent"):
-        for node in altai_proxy:
-            leaves = list(tree.leaves(node))
-            if len(leaves) > 1:
-                a_descent["total_a_descent"] += tree.span
-                flags = dict.fromkeys(arrows, False)
-                for leaf in leaves:
-                    if leaf in chagyrskaya:
-                        flags["a_c"] = True
-                    elif leaf in denisovan:
-                        flags["a_d"] = True
-                        parent = tree.parent(leaf)
-                        while parent not in altai_proxy:
-                            if parent in chagyrskaya_proxy:
-                                flags["a_c_d"] = True
-                            parent = tree.parent(parent)
-                    elif leaf in vindija:
-                        denisovan_descendant = False
-                        chagyrskaya_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in altai_proxy:
-                            if parent in denisovan_proxy:
-                                denisovan_descendant = True
-                            elif parent in chagyrskaya_proxy:
-                                chagyrskaya_descendant = True
-                            parent = tree.parent(parent)
-                        if denisovan_descendant and chagyrskaya_descendant is False:
-                            flags["a_d_v"] = True
-                        elif chagyrskaya_descendant and denisovan_descendant is False:
-                            flags["a_c_v"] = True
-                        elif (
-                            chagyrskaya_descendant is False
-                            and denisovan_descendant is False
-                        ):
-                            flags["a_v"] = True
-                    elif leaf in nonarchaic:
-                        denisovan_descendant = False
-                        chagyrskaya_descendant = False
-                        vindija_descendant = False
-                        parent = tree.parent(leaf)
-                        while parent not in altai_proxy:
-                            if parent in denisovan_proxy:
-                                denisovan_descendant = True
-                            elif parent in chagyrskaya_proxy:
-                                chagyrskaya_descendant = True
-                            elif parent in vindija_proxy:
-                                vindija_descendant = True
-                            parent = tree.parent(parent)
-                        if vindija_descendant:
-                            flags["a_v_m"] = True
-                        elif denisovan_descendant and vindija_descendant is False:
-                            flags["a_d_m"] = True
-                        elif (
-                            chagyrskaya_descendant
-                            and denisovan_descendant is False
-                            and vindija_descendant is False
-                        ):
-                            flags["a_c_m"] = True
-                        elif (
-                            chagyrskaya_descendant is False
-                            and denisovan_descendant is False
-                            and vindija_descendant is False
-                        ):
-                            flags["a_m"] = True
-                for path, flag in flags.items():
-                    if flag is True:
-                        a_descent[path] += tree.span
-            else:
-                assert leaves[0] in altai or leaves[0] in altai_proxy
+
+def archaic_path_arrows(archaic, category, proxies):
+    """
+    Returns the descent paths from the specified archaic's proxy node to a leaf of
+    the given category, where proxies is the set of other archaic proxy nodes
+    strictly between them.
+    """
+    if archaic == "v":
+        return ["v_m"] if category == "m" else []
+    if archaic == "c":
+        if category == "d":
+            return ["c_d"]
+        if category == "v":
+            return ["c_d_v"] if "d" in proxies else ["c_v"]
+        if category == "m":
+            if "v" in proxies:
+                return ["c_v_m"]
+            return ["c_d_m"] if "d" in proxies else ["c_m"]
+    if archaic == "d":
+        if category == "v":
+            return ["d_v"]
+        if category == "m":
+            return ["d_v_m"] if "v" in proxies else ["d_m"]
+    if archaic == "a":
+        if category == "c":
+            return ["a_c"]
+        if category == "d":
+            return ["a_d", "a_c_d"] if "c" in proxies else ["a_d"]
+        if category == "v":
+            if "d" in proxies and "c" not in proxies:
+                return ["a_d_v"]
+            if "c" in proxies and "d" not in proxies:
+                return ["a_c_v"]
+            if "c" not in proxies and "d" not in proxies:
+                return ["a_v"]
+        if category == "m":
+            for proxy in ["v", "d", "c"]:
+                if proxy in proxies:
+                    return ["a_{}_m".format(proxy)]
+            return ["a_m"]
+    return []
+
+
+def archaic_arrow_masks():
+    """
+    Returns, for each archaic and descent path, a mask of the codes of the leaves
+    which descend from the archaic along it. A leaf's code is 16 times the index
+    of its category plus the bits of the proxy nodes above it on the path.
+    """
+    masks = {
+        archaic: dict.fromkeys(arrows, 0) for archaic, arrows in ARCHAIC_ARROWS.items()
+    }
+    for index, category in enumerate(LEAF_CATEGORIES):
+        for bits in range(16):
+            proxies = {name for name, bit in PROXY_BITS.items() if bits & bit}
+            for archaic, arrow_masks in masks.items():
+                for arrow in archaic_path_arrows(archaic, category, proxies):
+                    arrow_masks[arrow] |= 1 << (16 * index + bits)
+    return {
+        archaic: {arrow: np.uint64(mask) for arrow, mask in arrow_masks.items()}
+        for archaic, arrow_masks in masks.items()
+    }
+
+
+def find_archaic_descent(ts, proxies, archaics, nonarchaic):
+    """
+    Returns the span of descent along each path from each archaic, in one pass over
+    the trees. proxies and archaics map the archaic names in ARCHAIC_ARROWS to their
+    proxy nodes and sample nodes. For each proxy node with more than one leaf, the
+    leaves below it are encoded by category and the set of other proxy nodes on the
+    path up to it, and the paths are read from the bitwise OR of the codes.
+    """
+    category = np.full(ts.num_nodes, -1)
+    for index, name in reversed(list(enumerate(LEAF_CATEGORIES))):
+        category[nonarchaic if name == "m" else archaics[name]] = index
+    proxy_archaic = {node: name for name, nodes in proxies.items() for node in nodes}
+    arrow_masks = archaic_arrow_masks()
+    descent = {
+        name: dict.fromkeys(["total_{}_descent".format(name)] + arrows, 0)
+        for name, arrows in ARCHAIC_ARROWS.items()
+    }
+    path_bits = np.zeros(ts.num_nodes, dtype=np.uint64)
+    for tree in tqdm(ts.trees(), total=ts.num_trees, desc="Archaic Descent"):
+        left_child = tree.left_child_array
+        for node, name in proxy_archaic.items():
+            nodes = tree.preorder(node)
+            leaves = nodes[left_child[nodes] == tskit.NULL]
+            if len(leaves) <= 1:
+                assert leaves[0] in archaics[name] or leaves[0] in proxies[name]
+                continue
+            descent[name]["total_{}_descent".format(name)] += tree.span
+            # Proxy nodes of the same archaic have the same time, so none of them
+            # are below this one.
+            for other, other_name in proxy_archaic.items():
+                if (
+                    other != node
+                    and left_child[other] != tskit.NULL
+                    and tree.is_descendant(other, node)
+                ):
+                    other_nodes = tree.preorder(other)
+                    path_bits[other_nodes[left_child[other_nodes] == tskit.NULL]] |= (
+                        np.uint64(PROXY_BITS[other_name])
+                    )
+            leaf_category = category[leaves]
+            categorised = leaf_category >= 0
+            codes = 16 * leaf_category[categorised].astype(np.uint64) + path_bits[
+                leaves[categorised]
+            ]
+            path_bits[leaves] = 0
+            mask = np.bitwise_or.reduce(np.left_shift(np.uint64(1), codes))
+            if name == "v" and not mask & arrow_masks["v"]["v_m"]:
+                raise ValueError("Leaves must be younger than Vindija")
+            for arrow, arrow_mask in arrow_masks[name].items():
+                if mask & arrow_mask:
+                    descent[name][arrow] += tree.span
+    return descent
+
+
+def find_archaic_relationships(args):
+    ts = tskit.load(
+        "all-data/merged_hgdp_1kg_sgdp_high_cov_ancients_chr20.dated.binned.historic.snipped.trees"
+    )
+    tables = ts.tables
+    proxies = {
+        "a": np.where(tables.nodes.time == 4400.01)[0],
+        "c": np.where(tables.nodes.time == 3200.01)[0],
+        "d": np.where(tables.nodes.time == 2556.01)[0],
+        "v": np.where(tables.nodes.time == 2000.01)[0],
+    }
+    archaics = {
+        "a": np.where(tables.nodes.population == ts.num_populations - 1)[0],
+        "c": np.where(tables.nodes.population == ts.num_populations - 2)[0],
+        "v": np.where(tables.nodes.population == ts.num_populations - 3)[0],
+        "d": np.where(tables.nodes.population == ts.num_populations - 4)[0],
+    }
+    nonarchaic = ts.samples()[:-8]
+    descent = find_archaic_descent(ts, proxies, archaics, nonarchaic)
 
     with open("data/archaic_descent.txt", "w") as file:
-        file.write(json.dumps(a_descent))
-        file.write(json.dumps(c_descent))
-        file.write(json.dumps(d_descent))
-        file.write(json.dumps(v_descent))
+        for name in ["a", "c", "d", "v"]:
+            file.write(json.dumps(descent[name]))
+
 
 def get_tmrcas(args):
     ts_fn = os.path.join(
@@ -959,6 +1310,7 @@ def main():
         "recurrent_mutations_tgp": get_tgp_recurrent_mutations,
         "recurrent_mutations_hgdp": get_hgdp_recurrent_mutations,
         "recurrent_mutations_sgdp": get_sgdp_recurrent_mutations,
+        "recurrent_mutations_all": get_all_recurrent_mutations,
         "tgp_dates": tgp_date_estimates,
         "ancient_constraints": get_ancient_constraints_tgp,
         "min_site_times_ancients": min_site_times_ancients,
@@ -979,6 +1331,19 @@ def main():
         '--num_processes', '-p', type=int, default=1, 
         help='The number of CPUs to use in for some of the more intensive calculations',
     )
+    parser.add_argument(
+        "--epoch_length",
+        type=float,
+        default=None,
+        help="For ancestral geography, write the node locations in epochs of this "
+        "many generations to one file per epoch instead of a single csv",
+    )
+    parser.add_argument(
+        "--grid_resolution",
+        type=float,
+        default=1,
+        help="The size in degrees of the grid cells of the epoch densities",
+    )
 
     args = parser.parse_args()
     name_map[args.name](args)
@@ -2949,11 +2949,21 @@ class VindiajDescent(AncientDescent):
     name = "vindija_descent"
     data_path = "data"
     filename = [
-        "combined_ts_vindija_descent_arr",
         "combined_ts_vindija_descendants",
         "combined_ts_vindija_corrcoeff_df",
     ]
 
+    def __init__(self):
+        super().__init__()
+        # The descent array is bit-packed, with a bit for each 1Kb chunk
+        descent = np.load(
+            os.path.join(self.data_path, "combined_ts_vindija_descent_arr.npz")
+        )
+        self.data.insert(
+            0,
+            np.unpackbits(descent["packed"], axis=1, count=int(descent["num_bins"])),
+        )
+
     def plot(self):
         descent_arr = self.data[0]
         descendants = self.data[1]
@@ -19,17 +19,10 @@ def get_mut_pos_df(ts, name, node_dates, mutation_age="geometric", exclude_root=
     return mut_df
 
 def weighted_geographic_center(lat_list, long_list, weights):
-    x = list()
-    y = list()
-    z = list()
     if len(lat_list) == 1 and len(long_list) == 1:
         return(lat_list[0], long_list[0])
-    lat_radians = np.radians(lat_list)
-    long_radians = np.radians(long_list)
-    x = (np.cos(lat_radians) * np.cos(long_radians))
-    y = (np.cos(lat_radians) * np.sin(long_radians))
-    z = (np.sin(lat_radians))
-    
+    x, y, z = geographic_to_unit_vectors(lat_list, long_list).T
+
     weights = np.array(weights)
     central_latitude, central_longitude = radians_center_weighted(x, y, z, weights)
 
@@ -45,3 +38,24 @@ def radians_center_weighted(x, y, z, weights):
             weighted_avg_x * weighted_avg_x + weighted_avg_y * weighted_avg_y)
     central_latitude = np.arctan2(weighted_avg_z, central_square_root)
     return central_latitude, central_longitude
+
+def geographic_to_unit_vectors(lats, longs):
+    """
+    Returns an (n, 3) array of the unit vectors of latitudes and longitudes in degrees
+    """
+    lat_radians = np.radians(lats)
+    long_radians = np.radians(longs)
+    return np.stack([
+        np.cos(lat_radians) * np.cos(long_radians),
+        np.cos(lat_radians) * np.sin(long_radians),
+        np.sin(lat_radians)], axis=-1)
+
+def unit_vectors_to_geographic(vectors):
+    """
+    Returns the latitudes and longitudes in degrees of the directions of an (n, 3)
+    array of vectors, which need not be normalised, as in radians_center_weighted
+    """
+    x, y, z = vectors[:, 0], vectors[:, 1], vectors[:, 2]
+    lats = np.arctan2(z, np.sqrt(x * x + y * y))
+    longs = np.arctan2(y, x)
+    return np.degrees(lats), np.degrees(longs)